@@ -3,35 +3,67 @@
 
 from __future__ import print_function
 
-import sys
-import csv
+import argparse
 
-from common import getField, isValidNodeLine
+from common import BODY_LENGTH, RecordCodec, RecordWriter, \
+    addInstrumentationArguments, instrumented, loadNodes, mapFile
 
 # To make our reducers lives' easier, we want questions before answers. {{{
 QUESTION = 'A'
 ANSWER = 'B'
 # }}}
 
-def mapper():
+# The fields we're interested in. See the comments in `mapper()`
+FIELDS = ('id', 'node_type', 'abs_parent_id', BODY_LENGTH)
+
+# Layouts of our records in binary mode: node id, marker and length, plus the
+# answer count of combined records. See RecordCodec.
+RECORD_LAYOUTS = ('ncI', 'ncII')
+CODEC = RecordCodec(*RECORD_LAYOUTS)
+
+# How many threads the combiner keeps partial sums for before flushing them
+MAX_COMBINER_ENTRIES = 100000
+
+
+def flush(partials, emit):
+    """Outputs the partial answer lengths gathered by the combiner.
+
+    :partials: A dict mapping question ids to [total length, answer count].
+    :emit: The function that outputs a record, like `RecordWriter.write()`.
+    :returns: None. The dict is emptied.
+    """
+    for parent, (total, count) in partials.items():
+        emit(parent, ANSWER, total, count)
+    partials.clear()
+
+
+def mapper(combine=False, maxEntries=MAX_COMBINER_ENTRIES, binary=False,
+           cache=None):
     """Mapper function.
 
     Input is read from sys.stdin and written to sys.stdout. Both streams can be
     overwritten if needed.
 
+    :combine: Whether to sum the answer lengths of each thread in the mapper
+              instead of outputting every answer (in-mapper combining).
+    :maxEntries: How many threads the combiner holds in memory at most. When
+                 this many threads have partial sums, all of them are output.
+    :binary: Whether to output binary records instead of text. Hadoop
+             Streaming only handles text.
+    :cache: A cache to read nodes from instead of sys.stdin, if it is fresh.
+            See `common.loadNodes()`.
     :returns: Nothing. Writes to standard output.
     """
 
-    # The input file is saved as a tab-separated file. The data itself comes from
-    # http://content.udacity-data.com/course/hadoop/forum_data.tar.gz -- file
-    # "forum_nodes.tsv".
-    reader = csv.reader(sys.stdin, delimiter='\t')
-
-    for line in reader:
-        # Basic data sanity check
-        if not isValidNodeLine(line):
-            continue
+    # Partial sums for the combiner: question id -> [total length, count]
+    partials = {}
+    writer = RecordWriter(codec=CODEC if binary else None)
+    emit = writer.write
 
+    # The input file is saved as a tab-separated file. The data itself comes
+    # from http://content.udacity-data.com/course/hadoop/forum_data.tar.gz --
+    # file "forum_nodes.tsv". readNodes parses it and drops the invalid lines.
+    for node, nodeType, parent, length in loadNodes(FIELDS, cache):
         # The fields we're interested in. For questions, we obviously want
         # their ids to be output, along with their body lengths. For answers,
         # we actually want to output the value of "parent_id", and the reason
@@ -39,16 +71,6 @@ def mapper():
         # questions that caused them to be. The node_type is used to decide if
         # this is a question or an answer. Comments should be ignored.
 
-        node = getField(line, 'id')
-        nodeType = getField(line, 'node_type')
-        parent = getField(line, 'abs_parent_id')
-        body = getField(line, 'body')
-
-        # If any of the fields we're interested in is None, then it is no good
-        # for us. Drop this line altogether.
-        if any(map(lambda x: x == None, (node, nodeType, parent, body))):
-            continue
-
         # Data output, as announced by the comments above
         # NOTE: We're assuming neither questions nor answers can be empty.
         # We're hoping that the forum software prevented that from happening.
@@ -57,13 +79,69 @@ def mapper():
         # string, which has a length of two. This could be improved, but
         # I believe this happening would be quite unlikely.
         if nodeType == 'question':
-            print('{0}\t{1}\t{2}'.format(node, QUESTION, len(body)))
+            emit(node, QUESTION, length)
         elif nodeType == 'answer':
-            print('{0}\t{1}\t{2}'.format(parent, ANSWER, len(body)))
+            if not combine:
+                emit(parent, ANSWER, length)
+                continue
+
+            # The reducer only needs the sum of the lengths and the number of
+            # answers, which can be added up in any order. So we add them up
+            # here, and ship a single record per thread instead of one per
+            # answer. Partial sums are fine: the reducer adds them up again.
+            partial = partials.get(parent)
+            if partial is None:
+                if len(partials) >= maxEntries:
+                    flush(partials, emit)
+                partial = partials[parent] = [0, 0]
+            partial[0] += length
+            partial[1] += 1
         else:
             # We don't care about it.
             continue
 
+    # Whatever the combiner still holds must reach the reducers
+    flush(partials, emit)
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the mapper."
+    parser = argparse.ArgumentParser(
+        description='Mapper for the Post and Answer Length exercise.')
+    parser.add_argument('--combine', action='store_true',
+                        help='Sum answer lengths per thread in the mapper.')
+    parser.add_argument('--max-entries', type=int,
+                        default=MAX_COMBINER_ENTRIES,
+                        help='How many threads the combiner keeps in memory.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Output binary records (for local runs only).')
+    parser.add_argument('--cache',
+                        help='Read nodes from this cache (see build_cache.py) '
+                        'instead of standard input, if it is fresh.')
+    parser.add_argument('input', nargs='?',
+                        help='Read nodes from this file instead of standard '
+                        'input, splitting it among --workers processes.')
+    parser.add_argument('--workers', type=int,
+                        help='How many processes to use when given a file. '
+                        'Default: one per CPU.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.input is not None and args.cache is not None:
+        parser.error('--cache holds the whole input and cannot be split '
+                     'among workers')
+
+    with instrumented('average_length_mapper', args.counters, args.stats,
+                      args.profile):
+        if args.input is None:
+            mapper(combine=args.combine, maxEntries=args.max_entries,
+                   binary=args.binary, cache=args.cache)
+        else:
+            mapFile(args.input, args.workers, mapper, combine=args.combine,
+                    maxEntries=args.max_entries, binary=args.binary)
+
+
 if __name__ == '__main__':
-    mapper()
+    main()
 
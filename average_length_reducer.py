@@ -5,6 +5,15 @@
 
 .. _Post and Answer Length: https://www.udacity.com/course/viewer#!/c-ud617/l-717558831/m-700668970
 
+With ``--statistics``, the reducer also summarises the relation between the
+length of each question and the mean length of its answers as it goes:
+Pearson's and Spearman's correlations, quantiles and histograms of both. The
+summary is output as one more line, keyed by SUMMARY_KEY, and the summaries
+of many reducers are merged into the statistics with ``--merge-statistics``::
+
+    cat average-length-output/part-* | \\
+        python average_length_reducer.py --merge-statistics
+
 .. module:: average_length_reducer
 .. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
 """
@@ -13,41 +22,62 @@ from __future__ import print_function
 from __future__ import division # Float division by default
 
 import sys
+import json
+import argparse
+
+from common import JointHistogram, Moments, RecordCodec, RecordWriter, \
+    TDigest, addInstrumentationArguments, drop, instrumented, timed
 
 # To make our reducers lives' easier, we want questions before answers. {{{
 QUESTION = 'A'
 ANSWER = 'B'
 # }}}
 
+# Layouts of our records in binary mode. Must match the mapper's.
+RECORD_LAYOUTS = ('ncI', 'ncII')
+CODEC = RecordCodec(*RECORD_LAYOUTS)
+
+# Statistics. See `LengthStatistics`. {{{
+# Key of the line holding a reducer's summary. Node ids are never empty, so
+# this can't be a node.
+SUMMARY_KEY = ''
+# The quantiles output
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+# }}}
+
 def getData(line):
     """Basic sanity checking function.
 
     Makes sure a line is valid before outputting it to the mapper by doing some
     basic sanity checks.
 
-    :line: The line to be validated.
+    :line: The line to be validated. Binary records come already split.
     :returns: The data in the format expected if it is valid. None otherwise.
     """
-    data = line.strip().split('\t')
-
-    # Our mapper outputs three columns. Anything different than that can be
-    # considered corrupt
-    if len(data) != 3:
+    data = line.strip().split('\t') if isinstance(line, str) else line
+
+    # Our mapper outputs three columns, or four when it combines answers: the
+    # third one is then a sum of lengths and the fourth one, how many answers
+    # were summed. Anything different than that can be considered corrupt
+    if len(data) == 3:
+        node, nodeType, length = data
+        count = 1
+    elif len(data) == 4:
+        node, nodeType, length, count = data
+    else:
         return None
 
-    # In the format we expect
-    node, nodeType, length = data
-
     try:
         length = int(length)
+        count = int(count)
     except ValueError:
         # This is not a body length. :'(
         return None
 
     if nodeType == QUESTION:
-        return node, True, length
+        return node, True, length, count
     elif nodeType == ANSWER:
-        return node, False, length
+        return node, False, length, count
     else:
         return None
 
@@ -68,19 +98,20 @@ def getAverageAnswerLength(nodeInfo):
         return 0
 
 
-def output(node, nodeInfo):
+def output(node, nodeInfo, writer):
     """Outputs the information this reducer has consolidated.
 
     :node: The node id we're outputting information about.
     :nodeInfo: The node's statistics: question length, total answer length and
                amount of answers.
+    :writer: The RecordWriter to output to.
     :returns: None.
 
     """
-    print('{0}\t{1}\t{2}'.format(node,
-                                 getQuestionLength(nodeInfo),
-                                 getAverageAnswerLength(nodeInfo)
-                                ))
+    writer.write(node,
+                 getQuestionLength(nodeInfo),
+                 getAverageAnswerLength(nodeInfo)
+                )
 
 
 def emptyNodeInfo():
@@ -88,32 +119,142 @@ def emptyNodeInfo():
     return [0] * 3
 
 
-def update(nodeInfo, isQuestion, length):
-    "Updates nodeInfo with the information we just read."
+def update(nodeInfo, isQuestion, length, count=1):
+    """Updates nodeInfo with the information we just read.
+
+    :nodeInfo: The node's statistics. See `output()`.
+    :isQuestion: Whether the information is about the question itself.
+    :length: The question length, or the total length of `count` answers.
+    :count: How many answers `length` refers to.
+    :returns: None.
+    """
 
     if isQuestion:
         nodeInfo[0] = length
     else:
         nodeInfo[1] += length
-        nodeInfo[2] += 1
+        nodeInfo[2] += count
 
 
-def reducer():
+class LengthStatistics(object):
+    """Single-pass statistics of question lengths and mean answer lengths.
+
+    Only threads with answers are counted, since the others have no mean
+    answer length. Every part of this can be merged with the same part of
+    another reducer's statistics, so the statistics of the whole output are
+    known without reading it again:
+
+    * `common.Moments` gives the means, standard deviations and Pearson's
+      correlation;
+    * a `common.TDigest` of each length gives its quantiles;
+    * a `common.JointHistogram` of both gives their histograms and an
+      estimate of Spearman's correlation.
+    """
+
+    def __init__(self):
+        "Creates empty statistics."
+        self.moments = Moments()
+        self.questions = TDigest()
+        self.answers = TDigest()
+        self.histogram = JointHistogram()
+
+    def add(self, nodeInfo):
+        "Counts a thread, given its nodeInfo. See `output()`."
+        if not nodeInfo[2]:
+            return
+        questionLength = getQuestionLength(nodeInfo)
+        answerLength = getAverageAnswerLength(nodeInfo)
+        self.moments.add(questionLength, answerLength)
+        self.questions.add(questionLength)
+        self.answers.add(answerLength)
+        self.histogram.add(questionLength, answerLength)
+
+    def merge(self, other):
+        "Adds the threads counted by other statistics to these."
+        self.moments.merge(other.moments)
+        self.questions.merge(other.questions)
+        self.answers.merge(other.answers)
+        self.histogram.merge(other.histogram)
+
+    def dumps(self):
+        "Serialises the statistics as a single line of JSON."
+        return json.dumps({'moments': self.moments.asList(),
+                           'questions': self.questions.asDict(),
+                           'answers': self.answers.asDict(),
+                           'histogram': self.histogram.asDict()})
+
+    @classmethod
+    def loads(cls, text):
+        """Deserialises statistics.
+
+        :text: The statistics, as returned by `dumps()`.
+        :returns: The statistics.
+        :raises ValueError: If the text is not statistics.
+        """
+        data = json.loads(text)
+        statistics = cls()
+        statistics.moments = Moments.fromList(data['moments'])
+        statistics.questions = TDigest.fromDict(data['questions'])
+        statistics.answers = TDigest.fromDict(data['answers'])
+        statistics.histogram = JointHistogram.fromDict(data['histogram'])
+        return statistics
+
+    def output(self, writer):
+        """Outputs the statistics, as (subject, statistic, value) lines.
+
+        The subject is "question" or "answer" for the statistics of question
+        lengths or mean answer lengths, and "both" for the correlations.
+        Histogram bins are named after their bounds, like "bin 10-11.2".
+
+        :writer: The RecordWriter to output to.
+        """
+        moments = self.moments
+        writer.write('both', 'threads', moments.count)
+        writer.write('both', 'pearson', _format(moments.pearson()))
+        writer.write('both', 'spearman', _format(self.histogram.spearman()))
+
+        deviations = moments.stddev()
+        subjects = (('question', 0, moments.meanX, self.questions),
+                    ('answer', 1, moments.meanY, self.answers))
+        for subject, axis, mean, digest in subjects:
+            writer.write(subject, 'mean', _format(mean))
+            writer.write(subject, 'stddev', _format(deviations[axis]))
+            for q in QUANTILES:
+                writer.write(subject, 'p{0:g}'.format(q * 100),
+                             _format(digest.quantile(q)))
+            for lower, upper, count in self.histogram.marginal(axis):
+                writer.write(subject, 'bin {0}-{1}'.format(
+                    _format(lower), _format(upper)), count)
+
+
+def _format(value):
+    "Formats a statistic, which may be undefined."
+    return 'nan' if value is None else '{0:.6g}'.format(value)
+
+
+def reducer(binary=False, statistics=False):
     """Reducer function.
 
+    :binary: Whether the input holds binary records instead of text.
+    :statistics: Whether to output the `LengthStatistics` of the threads as
+                 well, as a last line keyed by SUMMARY_KEY.
     :returns: Nothing. Writes to standard output.
     """
 
     # Init the reducer
     lastNode = '-1'
     nodeInfo = emptyNodeInfo()
+    writer = RecordWriter()
+    summary = LengthStatistics() if statistics else None
 
-    for line in sys.stdin:
+    records = CODEC.readRecords(sys.stdin) if binary else sys.stdin
+    for line in timed(records, 'read'):
         data = getData(line)
         if data is None:
+            drop('malformed record')
             continue
 
-        node, isQuestion, length = data
+        node, isQuestion, length, count = data
 
         # The line we just read belong to a different node. We must output
         # the information about the previous one and initialize the state for
@@ -122,17 +263,77 @@ def reducer():
             # We don't want to output data just because the line we read is
             # different from the initialization data.
             if lastNode != '-1':
-                output(lastNode, nodeInfo)
+                output(lastNode, nodeInfo, writer)
+                if summary is not None:
+                    summary.add(nodeInfo)
                 nodeInfo = emptyNodeInfo()
 
         # Update the information about the current node
-        update(nodeInfo, isQuestion, length)
+        update(nodeInfo, isQuestion, length, count)
 
         lastNode = node
 
     # We exited the loop, but we still have state stored. Output it.
-    output(lastNode, nodeInfo)
+    output(lastNode, nodeInfo, writer)
+    if summary is not None:
+        summary.add(nodeInfo)
+        writer.write(SUMMARY_KEY, summary.dumps())
+    writer.flush()
+
+
+def mergeStatistics():
+    """Merges the statistics output by many reducers, and outputs them.
+
+    Lines that are not statistics (the rest of the reducers' outputs) are
+    ignored, so the outputs can be given as they are.
+
+    :returns: Nothing. Writes to standard output.
+    """
+    summary = None
+    prefix = SUMMARY_KEY + '\t'
+    for line in timed(sys.stdin, 'read'):
+        if not line.startswith(prefix):
+            continue
+        try:
+            other = LengthStatistics.loads(line[len(prefix):])
+        except (ValueError, KeyError, TypeError):
+            drop('not statistics')
+            continue
+        if summary is None:
+            summary = other
+        else:
+            summary.merge(other)
+
+    if summary is None:
+        return
+
+    writer = RecordWriter()
+    summary.output(writer)
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the reducer."
+    parser = argparse.ArgumentParser(
+        description='Reducer for the Post and Answer Length exercise.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Read binary records (for local runs only).')
+    parser.add_argument('--statistics', action='store_true',
+                        help='Output a summary of the correlation between '
+                        'question and answer lengths as well.')
+    parser.add_argument('--merge-statistics', action='store_true',
+                        help='Merge the summaries output by many reducers '
+                        'instead, and output the statistics.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    with instrumented('average_length_reducer', args.counters, args.stats,
+                      args.profile):
+        if args.merge_statistics:
+            mergeStatistics()
+        else:
+            reducer(binary=args.binary, statistics=args.statistics)
 
 
 if __name__ == '__main__':
-    reducer()
+    main()
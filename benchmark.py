@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Micro-benchmarks for the hot paths of the mappers and reducers.
+
+Run it as ``python benchmark.py [name ...]``. With no names, every benchmark
+is run. Results are printed as tab-separated ``benchmark, variant, rows/sec``
+lines (or bytes, or rows, for variants named so), so that they can be easily
+compared between runs.
+
+.. module:: benchmark
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import io
+import os
+import csv
+import sys
+import glob
+import time
+import itertools
+import tracemalloc
+import random
+import shutil
+import argparse
+import tempfile
+
+from common import BODY_LENGTH, ID_INDEX, NODE_FIELDS, NUM_NODE_FIELDS, \
+    REJECTIONS, RecordWriter, compileProjection, isValidNodeLine, readNodes, \
+    validateNodeLine
+from generate_nodes import generateNodes
+import local_mapreduce
+import popular_tags_mapper
+import popular_tags_reducer
+import student_times_mapper
+import student_times_reducer
+import study_groups_reducer
+
+# How many times each variant runs. We keep the best time.
+REPEAT = 3
+
+
+def sampleLines(count, seed=42):
+    """Builds parsed lines that look like the ones in forum_nodes.tsv.
+
+    :count: How many lines to build.
+    :seed: Seed for the random number generator, so runs are comparable.
+    :returns: A list of lists of strings, as csv.reader would return them.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for node in range(count):
+        line = ['\\N'] * len(NODE_FIELDS)
+        line[NODE_FIELDS.index('id')] = str(node)
+        line[NODE_FIELDS.index('tagnames')] = 'cs101 homework'
+        line[NODE_FIELDS.index('author_id')] = str(rng.randint(1, 5000))
+        line[NODE_FIELDS.index('body')] = 'x' * rng.randint(10, 2000)
+        line[NODE_FIELDS.index('node_type')] = rng.choice(('question',
+                                                           'answer',
+                                                           'comment'))
+        line[NODE_FIELDS.index('abs_parent_id')] = str(rng.randint(0, node))
+        line[NODE_FIELDS.index('added_at')] = '2012-02-25 08:09:06.787181+00'
+        lines.append(line)
+    return lines
+
+
+def sampleTsv(count, seed=42):
+    """Builds the contents of a forum_nodes.tsv file, header included.
+
+    Just like in the real file, every field is quoted.
+
+    :count: How many lines to build, not counting the header.
+    :seed: Seed for the random number generator, so runs are comparable.
+    :returns: The file contents, as UTF-8 encoded bytes.
+    """
+    lines = [NODE_FIELDS] + sampleLines(count, seed)
+    text = '\n'.join('\t'.join('"{0}"'.format(field) for field in line)
+                     for line in lines)
+    return (text + '\n').encode('utf-8')
+
+
+def asStdin(data):
+    "Wraps bytes in a stream that behaves like sys.stdin."
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+
+def asStdout():
+    "A stream that behaves like sys.stdout, writing to memory."
+    return io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+
+
+def rowsPerSecond(function, rows):
+    """Measures how many rows per second a function processes.
+
+    :function: A function that takes the list of rows and processes them all.
+    :rows: The rows to be processed.
+    :returns: The best throughput observed in REPEAT runs.
+    """
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        function(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(rows) / best if best else float('inf')
+
+
+def report(benchmark, variant, rate):
+    "Prints a benchmark result."
+    print('{0}\t{1}\t{2:.0f}'.format(benchmark, variant, rate))
+
+
+def benchmarkProjection(count):
+    """Per-row field lookups vs. a compiled projection.
+
+    The "lookup" variant is how mappers used to fetch their fields: a linear
+    scan of NODE_FIELDS for every field of every row.
+    """
+    fields = ('id', 'node_type', 'abs_parent_id', 'body')
+    rows = sampleLines(count)
+
+    def lookup(rows):
+        for line in rows:
+            if len(line) != len(NODE_FIELDS):
+                continue
+            int(line[NODE_FIELDS.index('id')])
+            [line[NODE_FIELDS.index(field)] for field in fields]
+
+    getNodeFields = compileProjection(fields)
+
+    def projection(rows):
+        for line in rows:
+            if not isValidNodeLine(line):
+                continue
+            getNodeFields(line)
+
+    report('projection', 'lookup', rowsPerSecond(lookup, rows))
+    report('projection', 'compiled', rowsPerSecond(projection, rows))
+
+
+def benchmarkReader(count):
+    """csv.reader over the whole input vs. readNodes.
+
+    Every variant reads the fields average_length_mapper needs from a file
+    that looks like forum_nodes.tsv. The mapper actually asks for the length
+    of the body, not its text: "readNodes, measured" gets that by asking for
+    BODY_LENGTH, and "readNodes, len()" by measuring the bodies readNodes
+    returns, which is how it used to be done.
+    """
+    fields = ('id', 'node_type', 'abs_parent_id', 'body')
+    data = sampleTsv(count)
+    getNodeFields = compileProjection(fields)
+
+    def csvReader(data):
+        for line in csv.reader(asStdin(data), delimiter='\t'):
+            if not isValidNodeLine(line):
+                continue
+            getNodeFields(line)
+
+    def fastReader(data):
+        for _ in readNodes(fields, asStdin(data)):
+            pass
+
+    def lenReader(data):
+        for row in readNodes(fields, asStdin(data)):
+            row[:-1] + (len(row[-1]),)
+
+    def measuringReader(data):
+        for _ in readNodes(fields[:-1] + (BODY_LENGTH,), asStdin(data)):
+            pass
+
+    # Throughput is measured in rows, not in bytes
+    rows = [data] * count
+    report('reader', 'csv', rowsPerSecond(lambda _: csvReader(data), rows))
+    report('reader', 'readNodes', rowsPerSecond(lambda _: fastReader(data),
+                                                rows))
+    report('reader', 'readNodes, len()',
+           rowsPerSecond(lambda _: lenReader(data), rows))
+    report('reader', 'readNodes, measured',
+           rowsPerSecond(lambda _: measuringReader(data), rows))
+
+
+def benchmarkValidator(count):
+    """Node line validation: int() vs. str.isdecimal().
+
+    Lines come from `generate_nodes`, so that 1% of them is malformed in
+    each of the ways validateNodeLine tells apart. The "int" variant is how
+    lines used to be validated. Besides the throughput, how many rows were
+    rejected for each reason is reported.
+    """
+    data = ''.join(generateNodes(count, malformed=0.01))
+    rows = list(csv.reader(io.StringIO(data), delimiter='\t'))
+
+    def isValidWithInt(line):
+        if len(line) != NUM_NODE_FIELDS:
+            return False
+        try:
+            int(line[ID_INDEX])
+        except ValueError:
+            return False
+        return True
+
+    def intValidator(rows):
+        for line in rows:
+            isValidWithInt(line)
+
+    def validator(rows):
+        for line in rows:
+            validateNodeLine(line)
+
+    report('validator', 'int', rowsPerSecond(intValidator, rows))
+    report('validator', 'isdecimal', rowsPerSecond(validator, rows))
+
+    rejections = dict((reason, 0) for reason in REJECTIONS)
+    header = True
+    for line in rows:
+        reason = validateNodeLine(line, header)
+        header = False
+        if reason is not None:
+            rejections[reason] += 1
+    for reason in REJECTIONS:
+        report('validator', reason + ' rows', rejections[reason])
+
+
+def sampleDates(count, seed=42):
+    """Builds dates in the format used by forum_nodes.tsv.
+
+    Dates are spread over two months, so that some of them share the same
+    day and hour, as posts in the forum do.
+    """
+    rng = random.Random(seed)
+    return ['2012-{0:02d}-{1:02d} {2:02d}:{3:02d}:{4:02d}.{5:06d}+00'.format(
+        rng.randint(2, 3), rng.randint(1, 28), rng.randint(0, 23),
+        rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999999))
+        for _ in range(count)]
+
+
+def benchmarkDates(count):
+    """strptime vs. slicing (with a cached prefix) vs. NumPy batches.
+
+    These are the ways student_times_mapper can get the hour of a post.
+    """
+    dates = sampleDates(count)
+
+    def strptime(dates):
+        for date in dates:
+            student_times_mapper.parseDate(date).hour
+
+    def sliced(dates):
+        for date in dates:
+            student_times_mapper.parseHour(date)
+
+    def batches(dates):
+        size = student_times_mapper.BATCH_SIZE
+        for start in range(0, len(dates), size):
+            student_times_mapper.parseHours(dates[start:start + size])
+
+    report('dates', 'strptime', rowsPerSecond(strptime, dates))
+    report('dates', 'parseHour', rowsPerSecond(sliced, dates))
+    if student_times_mapper.np is not None:
+        report('dates', 'parseHours', rowsPerSecond(batches, dates))
+
+
+def benchmarkRecords(count):
+    """Text lines vs. binary records between student_times mappers/reducers.
+
+    Encoding is what the mapper does to output a record, decoding is what the
+    reducer does to get it back (reading it from a stream included), and the
+    size is how many bytes each record takes on the way.
+    """
+    rng = random.Random(42)
+    records = [(str(rng.randint(1, 10 ** 8)), rng.randint(0, 23))
+               for _ in range(count)]
+    codec = student_times_mapper.CODEC
+    text = ''.join('{0}\t{1}\n'.format(*record)
+                   for record in records).encode('utf-8')
+    binary = b''.join(codec.encode(record) for record in records)
+
+    def textEncode(records):
+        '\n'.join('\t'.join(str(field) for field in record)
+                  for record in records).encode('utf-8')
+
+    def binaryEncode(records):
+        encode = codec.encode
+        b''.join(encode(record) for record in records)
+
+    def textDecode(_):
+        for line in asStdin(text):
+            student_times_reducer.getData(line)
+
+    def binaryDecode(_):
+        for record in codec.readRecords(io.BytesIO(binary)):
+            student_times_reducer.getData(record)
+
+    report('records', 'text encode', rowsPerSecond(textEncode, records))
+    report('records', 'binary encode', rowsPerSecond(binaryEncode, records))
+    report('records', 'text decode', rowsPerSecond(textDecode, records))
+    report('records', 'binary decode', rowsPerSecond(binaryDecode, records))
+    report('records', 'text bytes/row', len(text) / count)
+    report('records', 'binary bytes/row', len(binary) / count)
+
+
+def benchmarkOutput(count):
+    """print() per record vs. RecordWriter.
+
+    Records look like the ones student_times_mapper outputs, and are written
+    to a stream that behaves like sys.stdout.
+    """
+    rng = random.Random(42)
+    records = [(str(rng.randint(1, 10 ** 8)), rng.randint(0, 23))
+               for _ in range(count)]
+
+    def printed(records):
+        sys.stdout = asStdout()
+        try:
+            for author, hour in records:
+                print('{0}\t{1}'.format(author, hour))
+            sys.stdout.flush()
+        finally:
+            sys.stdout = sys.__stdout__
+
+    def buffered(records):
+        writer = RecordWriter(stream=asStdout())
+        for author, hour in records:
+            writer.write(author, hour)
+        writer.flush()
+
+    report('output', 'print', rowsPerSecond(printed, records))
+    report('output', 'RecordWriter', rowsPerSecond(buffered, records))
+
+
+def benchmarkReducer(count):
+    """Streaming student_times_reducer vs. its NumPy batch mode.
+
+    The input is sorted mapper output with about 8 posts per author.
+    """
+    rng = random.Random(42)
+    authors = sorted(str(rng.randint(1, count // 8 + 1)) for _ in range(count))
+    text = ''.join('{0}\t{1}\n'.format(author, rng.randint(0, 23))
+                   for author in authors).encode('utf-8')
+
+    def run(function):
+        sys.stdin, sys.stdout = asStdin(text), asStdout()
+        try:
+            function()
+        finally:
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+
+    rows = [text] * count
+    report('reducer', 'streaming',
+           rowsPerSecond(lambda _: run(student_times_reducer.reducer), rows))
+    if student_times_reducer.np is not None:
+        report('reducer', 'batch', rowsPerSecond(
+            lambda _: run(student_times_reducer.batchReducer), rows))
+
+
+def sampleTaggedTsv(count, seed=42):
+    """Same as `sampleTsv()`, but with many different tags.
+
+    Each node has three tags, drawn from a vocabulary of `count // 4` tags
+    with a skewed (Zipf-like) distribution, as tags in the forum are.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['tag{0}'.format(tag) for tag in range(max(count // 4, 1))]
+    weights = list(itertools.accumulate(1 / (rank + 1)
+                                        for rank in range(len(vocabulary))))
+    tagsIndex = NODE_FIELDS.index('tagnames')
+    lines = sampleLines(count, seed)
+    for line in lines:
+        line[tagsIndex] = ' '.join(rng.choices(vocabulary, cum_weights=weights,
+                                               k=3))
+    text = '\n'.join('\t'.join('"{0}"'.format(field) for field in line)
+                     for line in [NODE_FIELDS] + lines)
+    return (text + '\n').encode('utf-8')
+
+
+def benchmarkTopTags(count):
+    """The popular tags job with 1, 4 and 16 reducers, merge step included.
+
+    Each variant is a whole local_mapreduce.py run over `sampleTaggedTsv()`.
+    """
+    lines = [None] * count
+    workDir = tempfile.mkdtemp(prefix='benchmark-')
+    inputPath = os.path.join(workDir, 'forum_nodes.tsv')
+    with open(inputPath, 'wb') as inputFile:
+        inputFile.write(sampleTaggedTsv(count))
+
+    def job(reducers):
+        outputDir = os.path.join(workDir, 'output')
+        shutil.rmtree(outputDir, ignore_errors=True)
+        local_mapreduce.run('popular_tags_mapper', 'popular_tags_reducer',
+                            inputPath, outputDir, reducers=reducers)
+        data = b''
+        for part in sorted(glob.glob(os.path.join(outputDir, 'part-*'))):
+            with open(part, 'rb') as partFile:
+                data += partFile.read()
+        sys.stdin, sys.stdout = asStdin(data), asStdout()
+        try:
+            popular_tags_reducer.merge()
+        finally:
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+
+    try:
+        for reducers in (1, 4, 16):
+            report('toptags', '{0} reducers'.format(reducers),
+                   rowsPerSecond(lambda _: job(reducers), lines))
+    finally:
+        shutil.rmtree(workDir)
+
+
+def benchmarkApproximate(count):
+    """Exact tag counts vs. Space-Saving summaries, in popular tags.
+
+    Both variants run the mapper and the reducer over `sampleTaggedTsv()`,
+    with the mapper output sorted in between. The size is how many bytes the
+    mapper outputs, which is what is shuffled.
+    """
+    data = sampleTaggedTsv(count)
+    rows = [data] * count
+    sizes = {}
+
+    def job(mapperArgs, reducerArgs):
+        sys.stdin, sys.stdout = asStdin(data), asStdout()
+        try:
+            popular_tags_mapper.main(mapperArgs)
+            sys.stdout.flush()
+            mapped = sys.stdout.buffer.getvalue()
+            sizes[tuple(mapperArgs)] = len(mapped)
+            lines = sorted(mapped.split(b'\n')[:-1])
+            sys.stdin = asStdin(b''.join(line + b'\n' for line in lines))
+            sys.stdout = asStdout()
+            popular_tags_reducer.main(reducerArgs)
+        finally:
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+
+    variants = (('exact', [], []),
+                ('approximate 0.001', ['--approximate', '0.001'],
+                 ['--approximate']))
+    for name, mapperArgs, reducerArgs in variants:
+        report('approximate', name, rowsPerSecond(
+            lambda _: job(mapperArgs, reducerArgs), rows))
+        report('approximate', name + ' bytes', sizes[tuple(mapperArgs)])
+
+
+def benchmarkThreads(count):
+    """Memory taken by study_groups_reducer on a single, huge thread.
+
+    The thread has `count` posts by `count // 20` authors, with author ids
+    like the ones in forum_nodes.tsv. Variants are the reducer's default
+    mode, --unique and --unique with --max-authors 1000. Besides the
+    throughput, the peak memory allocated while reducing (as measured by
+    tracemalloc) is reported.
+    """
+    rng = random.Random(42)
+    authors = [str(100000 + rng.randrange(max(count // 20, 1)))
+               for _ in range(count)]
+    data = ''.join('1000\t{0}\t{1}\n'.format('A' if post == 0 else 'B', author)
+                   for post, author in enumerate(authors)).encode('utf-8')
+    rows = [data] * count
+
+    def run(function):
+        sys.stdin, sys.stdout = asStdin(data), asStdout()
+        try:
+            function()
+        finally:
+            sys.stdin, sys.stdout = sys.__stdin__, sys.__stdout__
+
+    variants = (('default', study_groups_reducer.reducer),
+                ('unique', study_groups_reducer.uniqueReducer),
+                ('unique, max 1000',
+                 lambda: study_groups_reducer.uniqueReducer(maxAuthors=1000)))
+    for name, function in variants:
+        report('threads', name, rowsPerSecond(lambda _: run(function), rows))
+        tracemalloc.start()
+        try:
+            run(function)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        report('threads', name + ' peak bytes', peak)
+
+
+BENCHMARKS = {
+    'approximate': benchmarkApproximate,
+    'dates': benchmarkDates,
+    'output': benchmarkOutput,
+    'projection': benchmarkProjection,
+    'reader': benchmarkReader,
+    'reducer': benchmarkReducer,
+    'records': benchmarkRecords,
+    'threads': benchmarkThreads,
+    'toptags': benchmarkTopTags,
+    'validator': benchmarkValidator,
+}
+
+
+def main(argv=None):
+    "Runs the benchmarks requested on the command line."
+    parser = argparse.ArgumentParser(description='Runs micro-benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='Benchmarks to run: {0}. Default: all.'.format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='How many rows each benchmark processes.')
+    args = parser.parse_args(argv)
+
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: {0}'.format(name))
+        BENCHMARKS[name](args.rows)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""End-to-end benchmarks of every mapper/reducer pair.
+
+Where benchmark.py times the hot paths of the code, this runs whole jobs, the
+way they run on a single machine: the mapper reads a forum_nodes.tsv, its
+output is sorted with shuffle.py and handed to the reducer. Each stage runs
+in its own process. For every job, the valid rows of input processed per
+second (see `countRows()`), the peak resident memory of its largest stage
+and the bytes output by the mapper and by the reducer are reported as
+tab-separated ``job, metric, value`` lines.
+
+The input is generated by `generate_nodes`, so that it can be as large as
+needed and is the same from one run to the next. Results can be saved as a
+baseline, and later runs are compared against it::
+
+    python benchmark_jobs.py --rows 500000 --save
+    # ... change something ...
+    python benchmark_jobs.py --rows 500000
+
+Metrics that got worse by more than ``--tolerance`` are flagged, and the
+exit status is then 1.
+
+.. module:: benchmark_jobs
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from common import readNodes
+from generate_nodes import addGeneratorArguments, generateNodes, \
+    generatorOptions
+
+# Where the scripts of the jobs are
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The mapper and reducer of each job
+JOBS = {
+    'average_length': ('average_length_mapper.py',
+                       'average_length_reducer.py'),
+    'fused': ('fused_mapper.py', 'fused_reducer.py'),
+    'popular_tags': ('popular_tags_mapper.py', 'popular_tags_reducer.py'),
+    'student_times': ('student_times_mapper.py', 'student_times_reducer.py'),
+    'study_groups': ('study_groups_mapper.py', 'study_groups_reducer.py'),
+}
+
+# The metrics reported, and whether larger values are better
+METRICS = (('rows/sec', True), ('peak RSS bytes', False),
+           ('map output bytes', False), ('output bytes', False))
+
+# How many times each job runs. We keep the fastest run.
+REPEAT = 3
+# How much worse than the baseline a metric can get before it is flagged
+TOLERANCE = 0.1
+# Where the baseline is saved to and read from, by default
+BASELINE = os.path.join(HERE, 'benchmark_baseline.json')
+
+
+def runStage(script, inputPath, outputPath):
+    """Runs a script in its own process, from one file to another.
+
+    :script: The script's file name, in HERE.
+    :inputPath: The file the script reads from standard input.
+    :outputPath: The file its standard output is written to.
+    :returns: A tuple with the seconds it took and its peak resident memory,
+              in bytes.
+    :raises subprocess.CalledProcessError: When the script fails.
+    """
+    command = [sys.executable, os.path.join(HERE, script)]
+    with open(inputPath, 'rb') as stdin, open(outputPath, 'wb') as stdout:
+        start = time.time()
+        process = subprocess.Popen(command, stdin=stdin, stdout=stdout)
+        # wait4() gives us the resource usage of this process alone
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+
+    process.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                          else -os.WTERMSIG(status))
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return elapsed, usage.ru_maxrss * scale
+
+
+def runJob(job, inputPath, rows, workDir):
+    """Runs a job once: map, sort, then reduce.
+
+    :job: One of JOBS.
+    :inputPath: The forum_nodes.tsv to process.
+    :rows: How many rows it has, for the throughput.
+    :workDir: Where the outputs of each stage are written to.
+    :returns: A dict with every one of METRICS.
+    """
+    mapper, reducer = JOBS[job]
+    mapOutput = os.path.join(workDir, job + '.map')
+    sortOutput = os.path.join(workDir, job + '.sorted')
+    output = os.path.join(workDir, job + '.out')
+
+    stages = [runStage(mapper, inputPath, mapOutput),
+              runStage('shuffle.py', mapOutput, sortOutput),
+              runStage(reducer, sortOutput, output)]
+    elapsed = sum(seconds for seconds, _ in stages)
+
+    return {
+        'rows/sec': rows / elapsed if elapsed else float('inf'),
+        'peak RSS bytes': max(peak for _, peak in stages),
+        'map output bytes': os.path.getsize(mapOutput),
+        'output bytes': os.path.getsize(output),
+    }
+
+
+def benchmarkJob(job, inputPath, rows, workDir, repeat=REPEAT):
+    """Runs a job `repeat` times.
+
+    :returns: The metrics of the fastest run. See `runJob()`.
+    """
+    runs = [runJob(job, inputPath, rows, workDir) for _ in range(repeat)]
+    return max(runs, key=lambda metrics: metrics['rows/sec'])
+
+
+def compare(metrics, baseline, tolerance=TOLERANCE):
+    """Compares the metrics of a job with its baseline.
+
+    :metrics: The metrics of the job, as `runJob()` returns them.
+    :baseline: The metrics of the job in the baseline.
+    :tolerance: How much worse (as a fraction) a metric can get.
+    :returns: A dict with, for each metric in both, a tuple with its relative
+              change and whether it got worse by more than the tolerance.
+    """
+    changes = {}
+    for name, largerIsBetter in METRICS:
+        if name not in metrics or not baseline.get(name):
+            continue
+        change = metrics[name] / baseline[name] - 1
+        worse = -change if largerIsBetter else change
+        changes[name] = change, worse > tolerance
+    return changes
+
+
+def report(job, name, value, change=None):
+    "Prints a metric, along with its change from the baseline, if any."
+    line = '{0}\t{1}\t{2:.0f}'.format(job, name, value)
+    if change is not None:
+        relative, regressed = change
+        line += '\t{0:+.1%}'.format(relative)
+        if regressed:
+            line += '\tREGRESSION'
+    print(line)
+
+
+def countRows(path):
+    """Counts the rows of a forum_nodes.tsv the jobs process.
+
+    Rows are parsed like the mappers parse them, so bodies that span many
+    lines count once, and the header and malformed lines don't count.
+    """
+    with open(path, encoding='utf-8') as stream:
+        return sum(1 for _ in readNodes(('id',), stream))
+
+
+def main(argv=None):
+    "Parses the command line, runs the benchmarks and compares the results."
+    parser = argparse.ArgumentParser(
+        description='Runs end-to-end benchmarks of the jobs.')
+    parser.add_argument('jobs', nargs='*', metavar='job',
+                        help='Jobs to run: {0}. Default: all.'.format(
+                            ', '.join(sorted(JOBS))))
+    addGeneratorArguments(parser)
+    parser.add_argument('--input',
+                        help='Process this forum_nodes.tsv instead of a '
+                        'generated one.')
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='How many times each job runs. The fastest run '
+                        'is kept.')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='The baseline to compare against. Default: '
+                        'benchmark_baseline.json, next to this script.')
+    parser.add_argument('--save', action='store_true',
+                        help='Save the results as the baseline instead.')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='How much worse than the baseline a metric can '
+                        'get, as a fraction. Default: 0.1.')
+    args = parser.parse_args(argv)
+
+    for job in args.jobs:
+        if job not in JOBS:
+            parser.error('Unknown job: {0}'.format(job))
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    # Results are only comparable when the input is the same
+    options = generatorOptions(parser, args)
+    source = ({'input': os.path.abspath(args.input)} if args.input
+              else {'generator': options})
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+        if baseline['source'] != source:
+            parser.error('{0} was saved with another input ({1}). Use the '
+                         'same options, or --save a new baseline.'.format(
+                             args.baseline, baseline['source']))
+
+    workDir = tempfile.mkdtemp(prefix='benchmark-jobs-')
+    try:
+        if args.input:
+            inputPath = args.input
+        else:
+            inputPath = os.path.join(workDir, 'forum_nodes.tsv')
+            with open(inputPath, 'w', encoding='utf-8') as stream:
+                stream.writelines(generateNodes(**options))
+        # Generated inputs have malformed rows too, which don't count
+        rows = countRows(inputPath)
+
+        results = {}
+        regressions = 0
+        for job in args.jobs or sorted(JOBS):
+            metrics = benchmarkJob(job, inputPath, rows, workDir,
+                                   args.repeat)
+            results[job] = metrics
+            changes = {}
+            if baseline is not None and job in baseline['jobs']:
+                changes = compare(metrics, baseline['jobs'][job],
+                                  args.tolerance)
+            for name, _ in METRICS:
+                report(job, name, metrics[name], changes.get(name))
+            regressions += sum(regressed for _, regressed in changes.values())
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.save:
+        with open(args.baseline, 'w') as stream:
+            json.dump({'source': source, 'jobs': results}, stream,
+                      indent=2, sort_keys=True)
+            stream.write('\n')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,28 @@ course.
 .. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
 """
 
+from __future__ import print_function
+
+import io
+import os
+import re
+import csv
+import sys
+import json
+import math
+import time
+import cProfile
+import pstats
+import contextlib
+import mmap
+import array
+import heapq
+import shutil
+import struct
+import tempfile
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+
 NODE_FIELDS = [
     "id",
     "title",
@@ -30,6 +52,64 @@ NODE_FIELDS = [
     "marked"
 ]
 
+# Where each field lives in a line, so that lookups don't have to scan
+# NODE_FIELDS over and over again.
+FIELD_INDEX = dict((name, index) for index, name in enumerate(NODE_FIELDS))
+
+# Things isValidNodeLine needs for every single line. {{{
+NUM_NODE_FIELDS = len(NODE_FIELDS)
+ID_INDEX = FIELD_INDEX['id']
+HEADER_ID = NODE_FIELDS[ID_INDEX]
+BODY_INDEX = FIELD_INDEX['body']
+# Why validateNodeLine can reject a line
+REJECTIONS = ('short', 'long', 'header', 'non-numeric id')
+# }}}
+
+# How many bytes readLines reads from its input at once
+READ_BLOCK_SIZE = 1 << 20
+# How sys.stdin splits lines, as the newline argument of io.TextIOWrapper:
+# universal newlines on Windows, only "\n" everywhere else. readLines splits
+# the same way by default, so that nodes are read just as they always were.
+STDIN_NEWLINE = None if os.name == 'nt' else '\n'
+# How many bytes of a memory-mapped input are read before the pages they
+# take are given back. See `_MappedRange`.
+RELEASE_SIZE = 1 << 20
+# How many bytes RecordWriter buffers before writing them
+OUTPUT_BUFFER_SIZE = 1 << 16
+# How many functions a profile printed by `instrumented()` shows
+PROFILE_LINES = 25
+# Roughly how many centroids a TDigest keeps, and how many times as many
+# values it buffers before merging them into the centroids
+TDIGEST_COMPRESSION = 100
+TDIGEST_BUFFER = 5
+# How many bins each power of 10 is split in by a JointHistogram
+HISTOGRAM_BINS_PER_DECADE = 20
+
+# The node cache (see `writeCache()`). {{{
+# Columns the cache keeps, besides BODY_LENGTH: every field the mappers use,
+# except for the bodies, which are what makes forum_nodes.tsv so big.
+CACHE_FIELDS = ('id', 'author_id', 'node_type', 'abs_parent_id', 'added_at',
+                'tagnames')
+# Not a node field: the length of the body, which is all mappers need of it
+BODY_LENGTH = 'body_length'
+# Bump when the layout of the files changes, so that old caches are rebuilt
+CACHE_VERSION = 1
+CACHE_META = 'meta.json'
+# How many rows the cache reader decodes at once
+CACHE_CHUNK_ROWS = 8192
+# }}}
+
+# The Stats of the current run, when it is instrumented. See `instrumented()`.
+_stats = None
+
+# Where records start in a file with quoted fields, like forum_nodes.tsv: at
+# the beginning of a line with a quoted numeric id. Inside a quoted field
+# quotes are doubled, so no line in the middle of a multi-line body can look
+# like that. Files without quotes can't have multi-line fields, so there any
+# line starts a record.
+QUOTED_RECORD_START = re.compile(br'\n(?="\d+"\t)')
+RECORD_START = re.compile(br'\n')
+
 
 def getFieldNumber(fieldName):
     """Given a node field's name, returns its index in which it would appear.
@@ -38,10 +118,7 @@ def getFieldNumber(fieldName):
     :returns: The field's index when found, -1 otherwise.
 
     """
-    try:
-        return NODE_FIELDS.index(fieldName)
-    except ValueError:
-        return -1
+    return FIELD_INDEX.get(fieldName, -1)
 
 
 def getField(line, fieldName):
@@ -58,24 +135,1743 @@ def getField(line, fieldName):
     return line[index]
 
 
+def compileProjection(fieldNames):
+    """Builds a function that extracts many fields from a line in one go.
+
+    This is what mappers should use in their inner loops: field names are
+    resolved only once, when the projection is built, and every call after
+    that is a single `operator.itemgetter` call.
+
+    :fieldNames: A sequence with the names of the fields we want.
+    :returns: A function that, given a line, returns a tuple with the values
+              of the requested fields, in the order they were requested.
+    :raises ValueError: If any of the field names is not a node field.
+    """
+    indices = []
+    for fieldName in fieldNames:
+        index = getFieldNumber(fieldName)
+        if index < 0:
+            raise ValueError('Unknown node field: {0}'.format(fieldName))
+        indices.append(index)
+
+    if len(indices) == 1:
+        # itemgetter with a single index returns the bare value, not a tuple
+        getter = itemgetter(indices[0])
+        return lambda line: (getter(line),)
+
+    return itemgetter(*indices)
+
+
 def isValidNodeLine(line):
     """Does basic sanity-checking on a line from the forum node "table".
 
     :line: The line to be tested.
     :returns: True if it looks like the line is good. False otherwise.
     """
+    return validateNodeLine(line) is None
+
+
+def validateNodeLine(line, header=True):
+    """Tells why a line from the forum node "table" is invalid, if it is.
+
+    :line: The fields of the line.
+    :header: Whether the line may be the file's header. Only the first line
+             of the file can be, so readers pass False after it, and a line
+             that looks like the header anywhere else is counted as corrupt.
+    :returns: None if the line looks good. Otherwise, one of REJECTIONS.
+    """
 
     # The line must have the same number of fields that we're expecting
-    if len(line) != len(NODE_FIELDS):
-        return False
+    count = len(line)
+    if count != NUM_NODE_FIELDS:
+        return 'short' if count < NUM_NODE_FIELDS else 'long'
+
+    # Most ids are fine, so we check them right here
+    nodeId = line[ID_INDEX]
+    if nodeId.isdecimal():
+        return None
+    return validateNodeId(nodeId, header)
+
+
+def validateNodeId(nodeId, header=True):
+    """Tells why a node id is invalid, if it is. See `validateNodeLine()`.
+
+    Ids are checked with str.isdecimal(), which is several times faster than
+    int(). Only ids that fail that check go through int(), which also takes
+    signs and surrounding blanks, so exactly the same ids are accepted.
+
+    :nodeId: The id field of a line.
+    :header: Whether the line may be the file's header.
+    :returns: None if the id is numeric. Otherwise, "header" or
+              "non-numeric id".
+    """
+    if nodeId.isdecimal():
+        return None
 
     try:
-        # If "id" is not numeric, this line is probably the file's header,
-        # or the data is corrupt.
-        int(getField(line, 'id'))
+        int(nodeId)
     except ValueError:
-        # Either way, we don't want it
+        # If "id" is not numeric, this line is probably the file's header,
+        # or the data is corrupt. Either way, we don't want it.
+        if header and nodeId == HEADER_ID:
+            return 'header'
+        return 'non-numeric id'
+
+    return None
+
+
+def readLines(stream, blockSize=READ_BLOCK_SIZE, newline=STDIN_NEWLINE):
+    """Reads the lines of a text stream in large blocks.
+
+    When the stream is backed by a binary buffer (as sys.stdin is), it is read
+    in blocks of `blockSize` bytes and each block is decoded at once, which is
+    much cheaper than decoding it line by line. Any other stream is simply
+    iterated over.
+
+    :stream: The stream to be read.
+    :blockSize: How many bytes to read at a time.
+    :newline: How lines end in the blocks, like io.TextIOWrapper takes it.
+              None translates "\\r\\n" and lone "\\r" to "\\n" (universal
+              newlines); "\\n" leaves carriage returns in the lines.
+    :returns: A generator of lines, *without* their trailing newlines.
+    """
+    raw = getattr(stream, 'buffer', None)
+    if raw is None:
+        for line in stream:
+            yield line[:-1] if line.endswith('\n') else line
+        return
+
+    if newline not in (None, '\n'):
+        raise ValueError('Unsupported newline: {0!r}'.format(newline))
+    translate = _translateNewlines if newline is None else _keepNewlines
+    encoding = getattr(stream, 'encoding', None) or 'utf-8'
+    pending = b''
+    while True:
+        block = raw.read(blockSize)
+        if not block:
+            break
+
+        # We only decode up to the last newline in the block. Whatever is
+        # after it is an incomplete line (and maybe an incomplete character).
+        block = pending + block
+        end = block.rfind(b'\n') + 1
+        pending = block[end:]
+        if end == 0:
+            continue
+
+        lines = translate(block[:end].decode(encoding)).split('\n')
+        # The text ends with a newline, so the last element is always empty
+        lines.pop()
+        for line in lines:
+            yield line
+
+    # The last line of the stream doesn't always end in a newline
+    if pending:
+        lines = translate(pending.decode(encoding)).split('\n')
+        # Unless it ends in a lone "\r", and that is a newline too
+        if not lines[-1]:
+            lines.pop()
+        for line in lines:
+            yield line
+
+
+def _translateNewlines(text):
+    "Translates newlines like a TextIOWrapper with newline=None does."
+    if '\r' not in text:
+        return text
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _keepNewlines(text):
+    "Leaves newlines alone, like a TextIOWrapper with newline='\\n' does."
+    return text
+
+
+class _LineFeeder(object):
+    """Iterator that feeds csv.reader with lines taken from another iterator.
+
+    readNodes only hands lines to the csv parser when it can't split them by
+    itself. The feeder gets that line "pushed back" and then keeps taking
+    lines from the same iterator readNodes uses, so that records spanning
+    multiple lines are put back together correctly.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.pushed = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.pushed
+        if line is None:
+            line = next(self.lines)
+        else:
+            self.pushed = None
+        # The csv parser relies on newlines to join multi-line fields
+        return line + '\n'
+
+    def push(self, line):
+        "Makes `line` the next line to be returned."
+        self.pushed = line
+
+
+def readNodes(fieldNames, stream=None, newline=STDIN_NEWLINE):
+    """Reads the forum node "table", returning only the fields requested.
+
+    Most lines in forum_nodes.tsv have every field quoted and no quotes, tabs
+    or newlines inside the fields. These lines are split directly, and only
+    up to the last field we're interested in. Anything else goes through
+    csv.reader, so the results are exactly the ones we'd get by parsing the
+    whole input with it.
+
+    When BODY_LENGTH is requested, the body is replaced by its length in the
+    split line itself, before the fields are projected, so its text is
+    dropped right away. That's the length in characters, as before, so a
+    "\\N" (null) body has a length of 2.
+
+    :fieldNames: A sequence with the names of the fields we want. BODY_LENGTH
+                 can be used instead of "body" when only its length matters.
+    :stream: The stream to read from. Defaults to sys.stdin.
+    :newline: How lines end in the stream. See `readLines()`.
+    :returns: A generator of tuples with the values of the requested fields
+              of every valid line, in the order they were requested.
+    """
+    if stream is None:
+        stream = sys.stdin
+
+    fieldNames = list(fieldNames)
+    lengthIndex = None
+    if BODY_LENGTH in fieldNames:
+        lengthIndex = fieldNames.index(BODY_LENGTH)
+        fieldNames[lengthIndex] = 'body'
+    # Bodies are measured in the line, unless their text is wanted as well
+    measure = lengthIndex is not None and fieldNames.count('body') == 1
+
+    project = compileProjection(fieldNames)
+    # We need the id for validating lines, so we always split at least up to
+    # it. Everything after the last field we want is left unsplit.
+    maxsplit = 1 + max([ID_INDEX] +
+                       [FIELD_INDEX[name] for name in fieldNames])
+
+    separators = NUM_NODE_FIELDS - 1
+    quotes = 2 * NUM_NODE_FIELDS
+
+    lines = readLines(stream, newline=newline)
+    feeder = _LineFeeder(lines)
+    reader = csv.reader(feeder, delimiter='\t')
+
+    # Only the first line can be the header
+    header = True
+    for line in lines:
+        fields = None
+        if line.startswith('"'):
+            # When every quote in the line is either at one of its ends or
+            # around a separator, all fields are quoted and none of them has
+            # quotes inside it. Splitting on the quotes around the separators
+            # is then unambiguous, even if there are tabs inside the fields.
+            if (line.count('"') == quotes and
+                    line.endswith('"') and
+                    line.count('"\t"') == separators):
+                fields = line[1:-1].split('"\t"', maxsplit)
+        elif (line.count('\t') == separators and
+              '"' not in line and '\r' not in line):
+            fields = line.split('\t', maxsplit)
+
+        if fields is None:
+            # The slow path. The csv parser will take care of this line (and
+            # of the ones after it, if the record spans many lines).
+            feeder.push(line)
+            fields = next(reader)
+            rejection = validateNodeLine(fields, header)
+        elif fields[ID_INDEX].isdecimal():
+            # The field count is right, or the line wouldn't have been split
+            rejection = None
+        else:
+            rejection = validateNodeId(fields[ID_INDEX], header)
+        header = False
+
+        if rejection is not None:
+            drop(rejection)
+            continue
+
+        if measure:
+            fields[BODY_INDEX] = len(fields[BODY_INDEX])
+        elif lengthIndex is not None:
+            row = project(fields)
+            yield (row[:lengthIndex] + (len(row[lengthIndex]),) +
+                   row[lengthIndex + 1:])
+            continue
+        yield project(fields)
+
+
+def findRecordStart(fileObject, offset, pattern):
+    """Finds where the first record starting at or after an offset is.
+
+    :fileObject: The file, opened in binary mode.
+    :offset: Where to start looking from.
+    :pattern: The regular expression that matches a newline starting a record.
+              See `QUOTED_RECORD_START`.
+    :returns: The offset of the record, or the file size if there is none.
+    """
+    if offset == 0:
+        return 0
+
+    # We start one byte earlier, so that a record starting right at `offset`
+    # is found as well. `position` is the offset of data[0].
+    position = offset - 1
+    fileObject.seek(position)
+    data = b''
+    while True:
+        block = fileObject.read(READ_BLOCK_SIZE)
+        if not block:
+            return position + len(data)
+
+        data += block
+        match = pattern.search(data)
+        if match is not None:
+            return position + match.start() + 1
+
+        # The last newline may start a record we can't see entirely yet, so
+        # we keep it for the next search.
+        last = data.rfind(b'\n')
+        if last < 0:
+            last = len(data)
+        position += last
+        data = data[last:]
+
+
+def splitRanges(path, count):
+    """Splits a forum node file in byte ranges, aligned to record boundaries.
+
+    :path: The file's path.
+    :count: How many ranges we want. Fewer are returned for small files.
+    :returns: A list of (start, end) offsets. Every record in the file starts
+              in exactly one of the ranges.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fileObject:
+        quoted = fileObject.read(1) == b'"'
+        pattern = QUOTED_RECORD_START if quoted else RECORD_START
+
+        boundaries = [0]
+        for i in range(1, count):
+            offset = max(boundaries[-1], size * i // count)
+            boundaries.append(findRecordStart(fileObject, offset, pattern))
+        boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+class _ByteRange(io.RawIOBase):
+    "Raw stream over a range of bytes of a file. See `openRange()`."
+
+    def __init__(self, path, start, end):
+        io.RawIOBase.__init__(self)
+        # Unbuffered, so that bytes are read straight into the caller's buffer
+        self.fileObject = open(path, 'rb', buffering=0)
+        self.fileObject.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        with memoryview(buffer) as view:
+            read = self.fileObject.readinto(view[:size])
+        self.remaining -= read
+        return read
+
+    def close(self):
+        self.fileObject.close()
+        io.RawIOBase.close(self)
+
+
+class _MappedRange(io.RawIOBase):
+    """Raw stream over a range of bytes of a memory-mapped file. See
+    `openRange()`.
+
+    Bytes are copied straight from the mapping into the reader's buffer, and
+    the pages already read are given back to the kernel as the reading goes,
+    so that a whole file can be read with a resident memory of about a block.
+    """
+
+    def __init__(self, path, start, end):
+        io.RawIOBase.__init__(self)
+        with open(path, 'rb') as fileObject:
+            self.mapping = mmap.mmap(fileObject.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        # Let the kernel read ahead aggressively
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mapping.madvise(mmap.MADV_SEQUENTIAL)
+        self.position = start
+        self.end = end
+        # Pages before this offset were already given back
+        self.released = start - start % mmap.PAGESIZE
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.position)
+        if size <= 0:
+            return 0
+        with memoryview(self.mapping) as view:
+            buffer[:size] = view[self.position:self.position + size]
+        self.position += size
+        self._release()
+        return size
+
+    def _release(self):
+        "Gives back the pages that were read in full."
+        if not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        end = self.position - self.position % mmap.PAGESIZE
+        if end - self.released >= RELEASE_SIZE:
+            self.mapping.madvise(mmap.MADV_DONTNEED, self.released,
+                                 end - self.released)
+            self.released = end
+
+    def close(self):
+        self.mapping.close()
+        io.RawIOBase.close(self)
+
+
+def openRange(path, start, end, encoding='utf-8'):
+    """Opens a range of bytes of a file as a text stream.
+
+    The stream can stand in for sys.stdin: it can be read by readNodes as if
+    the range were the whole input. The file is memory-mapped, unless the
+    range is empty or the file can't be mapped.
+
+    :path: The file's path.
+    :start: Offset of the first byte to read.
+    :end: Offset right after the last byte to read.
+    :encoding: The file's encoding.
+    :returns: A text stream.
+    """
+    raw = None
+    if end > start:
+        try:
+            raw = _MappedRange(path, start, end)
+        except (OSError, ValueError):
+            # Not a regular file, most likely
+            raw = None
+    if raw is None:
+        raw = _ByteRange(path, start, end)
+    # Lines end like they do in sys.stdin, which the stream stands in for
+    return io.TextIOWrapper(io.BufferedReader(raw), encoding=encoding,
+                            newline=STDIN_NEWLINE)
+
+
+def _mapRange(job):
+    """Runs a mapper over a range of a file. See `mapFile()`.
+
+    :job: A tuple with: the path of the file, the byte range to read, where
+          to write the output, the mapper function and its arguments.
+    :returns: What `Stats.asDict()` returns, if the run is instrumented. Its
+              "total" timer covers this range only.
+    """
+    global _stats
+    path, start, end, outputPath, mapper, args, kwargs = job
+    if _stats is not None:
+        # Inherited from the parent process: count this range only
+        _stats = Stats(_stats.group)
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin = openRange(path, start, end)
+    sys.stdout = open(outputPath, 'w', encoding='utf-8')
+    begin = time.perf_counter()
+    try:
+        mapper(*args, **kwargs)
+    finally:
+        sys.stdin.close()
+        sys.stdout.close()
+        sys.stdin, sys.stdout = stdin, stdout
+    if _stats is None:
+        return None
+    _stats.time('total', time.perf_counter() - begin)
+    return _stats.asDict()
+
+
+def mapFile(path, workers, mapper, *args, **kwargs):
+    """Runs a mapper over a forum node file, using many processes.
+
+    The file is split with `splitRanges()` and each range is handed to a
+    mapper running in a pool of `workers` processes, with the range as its
+    sys.stdin. Their outputs are then written to sys.stdout, in the order of
+    the ranges. For mappers that output a record per node, that's exactly
+    what a single mapper would output; mappers that combine their records
+    output one partial result per range, which their reducers merge anyway.
+
+    :path: The file's path.
+    :workers: How many processes to use. None means one per CPU.
+    :mapper: The mapper function. It reads sys.stdin and writes to
+             sys.stdout, as all our mappers do.
+    :args: Positional arguments for the mapper.
+    :kwargs: Keyword arguments for the mapper.
+    :returns: Nothing. Writes to standard output. If the run is instrumented,
+              the counters and timers of every process are added up, their
+              "total" timers included, so that the stages still add up to
+              the total. The wall clock time of the run is then reported
+              apart, as "wall". See `instrumented()`.
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = splitRanges(path, workers)
+
+    if len(ranges) <= 1:
+        stdin = sys.stdin
+        sys.stdin = openRange(path, 0, os.path.getsize(path))
+        try:
+            mapper(*args, **kwargs)
+        finally:
+            sys.stdin.close()
+            sys.stdin = stdin
+        return
+
+    workDir = tempfile.mkdtemp(prefix='map-')
+    try:
+        jobs = [(path, start, end,
+                 os.path.join(workDir, 'part-{0:05d}'.format(task)),
+                 mapper, args, kwargs)
+                for task, (start, end) in enumerate(ranges)]
+        # Workers may be forked: anything still buffered would be output
+        # once per process
+        sys.stdout.flush()
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            for stats in pool.map(_mapRange, jobs):
+                if stats is not None and _stats is not None:
+                    _stats.merge(stats)
+
+        output = getattr(sys.stdout, 'buffer', None)
+        for job in jobs:
+            if output is None:
+                with open(job[3], encoding='utf-8') as part:
+                    shutil.copyfileobj(part, sys.stdout)
+            else:
+                with open(job[3], 'rb') as part:
+                    shutil.copyfileobj(part, output)
+        sys.stdout.flush()
+    finally:
+        shutil.rmtree(workDir)
+
+
+def _cacheFiles(cacheDir, column):
+    "Returns the paths of the offsets (or values) and data files of a column."
+    base = os.path.join(cacheDir, column)
+    return base + '.offsets', base + '.data'
+
+
+def writeCache(source, cacheDir):
+    """Parses forum_nodes.tsv once and saves its columns to a cache.
+
+    Each column in CACHE_FIELDS is saved as two files: one with the UTF-8
+    encoded values, one after the other, and another one with the offset of
+    each value in the first file (plus the offset of the end), as 64-bit
+    integers. BODY_LENGTH is saved as 64-bit integers as well. Only valid rows
+    are saved, just as `readNodes()` returns them. A JSON file describes the
+    cache and the file it came from, so that `isCacheFresh()` can tell when it
+    is out of date.
+
+    :source: The path of forum_nodes.tsv.
+    :cacheDir: Where to save the cache. Created if it doesn't exist.
+    :returns: How many rows were saved.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    status = os.stat(source)
+
+    # The cache is stale while it is being written
+    metaPath = os.path.join(cacheDir, CACHE_META)
+    if os.path.exists(metaPath):
+        os.remove(metaPath)
+
+    offsets = [array.array('q', [0]) for _ in CACHE_FIELDS]
+    lengths = array.array('q')
+    ascii = [True] * len(CACHE_FIELDS)
+    files = [open(_cacheFiles(cacheDir, name)[1], 'wb')
+             for name in CACHE_FIELDS]
+    try:
+        with open(source, encoding='utf-8', newline='') as stream:
+            for row in readNodes(CACHE_FIELDS + (BODY_LENGTH,), stream):
+                for column, value in enumerate(row[:-1]):
+                    data = value.encode('utf-8')
+                    files[column].write(data)
+                    offsets[column].append(offsets[column][-1] + len(data))
+                    if ascii[column] and len(data) != len(value):
+                        ascii[column] = False
+                lengths.append(row[-1])
+    finally:
+        for data in files:
+            data.close()
+
+    for name, columnOffsets in zip(CACHE_FIELDS, offsets):
+        with open(_cacheFiles(cacheDir, name)[0], 'wb') as output:
+            columnOffsets.tofile(output)
+    with open(_cacheFiles(cacheDir, BODY_LENGTH)[0], 'wb') as output:
+        lengths.tofile(output)
+
+    meta = {
+        'version': CACHE_VERSION,
+        'byteorder': sys.byteorder,
+        'source': os.path.abspath(source),
+        'size': status.st_size,
+        'mtime': status.st_mtime_ns,
+        'rows': len(lengths),
+        'ascii': dict(zip(CACHE_FIELDS, ascii)),
+    }
+    with open(metaPath, 'w') as output:
+        json.dump(meta, output, indent=2, sort_keys=True)
+    return len(lengths)
+
+
+def readCacheMeta(cacheDir):
+    """Returns the description of a cache, or None if there is no cache."""
+    try:
+        with open(os.path.join(cacheDir, CACHE_META)) as meta:
+            return json.load(meta)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def isCacheFresh(cacheDir):
+    """Tells whether a cache can be used instead of parsing its source.
+
+    A cache is fresh when it is complete, was written in the current format
+    and its source file still has the size and modification time it had when
+    the cache was written.
+
+    :cacheDir: The cache.
+    :returns: True if the cache is fresh.
+    """
+    meta = readCacheMeta(cacheDir)
+    if (meta is None or meta.get('version') != CACHE_VERSION or
+            meta.get('byteorder') != sys.byteorder):
+        return False
+    try:
+        status = os.stat(meta['source'])
+    except OSError:
         return False
+    return (status.st_size == meta['size'] and
+            status.st_mtime_ns == meta['mtime'])
+
+
+def isCacheOf(cacheDir, stream):
+    """Tells whether a cache is fresh and was built from what a stream reads.
+
+    The stream must read a file (as sys.stdin does when redirected from
+    one), and that file must be the source the cache recorded, with the same
+    size and modification time. Anything else, like a pipe, can't be told
+    apart from another input.
+
+    :cacheDir: The cache.
+    :stream: The stream the mapper would otherwise parse.
+    :returns: True if the cache can be read instead of the stream.
+    """
+    if not isCacheFresh(cacheDir):
+        return False
+    meta = readCacheMeta(cacheDir)
+    try:
+        status = os.fstat(stream.fileno())
+        source = os.stat(meta['source'])
+    except (AttributeError, OSError, ValueError):
+        # No file behind the stream (io.UnsupportedOperation is an OSError)
+        return False
+    return (os.path.samestat(status, source) and
+            status.st_size == meta['size'] and
+            status.st_mtime_ns == meta['mtime'])
+
+
+class _CacheColumn(object):
+    "A memory-mapped column of the cache."
+
+    def __init__(self, cacheDir, name, ascii=True):
+        """Opens a column.
+
+        :cacheDir: The cache.
+        :name: A name in CACHE_FIELDS, or BODY_LENGTH.
+        :ascii: Whether every value of the column is ASCII, so that it can be
+                decoded a chunk at a time.
+        """
+        offsetsPath, dataPath = _cacheFiles(cacheDir, name)
+        self.ascii = ascii
+        self.maps = []
+        self.offsets = self._map(offsetsPath).cast('q')
+        self.data = self._map(dataPath) if name != BODY_LENGTH else None
+
+    def _map(self, path):
+        "Maps a file into memory, read-only, returning a memoryview."
+        with open(path, 'rb') as data:
+            if not os.fstat(data.fileno()).st_size:
+                # Empty files can't be mapped
+                return memoryview(b'')
+            mapped = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return memoryview(mapped)
+
+    def read(self, start, stop):
+        """Returns the values of rows [start, stop) as a list."""
+        if self.data is None:
+            return self.offsets[start:stop].tolist()
+
+        offsets = self.offsets[start:stop + 1].tolist()
+        base = offsets[0]
+        data = self.data[base:offsets[-1]]
+        if self.ascii:
+            # One decode for the whole chunk: characters are bytes here
+            text = str(data, 'ascii')
+            return [text[begin - base:end - base]
+                    for begin, end in zip(offsets, offsets[1:])]
+        return [str(data[begin - base:end - base], 'utf-8')
+                for begin, end in zip(offsets, offsets[1:])]
+
+    def close(self):
+        "Unmaps the column."
+        self.offsets.release()
+        if self.data is not None:
+            self.data.release()
+        for mapped in self.maps:
+            mapped.close()
+
+
+def readCache(fieldNames, cacheDir, chunkRows=CACHE_CHUNK_ROWS):
+    """Reads the forum node "table" from a cache, like `readNodes()` does.
+
+    Nothing is parsed: values are sliced out of memory-mapped columns, a
+    chunk of rows at a time. The cache is not checked for freshness here. See
+    `isCacheFresh()` and `loadNodes()`.
+
+    :fieldNames: A sequence with the names of the fields we want. Only
+                 CACHE_FIELDS and BODY_LENGTH are available.
+    :cacheDir: The cache. See `writeCache()`.
+    :chunkRows: How many rows to decode at once.
+    :returns: A generator of tuples with the values of the requested fields
+              of every row, in the order they were requested.
+    :raises ValueError: If a field is not in the cache.
+    """
+    for fieldName in fieldNames:
+        if fieldName not in CACHE_FIELDS and fieldName != BODY_LENGTH:
+            raise ValueError('Field not in the cache: {0}'.format(fieldName))
+
+    meta = readCacheMeta(cacheDir)
+    columns = [_CacheColumn(cacheDir, name, meta['ascii'].get(name, True))
+               for name in fieldNames]
+    try:
+        for start in range(0, meta['rows'], chunkRows):
+            stop = min(start + chunkRows, meta['rows'])
+            for row in zip(*[column.read(start, stop)
+                             for column in columns]):
+                yield row
+    finally:
+        for column in columns:
+            column.close()
+
+
+def loadNodes(fieldNames, cacheDir=None, stream=None):
+    """Reads the forum node "table" from a cache if it's fresh and was built
+    from the input (see `isCacheOf()`), or else parses it with `readNodes()`.
+
+    :fieldNames: A sequence with the names of the fields we want. BODY_LENGTH
+                 can be used instead of "body" when only its length matters,
+                 which is what makes the cache usable.
+    :cacheDir: The cache, if any. See `writeCache()`.
+    :stream: The stream to parse if the cache can't be used. Defaults to
+             sys.stdin.
+    :returns: A generator of tuples, as `readNodes()` does.
+    """
+    if stream is None:
+        stream = sys.stdin
+    if cacheDir is not None:
+        if not isCacheFresh(cacheDir):
+            sys.stderr.write('Cache {0} is missing or stale. Parsing the '
+                             'input instead.\n'.format(cacheDir))
+        elif not isCacheOf(cacheDir, stream):
+            sys.stderr.write('Cache {0} was not built from the input (or the '
+                             'input is not a file). Parsing the input '
+                             'instead.\n'.format(cacheDir))
+        else:
+            return timed(readCache(fieldNames, cacheDir), 'read cache')
+
+    return timed(readNodes(fieldNames, stream), 'parse')
+
+
+class RecordCodec(object):
+    """Compact binary framing for records passed from mappers to reducers.
+
+    Each job declares the layouts of its records as strings of `struct` type
+    codes, plus "n" for node ids: strings holding a number that are sent as an
+    unsigned 32-bit integer but come back as the very same string. A "c" comes
+    back as a one-character string as well.
+
+    A frame is a byte with the size of the packed record, followed by it. The
+    size also tells which layout was used, so layouts must have different
+    sizes (and different numbers of fields, which is how `encode()` picks
+    one). Records that don't fit their layout, like ids that aren't numbers,
+    are sent as text instead: a zero byte, the length of the text as an
+    unsigned 32-bit integer and the tab-separated fields in UTF-8.
+
+    Decoded records are tuples, with the same values (and types) whatever
+    their framing, so they can be sorted and grouped just like text lines.
+    Hadoop Streaming only handles text, so this is for local runs only.
+    """
+
+    TEXT_HEADER = struct.Struct('>BI')
+
+    def __init__(self, *layouts):
+        """Creates a codec.
+
+        :layouts: The record layouts, like "nB" for a node id and a byte.
+        """
+        self.layouts = layouts
+        self.byArity = {}
+        self.bySize = {}
+        for layout in layouts:
+            # Frames are packed with their size byte, so that runs of frames
+            # of the same layout can be unpacked at once.
+            framer = struct.Struct('>B' + layout.replace('n', 'I'))
+            size = framer.size - 1
+            if size in self.bySize or len(layout) in self.byArity:
+                raise ValueError('Ambiguous record layout: ' + layout)
+            encoders = [_ENCODERS.get(code, int) for code in layout]
+            # Fields that change type after being unpacked: (index, function)
+            decoders = [(index, _DECODERS[code])
+                        for index, code in enumerate(layout)
+                        if code in _DECODERS]
+            # How fields sent as text are converted. None keeps the string.
+            parsers = [None if code in _DECODERS else int for code in layout]
+            self.byArity[len(layout)] = (size, framer, encoders, parsers)
+            self.bySize[size] = (framer, decoders)
+
+    def __reduce__(self):
+        "Structs can't be pickled, so codecs are pickled as their layouts."
+        return (RecordCodec, self.layouts)
+
+    def encode(self, fields):
+        """Encodes a record into a frame.
+
+        :fields: The record's fields.
+        :returns: The frame, as bytes.
+        :raises KeyError: If no layout has as many fields as the record.
+        """
+        size, framer, encoders, _ = self.byArity[len(fields)]
+        try:
+            return framer.pack(size, *[encode(field) for encode, field
+                                       in zip(encoders, fields)])
+        except (ValueError, UnicodeError, struct.error):
+            text = '\t'.join(str(field) for field in fields).encode('utf-8')
+            return self.TEXT_HEADER.pack(0, len(text)) + text
+
+    def decode(self, frame, offset=0):
+        """Decodes the frame that starts at an offset of a buffer.
+
+        :frame: A buffer with the frame.
+        :offset: Where the frame starts.
+        :returns: The record, as a tuple.
+        """
+        size = frame[offset]
+        if size:
+            framer, decoders = self.bySize[size]
+            return self._finish(framer.unpack_from(frame, offset), decoders)
+
+        _, length = self.TEXT_HEADER.unpack_from(frame, offset)
+        start = offset + self.TEXT_HEADER.size
+        fields = bytes(frame[start:start + length]).decode('utf-8').split('\t')
+        parsers = self.byArity[len(fields)][3]
+        return tuple(field if parse is None else parse(field)
+                     for parse, field in zip(parsers, fields))
+
+    @staticmethod
+    def _finish(values, decoders):
+        "Turns unpacked values (size byte included) into a record."
+        if not decoders:
+            return values[1:]
+        record = list(values[1:])
+        for index, decode in decoders:
+            record[index] = decode(record[index])
+        return tuple(record)
+
+    def frameSize(self, data, offset):
+        """Returns the size of the frame at an offset of a buffer.
+
+        :returns: The size, headers included, or None if the buffer doesn't
+                  have enough bytes to tell.
+        """
+        if offset >= len(data):
+            return None
+        size = data[offset]
+        if size:
+            return 1 + size
+        if offset + self.TEXT_HEADER.size > len(data):
+            return None
+        return self.TEXT_HEADER.size + \
+            self.TEXT_HEADER.unpack_from(data, offset)[1]
+
+    def readFrames(self, stream, blockSize=READ_BLOCK_SIZE):
+        """Reads the frames of a binary stream.
+
+        :stream: The stream. Text streams backed by a binary buffer, like
+                 sys.stdin, are read through that buffer.
+        :blockSize: How many bytes to read at a time.
+        :returns: A generator of frames, as bytes.
+        """
+        stream = getattr(stream, 'buffer', stream)
+        data = b''
+        while True:
+            block = stream.read(blockSize)
+            if not block:
+                break
+            data += block
+            offset = 0
+            while True:
+                size = self.frameSize(data, offset)
+                if size is None or offset + size > len(data):
+                    break
+                yield data[offset:offset + size]
+                offset += size
+            data = data[offset:]
+
+    def readRecords(self, stream, blockSize=READ_BLOCK_SIZE):
+        """Reads the records of a binary stream.
+
+        :stream: The stream, as in `readFrames()`. An iterable of frames
+                 works as well.
+        :blockSize: How many bytes to read at a time.
+        :returns: A generator of records, as tuples.
+        """
+        if not hasattr(stream, 'read') and not hasattr(stream, 'buffer'):
+            for frame in stream:
+                yield self.decode(frame)
+            return
+
+        stream = getattr(stream, 'buffer', stream)
+        data = b''
+        while True:
+            block = stream.read(blockSize)
+            if not block:
+                break
+            data += block
+            records, offset = self._decodeFrames(data)
+            for record in records:
+                yield record
+            data = data[offset:]
+
+    def _decodeFrames(self, data):
+        """Decodes the whole frames in a buffer.
+
+        :data: The buffer.
+        :returns: A tuple with a list of records and the offset of the first
+                  frame that is not whole.
+        """
+        records = []
+        view = memoryview(data)
+        offset = 0
+        while True:
+            frameSize = self.frameSize(data, offset)
+            if frameSize is None or offset + frameSize > len(data):
+                break
+            size = data[offset]
+            if not size:
+                records.append(self.decode(data, offset))
+                offset += frameSize
+                continue
+
+            # Frames of the same layout are unpacked at once, up to the first
+            # frame whose first byte isn't the same size, which must be a
+            # frame of another layout. Every loop here is done in C.
+            stop = offset + (len(data) - offset) // frameSize * frameSize
+            sizes = data[offset:stop:frameSize]
+            count = len(sizes) - len(sizes.lstrip(sizes[:1]))
+            end = offset + count * frameSize
+            framer, decoders = self.bySize[size]
+            columns = list(zip(*framer.iter_unpack(view[offset:end])))[1:]
+            for index, decode in decoders:
+                columns[index] = map(decode, columns[index])
+            records.extend(zip(*columns))
+            offset = end
+        view.release()
+        return records, offset
+
+
+def _encodeId(field):
+    "Converts a node id to an int that converts back to the same string."
+    value = int(field)
+    if str(value) != field:
+        raise ValueError(field)
+    return value
+
+
+def _encodeChar(field):
+    "Converts a one-character string to bytes."
+    return field.encode('ascii')
+
+
+# How RecordCodec converts fields of each type code to be packed (int by
+# default) and, for those whose type changes, back after being unpacked
+_ENCODERS = {'n': _encodeId, 'c': _encodeChar}
+_DECODERS = {'n': str, 'c': bytes.decode}
+
+
+class RecordWriter(object):
+    """Writes records to sys.stdout in large blocks.
+
+    Records are formatted as tab-separated lines (or encoded with a
+    RecordCodec) and kept in a buffer, which is written to the binary stream
+    behind sys.stdout once it holds `bufferSize` bytes. That's much cheaper
+    than a call to print() per record. Whatever is left in the buffer must be
+    written with `flush()` at the end, which using the writer as a context
+    manager does::
+
+        with RecordWriter() as output:
+            for author, hour in records:
+                output.write(author, hour)
+    """
+
+    def __init__(self, bufferSize=OUTPUT_BUFFER_SIZE, codec=None, stream=None):
+        """Creates a writer.
+
+        :bufferSize: How many bytes (characters, for text) are buffered before
+                     being written.
+        :codec: A RecordCodec for binary output. Records are written as text
+                by default.
+        :stream: Where to write. Defaults to sys.stdout, as it is when the
+                 writer is created.
+        """
+        stream = sys.stdout if stream is None else stream
+        self.bufferSize = bufferSize
+        self.codec = codec
+        self.parts = []
+        self.size = 0
+        # Streams without a binary buffer, like io.StringIO, get text. The
+        # text stream is kept around: its buffer is closed along with it.
+        self.textStream = stream
+        self.stream = getattr(stream, 'buffer', stream)
+        self.encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        self.binary = self.stream is not stream
+        if self.binary:
+            # Text written before must come out before our bytes
+            stream.flush()
+        if codec is not None:
+            self.write = self._writeFrame
+        # Instrumentation. {{{
+        self.records = 0
+        self.writes = 0
+        # Records already counted by `Stats`
+        self.counted = 0
+        # }}}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.flush()
+
+    def write(self, *fields):
+        "Outputs a record, given its fields, as a tab-separated line."
+        line = '\t'.join(map(str, fields))
+        self.parts.append(line)
+        self.size += len(line) + 1
+        self.records += 1
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def writeLines(self, lines):
+        """Outputs many records at once, already formatted as lines.
+
+        :lines: A list of tab-separated lines, without their newlines. Only
+                for text output.
+        """
+        self.parts.extend(lines)
+        self.size += sum(map(len, lines)) + len(lines)
+        self.records += len(lines)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def _writeFrame(self, *fields):
+        "Outputs a record, given its fields, as a binary frame."
+        frame = self.codec.encode(fields)
+        self.parts.append(frame)
+        self.size += len(frame)
+        self.records += 1
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        "Writes whatever is buffered."
+        if not self.parts:
+            return
+        start = time.perf_counter()
+        if self.codec is not None:
+            self.stream.write(b''.join(self.parts))
+        else:
+            self.parts.append('')
+            text = '\n'.join(self.parts)
+            self.stream.write(text.encode(self.encoding) if self.binary
+                              else text)
+        self.stream.flush()
+        self.parts = []
+        self.size = 0
+        self.writes += 1
+        if _stats is not None:
+            _stats.time('write', time.perf_counter() - start)
+            _stats.count('Records written', self.records - self.counted)
+            self.counted = self.records
+
+
+class SpaceSaving(object):
+    """Approximate counts of the most frequent items of a stream.
+
+    This is the Space-Saving algorithm (Metwally et al., 2005): at most
+    `capacity` items are counted at once. When a new item arrives and there's
+    no room for it, it takes the place of the item with the smallest count,
+    and inherits that count as its error. Every count is an overestimate, by
+    at most its error, and no error is larger than `total / capacity`, so any
+    item that makes up more than 1/capacity of the stream is always counted.
+
+    Summaries of different parts of a stream can be merged (see `merge()`)
+    with the same guarantees, which is what lets mappers send summaries
+    instead of counts. They travel as JSON (see `dumps()` and `loads()`).
+    """
+
+    def __init__(self, capacity):
+        """Creates an empty summary.
+
+        :capacity: How many items are counted at once.
+        """
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # One (count, item) entry per item counted. Counts in the heap are
+        # only updated when they reach its top, so they may be too small.
+        self.heap = []
+
+    def add(self, item, amount=1):
+        "Counts `amount` more occurrences of an item."
+        self.total += amount
+        counts = self.counts
+        if item in counts:
+            counts[item] += amount
+            return
+
+        error = 0
+        if len(counts) >= self.capacity:
+            error, victim = self._popMinimum()
+            del counts[victim]
+            del self.errors[victim]
+        counts[item] = error + amount
+        self.errors[item] = error
+        heapq.heappush(self.heap, (error + amount, item))
+
+    def _popMinimum(self):
+        "Removes the item with the smallest count from the heap."
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, item = heapq.heappop(heap)
+            current = counts[item]
+            if current == count:
+                return count, item
+            # A stale entry: put it back with the right count
+            heapq.heappush(heap, (current, item))
+
+    def minimum(self):
+        """The count any item that is not in the summary may have had.
+
+        Until the summary fills up, every item is counted exactly, and items
+        not in it never occurred.
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """Adds the counts of another summary to this one.
+
+        Items missing from a full summary may have occurred as many times as
+        its smallest count, so that's what they are assumed to have (as an
+        error). Only the `capacity` largest counts are then kept. See Agarwal
+        et al., "Mergeable Summaries" (2012).
+
+        :other: The other summary.
+        """
+        mine = self.minimum()
+        theirs = other.minimum()
+        counts = {}
+        errors = {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = (self.counts.get(item, mine) +
+                            other.counts.get(item, theirs))
+            errors[item] = (self.errors.get(item, mine) +
+                            other.errors.get(item, theirs))
+
+        kept = heapq.nlargest(self.capacity, counts.items(),
+                              key=itemgetter(1))
+        self.counts = dict(kept)
+        self.errors = dict((item, errors[item]) for item, _ in kept)
+        self.heap = [(count, item) for item, count in kept]
+        heapq.heapify(self.heap)
+        self.total += other.total
+
+    def top(self, n):
+        """Returns the items with the largest counts.
+
+        :n: How many items to return.
+        :returns: A list of (item, count, error) tuples, largest counts
+                  first. Ties are broken by the item, largest first.
+        """
+        items = heapq.nlargest(n, ((count, item) for item, count
+                                   in self.counts.items()))
+        return [(item, count, self.errors[item]) for count, item in items]
+
+    def dumps(self):
+        "Serialises the summary as a single line of JSON."
+        return json.dumps({'capacity': self.capacity, 'total': self.total,
+                           'items': [[item, count, self.errors[item]]
+                                     for item, count in self.counts.items()]})
+
+    @classmethod
+    def loads(cls, text):
+        """Deserialises a summary.
+
+        :text: The summary, as returned by `dumps()`.
+        :returns: The summary.
+        :raises ValueError: If the text is not a summary.
+        """
+        data = json.loads(text)
+        summary = cls(data['capacity'])
+        summary.total = data['total']
+        for item, count, error in data['items']:
+            summary.counts[item] = count
+            summary.errors[item] = error
+            summary.heap.append((count, item))
+        heapq.heapify(summary.heap)
+        return summary
+
+
+class Moments(object):
+    """Means, variances and the covariance of a stream of (x, y) pairs.
+
+    They are kept as Welford's running means and sums of squared deviations
+    (co-moments), which don't lose precision the way sums of squares do, and
+    summaries of different parts of a stream can be merged exactly with the
+    formulas of Chan et al. (1979). See `merge()`.
+    """
+
+    def __init__(self):
+        "Creates an empty summary."
+        self.count = 0
+        self.meanX = 0.0
+        self.meanY = 0.0
+        # Sums of squared deviations from the means, and of their products
+        self.m2X = 0.0
+        self.m2Y = 0.0
+        self.cXY = 0.0
+
+    def add(self, x, y):
+        "Adds a pair to the summary."
+        self.count += 1
+        dx = x - self.meanX
+        self.meanX += dx / self.count
+        dy = y - self.meanY
+        self.meanY += dy / self.count
+        self.m2X += dx * (x - self.meanX)
+        self.m2Y += dy * (y - self.meanY)
+        self.cXY += dx * (y - self.meanY)
+
+    def merge(self, other):
+        """Adds the pairs summarised by another summary to this one.
+
+        :other: The other summary.
+        """
+        count = self.count + other.count
+        if not other.count:
+            return
+        dx = other.meanX - self.meanX
+        dy = other.meanY - self.meanY
+        weight = float(self.count) * other.count / count
+        self.meanX += dx * other.count / count
+        self.meanY += dy * other.count / count
+        self.m2X += other.m2X + dx * dx * weight
+        self.m2Y += other.m2Y + dy * dy * weight
+        self.cXY += other.cXY + dx * dy * weight
+        self.count = count
+
+    def stddev(self):
+        "The (population) standard deviations of x and y."
+        if not self.count:
+            return None, None
+        return (math.sqrt(self.m2X / self.count),
+                math.sqrt(self.m2Y / self.count))
+
+    def pearson(self):
+        "Pearson's correlation coefficient, or None if it is undefined."
+        if self.m2X <= 0 or self.m2Y <= 0:
+            return None
+        return self.cXY / math.sqrt(self.m2X * self.m2Y)
+
+    def asList(self):
+        "The summary, as a list that `fromList()` takes."
+        return [self.count, self.meanX, self.meanY, self.m2X, self.m2Y,
+                self.cXY]
+
+    @classmethod
+    def fromList(cls, values):
+        "Creates a summary from what `asList()` returned."
+        moments = cls()
+        (moments.count, moments.meanX, moments.meanY, moments.m2X,
+         moments.m2Y, moments.cXY) = values
+        return moments
+
+
+class TDigest(object):
+    """Approximate quantiles of a stream of numbers.
+
+    This is the merging variant of Dunning's t-digest: values are gathered in
+    a buffer, and every so often the buffer and the centroids so far are
+    sorted and merged into new centroids, each one holding the mean and the
+    number of values it stands for. How many values a centroid can hold is
+    bounded by the `k1` scale function, which keeps centroids small near the
+    extremes, so that extreme quantiles are accurate, and large in the middle.
+    At most about `compression` centroids are kept, however many values are
+    added, and digests of different parts of a stream can be merged.
+    """
+
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        """Creates an empty digest.
+
+        :compression: Roughly how many centroids are kept. More centroids make
+                      quantiles more accurate.
+        """
+        self.compression = compression
+        # Sorted [mean, weight] pairs
+        self.centroids = []
+        self.buffer = []
+        self.weight = 0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value, weight=1):
+        "Adds a value to the digest, `weight` times."
+        self.buffer.append((value, weight))
+        self.weight += weight
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if len(self.buffer) >= TDIGEST_BUFFER * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        """Adds the values summarised by another digest to this one.
+
+        :other: The other digest.
+        """
+        if not other.weight:
+            return
+        other._compress()
+        self.buffer.extend(other.centroids)
+        self.weight += other.weight
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+        self._compress()
+
+    def _limit(self, q):
+        "The largest quantile a centroid starting at quantile q can reach."
+        compression = self.compression
+        k = compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= compression / 4.0:
+            return 1.0
+        return (math.sin(2 * math.pi * k / compression) + 1) / 2
+
+    def _compress(self):
+        "Merges the buffer into the centroids."
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+
+        total = float(self.weight)
+        centroids = []
+        mean, weight = points[0]
+        done = 0
+        limit = self._limit(0.0)
+        for value, amount in points[1:]:
+            if (done + weight + amount) / total <= limit:
+                weight += amount
+                mean += (value - mean) * amount / weight
+            else:
+                centroids.append((mean, weight))
+                done += weight
+                limit = self._limit(done / total)
+                mean, weight = value, amount
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+    def quantile(self, q):
+        """Estimates a quantile of the values added so far.
+
+        Centroids are assumed to be centred on their means, and values in
+        between are interpolated linearly.
+
+        :q: The quantile, from 0 to 1.
+        :returns: The estimate, or None if the digest is empty.
+        """
+        self._compress()
+        if not self.centroids:
+            return None
+        target = q * self.weight
+        before = 0
+        position, value = 0.0, self.minimum
+        for mean, weight in self.centroids:
+            center = before + weight / 2.0
+            if target < center:
+                return _interpolate(target, position, value, center, mean)
+            position, value = center, mean
+            before += weight
+        return _interpolate(target, position, value, self.weight,
+                            self.maximum)
+
+    def asDict(self):
+        "The digest, as a dict that `fromDict()` takes."
+        self._compress()
+        return {'compression': self.compression, 'minimum': self.minimum,
+                'maximum': self.maximum,
+                'centroids': [list(centroid) for centroid in self.centroids]}
+
+    @classmethod
+    def fromDict(cls, data):
+        "Creates a digest from what `asDict()` returned."
+        digest = cls(data['compression'])
+        digest.minimum = data['minimum']
+        digest.maximum = data['maximum']
+        digest.centroids = [tuple(centroid) for centroid in data['centroids']]
+        digest.weight = sum(weight for _, weight in digest.centroids)
+        return digest
+
+
+def _interpolate(x, x0, y0, x1, y1):
+    "The value at x of the line through (x0, y0) and (x1, y1)."
+    if x1 <= x0:
+        return y1
+    return y0 + (y1 - y0) * (x - x0) / float(x1 - x0)
+
+
+class JointHistogram(object):
+    """Counts of (x, y) pairs of non-negative numbers, in logarithmic bins.
+
+    Bin 0 holds the values below 1, and each decade above that is split in
+    `binsPerDecade` bins, so that the bins of lengths, which span several
+    orders of magnitude, are all informative. Since the bins of x and y are
+    counted together, the histogram of each one can be told (see
+    `marginal()`), and so can their rank correlation (see `spearman()`).
+    Histograms of different parts of a stream are merged by adding them up.
+    """
+
+    def __init__(self, binsPerDecade=HISTOGRAM_BINS_PER_DECADE):
+        """Creates an empty histogram.
+
+        :binsPerDecade: How many bins each power of 10 is split in.
+        """
+        self.binsPerDecade = binsPerDecade
+        # (x bin, y bin) -> count
+        self.counts = {}
+
+    def bin(self, value):
+        "The bin a value falls in."
+        if value < 1:
+            return 0
+        return 1 + int(math.log10(value) * self.binsPerDecade)
+
+    def bounds(self, index):
+        "The lower (inclusive) and upper (exclusive) bounds of a bin."
+        if index == 0:
+            return 0, 1
+        return (10 ** ((index - 1.0) / self.binsPerDecade),
+                10 ** (float(index) / self.binsPerDecade))
+
+    def add(self, x, y):
+        "Counts a pair."
+        key = self.bin(x), self.bin(y)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        """Adds the counts of another histogram to these.
+
+        :other: The other histogram.
+        :raises ValueError: If its bins are not the same.
+        """
+        if other.binsPerDecade != self.binsPerDecade:
+            raise ValueError('Histograms with different bins: {0} and {1} '
+                             'per decade'.format(self.binsPerDecade,
+                                                 other.binsPerDecade))
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def _totals(self, axis):
+        "The count of each bin of x (axis 0) or y (axis 1), in order."
+        totals = {}
+        for key, count in self.counts.items():
+            totals[key[axis]] = totals.get(key[axis], 0) + count
+        return sorted(totals.items())
+
+    def marginal(self, axis):
+        """The histogram of x (axis 0) or y (axis 1) alone.
+
+        :returns: A list of (lower bound, upper bound, count) tuples, in
+                  order, for the bins that have any value.
+        """
+        return [self.bounds(index) + (count,)
+                for index, count in self._totals(axis)]
+
+    def spearman(self):
+        """Estimates Spearman's rank correlation coefficient.
+
+        Pairs whose x (or y) fall in the same bin are taken as ties, and get
+        the mean of the ranks they share. The estimate is then Pearson's
+        correlation of the ranks, which is exact when no two distinct values
+        share a bin.
+
+        :returns: The estimate, or None if it is undefined.
+        """
+        ranks = []
+        for axis in (0, 1):
+            rank = {}
+            before = 0
+            for index, count in self._totals(axis):
+                rank[index] = before + (count + 1) / 2.0
+                before += count
+            ranks.append(rank)
+        rankX, rankY = ranks
+
+        total = sum(self.counts.values())
+        mean = (total + 1) / 2.0
+        sxx = syy = sxy = 0.0
+        for (x, y), count in self.counts.items():
+            dx = rankX[x] - mean
+            dy = rankY[y] - mean
+            sxx += count * dx * dx
+            syy += count * dy * dy
+            sxy += count * dx * dy
+        if sxx <= 0 or syy <= 0:
+            return None
+        return sxy / math.sqrt(sxx * syy)
+
+    def asDict(self):
+        "The histogram, as a dict that `fromDict()` takes."
+        return {'binsPerDecade': self.binsPerDecade,
+                'counts': [[x, y, count]
+                           for (x, y), count in sorted(self.counts.items())]}
+
+    @classmethod
+    def fromDict(cls, data):
+        "Creates a histogram from what `asDict()` returned."
+        histogram = cls(data['binsPerDecade'])
+        for x, y, count in data['counts']:
+            histogram.counts[x, y] = count
+        return histogram
+
+
+class Stats(object):
+    """Counters and stage timers of a mapper or reducer run.
+
+    Records read and written, and the time taken to read and write them, are
+    counted by `timed()` and `RecordWriter`; records dropped, with the reason
+    why, by `drop()`. All of that happens only while the run is
+    `instrumented()`, so runs that aren't pay almost nothing for it.
+    """
+
+    def __init__(self, group):
+        """Creates empty counters.
+
+        :group: The name the counters are reported under, usually the name of
+                the mapper or reducer.
+        """
+        self.group = group
+        self.counters = {}
+        self.dropped = {}
+        self.seconds = {}
+
+    def count(self, name, amount=1):
+        "Adds to a counter."
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def drop(self, reason, amount=1):
+        "Counts dropped records."
+        self.dropped[reason] = self.dropped.get(reason, 0) + amount
+
+    def time(self, stage, seconds):
+        "Adds to the time taken by a stage."
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+
+    def merge(self, other):
+        """Adds the counters and timers of another run to these.
+
+        :other: What `asDict()` returned for the other run.
+        """
+        for name, value in other['counters'].items():
+            self.count(name, value)
+        for reason, value in other['dropped'].items():
+            self.drop(reason, value)
+        for stage, value in other['seconds'].items():
+            self.time(stage, value)
+
+    def asDict(self):
+        "Returns the counters and timers, for a JSON report."
+        return {'group': self.group, 'counters': dict(self.counters),
+                'dropped': dict(self.dropped), 'seconds': dict(self.seconds)}
+
+    def counterLines(self):
+        """Returns the counters and timers as Hadoop Streaming counters.
+
+        Counters must be integers, so times are reported in milliseconds.
+
+        :returns: A list of lines, without newlines.
+        """
+        values = sorted(self.counters.items())
+        values += sorted(('Dropped ({0})'.format(reason), value)
+                         for reason, value in self.dropped.items())
+        values += sorted(('Time {0} (ms)'.format(stage),
+                          int(round(seconds * 1000)))
+                         for stage, seconds in self.seconds.items())
+        return ['reporter:counter:{0},{1},{2}'.format(self.group, name, value)
+                for name, value in values]
+
+
+def drop(reason, amount=1):
+    """Counts records dropped for a reason, if the run is instrumented.
+
+    Only called when records are dropped, which is rare, so it can be called
+    in inner loops.
+
+    :reason: Why they were dropped, like "bad date".
+    :amount: How many records were dropped.
+    """
+    if _stats is not None:
+        _stats.drop(reason, amount)
+
+
+def addCounter(name, amount=1):
+    """Adds to a counter, if the run is instrumented.
+
+    For the counters a mapper or reducer keeps by itself. With
+    `mapFile()`, the amounts of all processes are added up.
+
+    :name: The counter's name, like "Flushes".
+    :amount: How much to add to it.
+    """
+    if _stats is not None:
+        _stats.count(name, amount)
+
+
+def timed(iterable, stage, counter='Records read'):
+    """Counts and times the items of an iterable, if the run is instrumented.
+
+    :iterable: Where the records of a stage come from, like `readNodes()`.
+    :stage: The name of the stage. The time spent producing the items is
+            added to it.
+    :counter: The counter the items are added to.
+    :returns: The iterable itself, if the run is not instrumented. Otherwise
+              a generator of the same items.
+    """
+    if _stats is None:
+        return iterable
+    return _timed(iter(iterable), stage, counter, _stats)
+
+
+def _timed(iterator, stage, counter, stats):
+    "See `timed()`."
+    clock = time.perf_counter
+    items = 0
+    elapsed = 0
+    try:
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += clock() - start
+            items += 1
+            yield item
+    finally:
+        stats.count(counter, items)
+        stats.time(stage, elapsed)
+
+
+def addInstrumentationArguments(parser):
+    """Adds the command line options of `instrumented()` to a parser.
+
+    :parser: An argparse.ArgumentParser.
+    """
+    parser.add_argument('--counters', action='store_true',
+                        help='Report records read, written and dropped, and '
+                        'the time taken by each stage, as Hadoop Streaming '
+                        'counters on standard error.')
+    parser.add_argument('--stats', metavar='PATH',
+                        help='Write the same as --counters to this file, as '
+                        'JSON.')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile the run with cProfile and save the '
+                        'results to this file ("-" prints them on standard '
+                        'error).')
+
+
+@contextlib.contextmanager
+def instrumented(group, counters=False, statsPath=None, profilePath=None):
+    """Instruments the run of a mapper or reducer. See `Stats`.
+
+    A "total" timer covers the whole run, so the time of the stages that
+    aren't timed by themselves (the mapper's or reducer's own work) is what
+    the other stages leave of it. cProfile tells that time apart, at the cost
+    of slowing the run down. When `mapFile()` runs the mapper in many
+    processes, the stages and the total are added up over them instead, and
+    the wall clock time of the run goes in a "wall" timer.
+
+    :group: The name the counters are reported under.
+    :counters: Whether to report them as Hadoop Streaming counters.
+    :statsPath: Where to write them as JSON, if anywhere.
+    :profilePath: Where to save the cProfile results, if anywhere. "-"
+                  prints the most expensive functions on standard error.
+    :returns: A context manager, whose value is the Stats of the run (None
+              if nothing was asked for).
+    """
+    global _stats
+    if not (counters or statsPath or profilePath):
+        yield None
+        return
+
+    stats = _stats = Stats(group)
+    profile = cProfile.Profile() if profilePath else None
+    start = time.perf_counter()
+    try:
+        if profile is not None:
+            profile.enable()
+        yield stats
+    finally:
+        if profile is not None:
+            profile.disable()
+        _stats = None
+    if 'total' in stats.seconds:
+        # Added up over the processes of `mapFile()`
+        stats.time('wall', time.perf_counter() - start)
+    else:
+        stats.time('total', time.perf_counter() - start)
 
-    # Okay, the data looks fine
-    return True
+    if counters:
+        for line in stats.counterLines():
+            sys.stderr.write(line + '\n')
+    if statsPath:
+        with open(statsPath, 'w') as statsFile:
+            json.dump(stats.asDict(), statsFile, indent=2, sort_keys=True)
+    if profilePath == '-':
+        pstats.Stats(profile, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(PROFILE_LINES)
+    elif profilePath:
+        profile.dump_stats(profilePath)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Mapper that runs every exercise in a single pass over the input.
+
+Each of the other mappers reads and parses the whole forum_nodes.tsv just to
+look at a couple of fields. This one parses each line once and outputs the
+records of every enabled exercise, each one prefixed by a tag that says which
+exercise it belongs to. `fused_reducer` sends each tag to the reducer of its
+exercise.
+
+Records are keyed by their tag *and* the key of their exercise, so reducers
+must be partitioned on the first two fields (see the README).
+
+.. module:: fused_mapper
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from common import BODY_LENGTH, RecordWriter, addInstrumentationArguments, \
+    drop, instrumented, loadNodes, mapFile
+from student_times_mapper import parseHour
+from popular_tags_mapper import MAX_BYTES, MAX_ENTRIES, TagCounter, \
+    reportCounters
+
+# To make our reducers lives' easier, we want questions before the rest. {{{
+QUESTION = 'A'
+ANSWER = 'B'
+WHATEVER = 'B'
+# }}}
+
+# The exercises we can run, and the tags of their records
+TAGS = {
+    'student_times': 'T',
+    'study_groups': 'G',
+    'popular_tags': 'P',
+    'average_length': 'L',
+}
+JOBS = ('student_times', 'study_groups', 'popular_tags', 'average_length')
+
+# Every field any exercise needs
+FIELDS = ('id', 'node_type', 'abs_parent_id', 'author_id', 'added_at',
+          'tagnames', BODY_LENGTH)
+
+
+def mapper(jobs=JOBS, maxEntries=MAX_ENTRIES, maxBytes=MAX_BYTES,
+           cache=None):
+    """Mapper function.
+
+    Input is read from sys.stdin and written to sys.stdout. Both streams can be
+    overwritten if needed.
+
+    :jobs: The exercises to output records for.
+    :maxEntries: How many distinct tags popular_tags counts in memory at once.
+    :maxBytes: How many bytes the tags counted in memory can take.
+    :cache: A cache to read nodes from instead of sys.stdin, if it is fresh.
+            See `common.loadNodes()`.
+    :returns: Nothing. Writes to standard output.
+    """
+    writer = RecordWriter()
+    write = writer.write
+
+    studentTimes = 'student_times' in jobs
+    studyGroups = 'study_groups' in jobs
+    popularTags = 'popular_tags' in jobs
+    averageLength = 'average_length' in jobs
+
+    tagCounter = TagCounter(
+        lambda tag, amount: write(TAGS['popular_tags'], tag, amount),
+        maxEntries, maxBytes)
+
+    # What each exercise does with a line is exactly what its own mapper
+    # does. See the comments there.
+    rows = loadNodes(FIELDS, cache)
+    for node, nodeType, parent, author, date, tags, length in rows:
+        if studentTimes:
+            hour = parseHour(date)
+            if hour is not None:
+                write(TAGS['student_times'], author, hour)
+            else:
+                drop('bad date')
+
+        if studyGroups:
+            if nodeType == 'question':
+                write(TAGS['study_groups'], node, QUESTION, author)
+            else:
+                write(TAGS['study_groups'], parent, WHATEVER, author)
+
+        if popularTags:
+            for tag in tags.split():
+                tagCounter.add(tag)
+
+        if averageLength:
+            if nodeType == 'question':
+                write(TAGS['average_length'], node, QUESTION, length)
+            elif nodeType == 'answer':
+                write(TAGS['average_length'], parent, ANSWER, length)
+
+    tagCounter.flush()
+    writer.flush()
+    reportCounters(tagCounter)
+
+
+def main(argv=None):
+    "Parses the command line and runs the mapper."
+    parser = argparse.ArgumentParser(
+        description='Mapper for all exercises at once.')
+    parser.add_argument('--jobs', nargs='+', choices=JOBS, default=JOBS,
+                        help='The exercises to run. Default: all of them.')
+    parser.add_argument('--max-entries', type=int, default=MAX_ENTRIES,
+                        help='How many distinct tags to count in memory.')
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES,
+                        help='How much memory the tags counted can take.')
+    parser.add_argument('--cache',
+                        help='Read nodes from this cache (see build_cache.py) '
+                        'instead of standard input, if it is fresh.')
+    parser.add_argument('input', nargs='?',
+                        help='Read nodes from this file instead of standard '
+                        'input, splitting it among --workers processes.')
+    parser.add_argument('--workers', type=int,
+                        help='How many processes to use when given a file. '
+                        'Default: one per CPU.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.input is not None and args.cache is not None:
+        parser.error('--cache holds the whole input and cannot be split '
+                     'among workers')
+
+    with instrumented('fused_mapper', args.counters, args.stats,
+                      args.profile):
+        if args.input is None:
+            mapper(args.jobs, args.max_entries, args.max_bytes, args.cache)
+        else:
+            mapFile(args.input, args.workers, mapper, args.jobs,
+                    args.max_entries, args.max_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Reducer for the records of `fused_mapper`.
+
+Lines come sorted by their tag first, so the lines of each exercise come
+together. Each group is handed, without its tags, to the reducer of the
+exercise, and each line that reducer outputs is prefixed by the name of the
+exercise.
+
+.. module:: fused_reducer
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import itertools
+
+from common import addInstrumentationArguments, drop, instrumented
+import student_times_reducer
+import study_groups_reducer
+import popular_tags_reducer
+import average_length_reducer
+
+# The reducer of each tag, and the name its output is prefixed with. Tags
+# must match the mapper's.
+REDUCERS = {
+    'T': ('student_times', student_times_reducer),
+    'G': ('study_groups', study_groups_reducer),
+    'P': ('popular_tags', popular_tags_reducer),
+    'L': ('average_length', average_length_reducer),
+}
+
+
+class TaggedOutput(object):
+    "A text stream that prefixes every line written to it with a tag."
+
+    def __init__(self, tag, stream):
+        """Creates the stream.
+
+        :tag: The tag. It is separated from the lines by a tab.
+        :stream: Where the tagged lines are written.
+        """
+        self.prefix = tag + '\t'
+        self.stream = stream
+        self.lineStart = True
+
+    def write(self, text):
+        "Writes text, tagging the lines that start in it."
+        if not text:
+            return
+        tagged = text.replace('\n', '\n' + self.prefix)
+        if self.lineStart:
+            tagged = self.prefix + tagged
+        # The line after the last newline hasn't started yet
+        self.lineStart = text.endswith('\n')
+        if self.lineStart:
+            tagged = tagged[:-len(self.prefix)]
+        self.stream.write(tagged)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def getTag(line):
+    "Returns the tag of a line."
+    return line.split('\t', 1)[0]
+
+
+def reducer():
+    """Reducer function.
+
+    :returns: Nothing. Writes to standard output.
+    """
+    stdin, stdout = sys.stdin, sys.stdout
+    try:
+        for tag, lines in itertools.groupby(stdin, getTag):
+            if tag not in REDUCERS:
+                # Not a line from our mapper. Ignore it.
+                for _ in lines:
+                    drop('unknown tag')
+                continue
+            name, module = REDUCERS[tag]
+
+            # Exercise reducers read sys.stdin and write to sys.stdout
+            sys.stdin = (line[len(tag) + 1:] for line in lines)
+            sys.stdout = TaggedOutput(name, stdout)
+            module.reducer()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+
+
+def main(argv=None):
+    "Parses the command line and runs the reducer."
+    parser = argparse.ArgumentParser(
+        description='Reducer for all exercises at once.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    with instrumented('fused_reducer', args.counters, args.stats,
+                      args.profile):
+        reducer()
+
+
+if __name__ == '__main__':
+    main()
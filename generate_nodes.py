@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Generates synthetic forum_nodes.tsv files, for benchmarks.
+
+The real dump is a single, fixed size. This builds files of any size that
+look like it where it matters to the mappers and reducers: every field of
+NODE_FIELDS is quoted, bodies span several lines and hold tabs, quotes and
+non-ASCII characters, a few tags and a few authors account for most posts
+(both follow Zipf's law), a few threads get most of the answers and
+comments, and some lines are malformed, in the ways readNodes drops::
+
+    python generate_nodes.py --rows 1000000 --malformed 0.01 > nodes.tsv
+
+The same arguments and ``--seed`` always generate the same file.
+
+.. module:: generate_nodes
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import math
+import time
+import random
+import argparse
+import itertools
+from array import array
+
+from common import FIELD_INDEX, NODE_FIELDS
+
+# Defaults of the generator's parameters. See `generateNodes()`. {{{
+ROWS = 100000
+SEED = 42
+TAGS = 5000
+TAG_SKEW = 1.1
+AUTHORS = 20000
+AUTHOR_SKEW = 1.0
+THREAD_SKEW = 0.7
+BODY_LENGTH = 500
+MALFORMED = 0.005
+# }}}
+
+# The first node id, like in the real dump
+FIRST_ID = 1000
+# Which fraction of the posts are questions, and of the rest, answers
+QUESTIONS = 0.25
+ANSWERS = 0.6
+# How many tags a question has, at most
+MAX_TAGS = 5
+# Spread of the (log-normal) body lengths
+BODY_SIGMA = 1.0
+# The posts are spread over this period, as seconds since the epoch
+START_TIME = 1325376000  # 2012-01-01
+PERIOD = 366 * 24 * 3600
+
+# What bodies are made of
+BODY_WORDS = ('the', 'unit', 'quiz', 'homework', 'python', 'def', 'return',
+              'café', 'naïve', '→', '<p>', '</p>', 'print(x)')
+# Newlines, tabs and quotes make readNodes take its slow path, so they are
+# as rare as in the real bodies: about one in this many words.
+SPECIAL_WORDS = ('"quoted"', 'tab\there', 'line\nbreak')
+SPECIAL_RATE = 500
+# How many characters of text bodies are sliced from
+BODY_TEXT_SIZE = 1 << 16
+
+# Ways in which a line can be malformed
+MALFORMED_KINDS = ('short', 'long', 'non-numeric id', 'bad date')
+
+
+def zipfWeights(count, exponent):
+    """Cumulative weights of a Zipf distribution over `count` items.
+
+    :count: How many items there are. The first one is the most frequent.
+    :exponent: How skewed the distribution is. 0 makes it uniform.
+    :returns: A list of cumulative weights, as `random.choices` takes them.
+    """
+    return list(itertools.accumulate(1 / (rank ** exponent)
+                                     for rank in range(1, count + 1)))
+
+
+def quote(field):
+    "Quotes a field the way the dump does, doubling quotes inside it."
+    return '"' + field.replace('"', '""') + '"'
+
+
+def formatDate(seconds, micros):
+    "Formats a date the way the dump does."
+    date = '{0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}'.format(
+        *time.gmtime(seconds)[:6])
+    return '{0}.{1:06d}+00'.format(date, micros)
+
+
+def generateNodes(rows=ROWS, seed=SEED, tags=TAGS, tagSkew=TAG_SKEW,
+                  authors=AUTHORS, authorSkew=AUTHOR_SKEW,
+                  threadSkew=THREAD_SKEW, bodyLength=BODY_LENGTH,
+                  malformed=MALFORMED):
+    """Generates the lines of a synthetic forum_nodes.tsv.
+
+    Posts come in the order of their ids. Each one is a question with
+    probability QUESTIONS; otherwise it goes into an earlier thread, chosen
+    in proportion to the posts the thread already has with probability
+    `threadSkew`, and uniformly otherwise. The former makes large threads
+    grow larger, so thread sizes follow a power law.
+
+    :rows: How many lines to generate, not counting the header.
+    :seed: Seed for the random number generator.
+    :tags: How many distinct tags there are.
+    :tagSkew: Zipf exponent of the tags' popularity.
+    :authors: How many distinct authors there are.
+    :authorSkew: Zipf exponent of the authors' activity.
+    :threadSkew: How skewed the thread sizes are, from 0 to 1.
+    :bodyLength: Mean length of the bodies, in characters.
+    :malformed: Which fraction of the lines is malformed.
+    :returns: A generator of lines, header first, each ending in a newline.
+    """
+    rng = random.Random(seed)
+    tagNames = ['tag{0}'.format(tag) for tag in range(tags)]
+    tagWeights = zipfWeights(tags, tagSkew)
+    authorIds = [str(100000 + author) for author in range(authors)]
+    authorWeights = zipfWeights(authors, authorSkew)
+    # Pick all authors at once, a block at a time: that's much faster.
+    authorBlock = []
+
+    text = ''.join(rng.choice(SPECIAL_WORDS if rng.randrange(SPECIAL_RATE)
+                              == 0 else BODY_WORDS) + ' '
+                   for _ in range(BODY_TEXT_SIZE // 4))
+    bodyMu = math.log(max(bodyLength, 1)) - BODY_SIGMA ** 2 / 2
+
+    # The thread of every post so far, and every thread so far
+    postThreads = array('l')
+    threads = array('l')
+
+    yield '\t'.join(quote(field) for field in NODE_FIELDS) + '\n'
+
+    line = ['\\N'] * len(NODE_FIELDS)
+    for node in range(FIRST_ID, FIRST_ID + rows):
+        if not authorBlock:
+            authorBlock = rng.choices(authorIds, cum_weights=authorWeights,
+                                      k=1024)
+
+        if not threads or rng.random() < QUESTIONS:
+            nodeType = 'question'
+            thread = node
+            threads.append(node)
+            parent = '\\N'
+            tagnames = ' '.join(sorted(set(rng.choices(
+                tagNames, cum_weights=tagWeights,
+                k=rng.randint(1, MAX_TAGS)))))
+        else:
+            nodeType = 'answer' if rng.random() < ANSWERS else 'comment'
+            if rng.random() < threadSkew:
+                thread = postThreads[rng.randrange(len(postThreads))]
+            else:
+                thread = threads[rng.randrange(len(threads))]
+            parent = str(thread)
+            tagnames = ''
+        postThreads.append(thread)
+
+        length = min(int(rng.lognormvariate(bodyMu, BODY_SIGMA)),
+                     len(text) - 1)
+        start = rng.randrange(len(text) - length)
+        seconds = START_TIME + (node - FIRST_ID) * PERIOD // max(rows, 1)
+        date = formatDate(seconds + rng.randrange(3600),
+                          rng.randrange(1000000))
+
+        line[0] = str(node)
+        line[1] = 'Title of node {0}'.format(node)
+        line[2] = tagnames
+        line[3] = authorBlock.pop()
+        line[4] = text[start:start + length]
+        line[5] = nodeType
+        line[6] = parent
+        line[7] = parent
+        line[8] = date
+        line[9] = str(rng.randint(-2, 10))
+        line[10] = ''
+        line[13] = date
+
+        if rng.random() < malformed:
+            yield malformedLine(line, rng.choice(MALFORMED_KINDS))
+        else:
+            yield '\t'.join(quote(field) for field in line) + '\n'
+
+
+def malformedLine(line, kind):
+    """Formats a line so that it is malformed in a given way.
+
+    :line: The fields of the line, which are left untouched.
+    :kind: One of MALFORMED_KINDS.
+    :returns: The formatted line.
+    """
+    fields = list(line)
+    if kind == 'short':
+        fields = fields[:len(fields) // 2]
+    elif kind == 'long':
+        fields.append('extra')
+    elif kind == 'non-numeric id':
+        fields[FIELD_INDEX['id']] = 'n' + fields[FIELD_INDEX['id']]
+    elif kind == 'bad date':
+        fields[FIELD_INDEX['added_at']] = '2012-13-45 25:61:00.0+00'
+    else:
+        raise ValueError('Unknown kind of malformed line: {0}'.format(kind))
+    return '\t'.join(quote(field) for field in fields) + '\n'
+
+
+def addGeneratorArguments(parser):
+    """Adds the generator's parameters to a command line parser.
+
+    :parser: An argparse.ArgumentParser.
+    """
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='How many lines to generate, besides the '
+                        'header.')
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help='Seed for the random number generator.')
+    parser.add_argument('--tags', type=int, default=TAGS,
+                        help='How many distinct tags there are.')
+    parser.add_argument('--tag-skew', type=float, default=TAG_SKEW,
+                        help='Zipf exponent of the tags\' popularity.')
+    parser.add_argument('--authors', type=int, default=AUTHORS,
+                        help='How many distinct authors there are.')
+    parser.add_argument('--author-skew', type=float, default=AUTHOR_SKEW,
+                        help='Zipf exponent of the authors\' activity.')
+    parser.add_argument('--thread-skew', type=float, default=THREAD_SKEW,
+                        help='How skewed thread sizes are, from 0 (not at '
+                        'all) to 1.')
+    parser.add_argument('--body-length', type=int, default=BODY_LENGTH,
+                        help='Mean length of the bodies, in characters.')
+    parser.add_argument('--malformed', type=float, default=MALFORMED,
+                        help='Which fraction of the lines is malformed.')
+
+
+def generatorOptions(parser, args):
+    """Checks the generator's parameters given on the command line.
+
+    :parser: The parser given to `addGeneratorArguments()`.
+    :args: What it parsed.
+    :returns: A dict with the keyword arguments of `generateNodes()`.
+    """
+    if args.rows < 0 or args.tags < 1 or args.authors < 1:
+        parser.error('--rows must not be negative, and --tags and --authors '
+                     'must be at least 1')
+    if not 0 <= args.thread_skew <= 1 or not 0 <= args.malformed <= 1:
+        parser.error('--thread-skew and --malformed must be between 0 and 1')
+
+    return dict(rows=args.rows, seed=args.seed, tags=args.tags,
+                tagSkew=args.tag_skew, authors=args.authors,
+                authorSkew=args.author_skew, threadSkew=args.thread_skew,
+                bodyLength=args.body_length, malformed=args.malformed)
+
+
+def main(argv=None):
+    "Parses the command line and writes a synthetic forum_nodes.tsv."
+    parser = argparse.ArgumentParser(
+        description='Generates a synthetic forum_nodes.tsv.')
+    addGeneratorArguments(parser)
+    parser.add_argument('--output',
+                        help='Where to write to. Default: standard output.')
+    args = parser.parse_args(argv)
+
+    lines = generateNodes(**generatorOptions(parser, args))
+    if args.output is None:
+        sys.stdout.writelines(lines)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.writelines(lines)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Keeps the results of every exercise up to date with new forum dumps.
+
+A new forum_nodes.tsv usually differs from the previous one in a few nodes
+only, but the jobs have to process all of it again. Instead, this module
+keeps the state the reducers would build (the posts of each author per hour,
+the authors of each thread, the count of each tag and the lengths of each
+thread) in an SQLite database, along with the fields of every node that
+state came from. Given a new dump, it finds which nodes are new, which
+changed (their ``last_activity_at`` is not the one we saw) and which were
+deleted, takes back what the changed and deleted nodes added to the state,
+and adds what the new and changed ones add. The state can then be output
+just like the reducers do::
+
+    python incremental.py update forum.db forum_nodes.tsv
+    python incremental.py output forum.db student_times
+
+An update is a single transaction: if it fails, the previous state is kept.
+The first update of an empty database processes the whole dump.
+
+.. module:: incremental
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+
+import sys
+import sqlite3
+import argparse
+from collections import Counter
+
+from common import BODY_LENGTH, RecordWriter, loadNodes
+from student_times_mapper import parseHour
+import student_times_reducer
+import study_groups_reducer
+import popular_tags_reducer
+import average_length_reducer
+
+# To make our reducers lives' easier, we want questions before the rest. {{{
+QUESTION = 'A'
+WHATEVER = 'B'
+# }}}
+
+# The exercises whose results we keep
+JOBS = ('student_times', 'study_groups', 'popular_tags', 'average_length')
+
+# What we keep of each node. Changes to a node are told by the last field.
+FIELDS = ('id', 'node_type', 'abs_parent_id', 'author_id', 'added_at',
+          'tagnames', BODY_LENGTH, 'last_activity_at')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY, node_type TEXT, parent TEXT, author TEXT,
+    added_at TEXT, tagnames TEXT, body_length INTEGER, version TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hours (
+    author TEXT, hour INTEGER, posts INTEGER, PRIMARY KEY (author, hour)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS participants (
+    thread TEXT, kind TEXT, author TEXT, posts INTEGER,
+    PRIMARY KEY (thread, kind, author)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY, posts INTEGER
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lengths (
+    thread TEXT PRIMARY KEY, questions INTEGER, question_length INTEGER,
+    answers INTEGER, answer_length INTEGER
+) WITHOUT ROWID;
+'''
+
+# How each table takes a delta: the key columns, then the columns added to
+UPSERTS = {
+    'hours': (('author', 'hour'), ('posts',)),
+    'participants': (('thread', 'kind', 'author'), ('posts',)),
+    'tags': (('tag',), ('posts',)),
+    'lengths': (('thread',), ('questions', 'question_length', 'answers',
+                              'answer_length')),
+}
+
+
+def connect(path):
+    """Opens (or creates) a state database.
+
+    :path: The database's path.
+    :returns: An sqlite3 connection.
+    """
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class Delta(object):
+    """What a set of nodes adds to (or takes from) the state of every job.
+
+    Each node is turned into the records its mappers would output, and those
+    are added up per key, just as the reducers would. See `fused_mapper`.
+    """
+
+    def __init__(self):
+        self.tables = dict((table, Counter()) for table in UPSERTS
+                           if table != 'lengths')
+        self.tables['lengths'] = {}
+
+    def add(self, node, sign=1):
+        """Adds a node, or takes it back.
+
+        :node: A tuple with the node's fields, as in FIELDS.
+        :sign: 1 to add the node, -1 to take it back.
+        """
+        node, nodeType, parent, author, date, tags, length = node[:7]
+
+        hour = parseHour(date)
+        if hour is not None:
+            self.tables['hours'][author, hour] += sign
+
+        if nodeType == 'question':
+            self.tables['participants'][node, QUESTION, author] += sign
+        else:
+            self.tables['participants'][parent, WHATEVER, author] += sign
+
+        for tag in tags.split():
+            self.tables['tags'][tag] += sign
+
+        if nodeType == 'question':
+            self._addLengths(node, (sign, sign * length, 0, 0))
+        elif nodeType == 'answer':
+            self._addLengths(parent, (0, 0, sign, sign * length))
+
+    def _addLengths(self, thread, values):
+        "Adds to the question and answer counts and lengths of a thread."
+        lengths = self.tables['lengths']
+        current = lengths.get(thread, (0, 0, 0, 0))
+        lengths[thread] = tuple(a + b for a, b in zip(current, values))
+
+    def apply(self, connection):
+        """Adds the delta to the state in a database.
+
+        Keys that end up with nothing (no posts, no questions and no answers)
+        are removed, just as if their nodes had never been seen.
+
+        :connection: The database connection.
+        """
+        for table, (keys, values) in UPSERTS.items():
+            rows = [(key if isinstance(key, tuple) else (key,)) +
+                    (value if isinstance(value, tuple) else (value,))
+                    for key, value in self.tables[table].items()]
+            columns = keys + values
+            connection.executemany(
+                'INSERT INTO {0} ({1}) VALUES ({2}) ON CONFLICT ({3}) DO '
+                'UPDATE SET {4}'.format(
+                    table, ', '.join(columns),
+                    ', '.join('?' * len(columns)), ', '.join(keys),
+                    ', '.join('{0} = {0} + excluded.{0}'.format(value)
+                              for value in values)),
+                rows)
+            connection.execute('DELETE FROM {0} WHERE {1}'.format(
+                table, ' AND '.join('{0} = 0'.format(value)
+                                    for value in values)))
+
+
+def update(connection, stream=None):
+    """Brings the state up to date with a new dump.
+
+    :connection: The database connection.
+    :stream: The new forum_nodes.tsv. Defaults to sys.stdin.
+    :returns: A dict with how many nodes were new, changed, deleted and left
+              alone.
+    """
+    with connection:
+        connection.execute('CREATE TEMP TABLE dump AS SELECT * FROM nodes '
+                           'WHERE 0')
+        connection.execute('CREATE UNIQUE INDEX temp.dump_id ON dump (id)')
+        connection.executemany('INSERT OR REPLACE INTO dump VALUES '
+                               '(?, ?, ?, ?, ?, ?, ?, ?)',
+                               loadNodes(FIELDS, stream=stream))
+
+        delta = Delta()
+        stats = Counter({'new nodes': 0, 'changed nodes': 0,
+                         'deleted nodes': 0})
+        for node in connection.execute(
+                'SELECT n.*, d.id IS NULL FROM nodes n LEFT JOIN dump d '
+                'ON d.id = n.id WHERE d.id IS NULL OR d.version IS NOT '
+                'n.version'):
+            delta.add(node, -1)
+            stats['deleted nodes' if node[-1] else 'changed nodes'] += 1
+        for node in connection.execute(
+                'SELECT d.*, n.id IS NULL FROM dump d LEFT JOIN nodes n '
+                'ON n.id = d.id WHERE n.id IS NULL OR n.version IS NOT '
+                'd.version'):
+            delta.add(node)
+            if node[-1]:
+                stats['new nodes'] += 1
+        delta.apply(connection)
+
+        connection.execute('DELETE FROM nodes WHERE id NOT IN '
+                           '(SELECT id FROM dump)')
+        connection.execute('INSERT OR REPLACE INTO nodes SELECT d.* FROM '
+                           'dump d LEFT JOIN nodes n ON n.id = d.id WHERE '
+                           'n.id IS NULL OR n.version IS NOT d.version')
+        total = connection.execute('SELECT COUNT(*) FROM dump').fetchone()[0]
+        connection.execute('DROP TABLE dump')
+
+    stats['unchanged nodes'] = (total - stats['new nodes'] -
+                                stats['changed nodes'])
+    return stats
+
+
+def output(connection, job, top=popular_tags_reducer.TOP_N_TAGS):
+    """Outputs the results of an exercise, just like its reducer would.
+
+    :connection: The database connection.
+    :job: The exercise, one of JOBS.
+    :top: How many tags popular_tags outputs.
+    :returns: Nothing. Writes to standard output.
+    """
+    writer = RecordWriter()
+
+    if job == 'student_times':
+        lastAuthor = None
+        postHours = None
+        for author, hour, posts in connection.execute(
+                'SELECT author, hour, posts FROM hours ORDER BY author'):
+            if author != lastAuthor:
+                if lastAuthor is not None:
+                    student_times_reducer.output(lastAuthor, postHours,
+                                                 writer)
+                postHours = student_times_reducer.emptyHours()
+                lastAuthor = author
+            postHours[hour % 24] += posts
+        if lastAuthor is not None:
+            student_times_reducer.output(lastAuthor, postHours, writer)
+
+    elif job == 'study_groups':
+        lastThread = None
+        authors = []
+        for thread, author, posts in connection.execute(
+                'SELECT thread, author, posts FROM participants '
+                'ORDER BY thread, kind, author'):
+            if thread != lastThread:
+                if lastThread is not None:
+                    study_groups_reducer.output(lastThread, authors, writer)
+                authors = []
+                lastThread = thread
+            authors.extend([author] * posts)
+        if lastThread is not None:
+            study_groups_reducer.output(lastThread, authors, writer)
+
+    elif job == 'popular_tags':
+        topN = [(posts, tag) for tag, posts in connection.execute(
+            'SELECT tag, posts FROM tags ORDER BY posts DESC, tag DESC '
+            'LIMIT ?', (top,))]
+        popular_tags_reducer.output(topN, writer, top)
+
+    elif job == 'average_length':
+        for row in connection.execute(
+                'SELECT thread, question_length, answer_length, answers '
+                'FROM lengths ORDER BY thread'):
+            average_length_reducer.output(row[0], row[1:], writer)
+
+    else:
+        raise ValueError('Unknown job: {0}'.format(job))
+
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and updates or outputs the state."
+    parser = argparse.ArgumentParser(
+        description='Keeps the results of every exercise up to date with '
+        'new forum dumps.')
+    parser.add_argument('command', choices=('update', 'output'),
+                        help='"update" reads a new dump, "output" outputs '
+                        'the results of an exercise.')
+    parser.add_argument('database', help='Where the state is kept.')
+    parser.add_argument('argument', nargs='?',
+                        help='For "update", the new forum_nodes.tsv '
+                        '(default: standard input). For "output", the '
+                        'exercise: {0}.'.format(', '.join(JOBS)))
+    parser.add_argument('--top', type=int,
+                        default=popular_tags_reducer.TOP_N_TAGS,
+                        help='How many tags popular_tags outputs.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'output' and args.argument not in JOBS:
+        parser.error('output needs one of: {0}'.format(', '.join(JOBS)))
+
+    connection = connect(args.database)
+    try:
+        if args.command == 'output':
+            output(connection, args.argument, args.top)
+            return
+
+        if args.argument is None:
+            stats = update(connection)
+        else:
+            with open(args.argument, encoding='utf-8') as stream:
+                stats = update(connection, stream)
+        for name in sorted(stats):
+            sys.stderr.write('{0}: {1}\n'.format(name, stats[name]))
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
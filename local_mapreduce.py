@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Runs a mapper/reducer pair on a single machine, without Hadoop.
+
+The input file is split in byte ranges aligned to record boundaries, and each
+range is handed to a mapper running in a pool of processes. Mapper outputs are
+partitioned by key and sorted in a bounded amount of memory (see `shuffle`),
+and each partition is then merged and handed to a reducer, also in parallel.
+Reducer outputs are written to ``part-NNNNN`` files in the output directory,
+just like Hadoop does.
+
+Usage is similar to the `run_mapreduce_with_common()` shell function in the
+README::
+
+    python local_mapreduce.py student_times_mapper.py \\
+        student_times_reducer.py forum_nodes.tsv student-times-output
+
+.. module:: local_mapreduce
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import glob
+import time
+import itertools
+import shlex
+import shutil
+import argparse
+import tempfile
+import importlib
+import multiprocessing
+
+from common import RecordCodec, openRange, splitRanges
+from shuffle import MAX_FAN_IN, MEMORY_BUDGET, ExternalSorter, Merger, \
+    parseSize
+from partitioner import SAMPLE_SIZE, makePartitioner, sampleKeys, skewReport
+
+
+def loadModule(name):
+    """Imports a mapper or reducer module.
+
+    :name: The module name. A script name, like "student_times_mapper.py",
+           also works.
+    :returns: The module.
+    """
+    name = os.path.basename(name)
+    if name.endswith('.py'):
+        name = name[:-3]
+    return importlib.import_module(name)
+
+
+def runModule(module, function, args):
+    """Runs a mapper or reducer on the current sys.stdin and sys.stdout.
+
+    :module: The mapper or reducer module.
+    :function: The name of the function to run when there are no arguments.
+    :args: Command line arguments. When given, they are passed to the
+           module's `main()`, just as if it had been run as a script.
+    :returns: None.
+    """
+    if not args:
+        getattr(module, function)()
+        return
+    try:
+        module.main(args)
+    except SystemExit as error:
+        # A pool worker that exits never returns its task, which would leave
+        # the job waiting for it forever
+        if error.code:
+            raise RuntimeError('{0} exited with status {1}'.format(
+                module.__name__, error.code)) from None
+
+
+def mapOutputPath(workDir, task):
+    "Where the output of a map task goes, before it is partitioned."
+    return os.path.join(workDir, 'map-{0:05d}.out'.format(task))
+
+
+def partitionPath(workDir, task, partition):
+    "Where the sorted output of a map task for a partition goes."
+    return os.path.join(workDir, 'map-{0:05d}.part-{1:05d}'.format(task,
+                                                                  partition))
+
+
+def addStats(total, stats):
+    "Adds the statistics of a task to the totals of a job."
+    for name, value in stats.items():
+        if name.endswith('fan-in'):
+            total[name] = max(total.get(name, 0), value)
+        else:
+            total[name] = total.get(name, 0) + value
+
+
+def mapTask(job):
+    """Runs a map task.
+
+    :job: A tuple with: the mapper module name, its arguments, the task
+          number, the input path, the byte range of the input to be read,
+          the work directory, how many keys to sample from the output, how
+          many fields make up a key and the RecordCodec of the output (None
+          for text).
+    :returns: The sampled keys.
+    """
+    (mapperName, mapperArgs, task, path, start, end, workDir, sampleSize,
+     keyFields, codec) = job
+
+    mapper = loadModule(mapperName)
+    outputPath = mapOutputPath(workDir, task)
+
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin = openRange(path, start, end)
+    sys.stdout = open(outputPath, 'w', encoding='utf-8')
+    try:
+        runModule(mapper, 'mapper', mapperArgs)
+    finally:
+        sys.stdin.close()
+        sys.stdout.close()
+        sys.stdin, sys.stdout = stdin, stdout
+
+    if not sampleSize:
+        return []
+    if codec is None:
+        with open(outputPath, encoding='utf-8') as output:
+            return sampleKeys(output, sampleSize, keyFields)
+    with open(outputPath, 'rb') as output:
+        return sampleKeys(codec.readFrames(output), sampleSize, keyFields,
+                          codec=codec)
+
+
+def partitionTask(job):
+    """Partitions and sorts the output of a map task.
+
+    This is the map side of the shuffle. Each partition is sorted here, so
+    that reducers only have to merge sorted files.
+
+    :job: A tuple with: the task number, the work directory, the
+          partitioner, the memory budget, the maximum merge fan-in and the
+          RecordCodec of the map output (None for text).
+    :returns: A tuple with a dict with the task's statistics and a list with
+              how many records each partition got.
+    """
+    task, workDir, partitioner, memoryBudget, maxFanIn, codec = job
+
+    partitions = partitioner.partitions
+    sorters = [ExternalSorter(memoryBudget // partitions, maxFanIn, workDir,
+                              codec)
+               for _ in range(partitions)]
+    outputPath = mapOutputPath(workDir, task)
+    mode, encoding = ('b', None) if codec is not None else ('', 'utf-8')
+    with open(outputPath, 'r' + mode, encoding=encoding) as output:
+        lines = output if codec is None else codec.readFrames(output)
+        for line in lines:
+            sorters[partitioner(line)].add(line)
+    os.remove(outputPath)
+
+    stats = {}
+    counts = []
+    for partition, sorter in enumerate(sorters):
+        with open(partitionPath(workDir, task, partition), 'w' + mode,
+                  encoding=encoding) as run:
+            run.writelines(sorter.sorted())
+        addStats(stats, dict(('map ' + name, value)
+                             for name, value in sorter.stats().items()))
+        counts.append(sorter.records)
+
+    return stats, counts
+
+
+def reduceTask(job):
+    """Merges the sorted map outputs of a partition and reduces them.
+
+    :job: A tuple with: the reducer module name, its arguments, the partition
+          number, the number of partitions, the work directory, the output
+          directory, the maximum merge fan-in and the RecordCodec of the map
+          outputs (None for text).
+    :returns: A dict with the task's statistics.
+    """
+    (reducerName, reducerArgs, partition, partitions, workDir, outputDir,
+     maxFanIn, codec) = job
+    # Like Hadoop Streaming, which exports the job's configuration
+    os.environ['mapreduce_job_reduces'] = str(partitions)
+
+    reducer = loadModule(reducerName)
+    merger = Merger(maxFanIn, workDir, codec)
+    lines = merger.merge(sorted(glob.glob(os.path.join(
+        workDir, 'map-*.part-{0:05d}'.format(partition)))), remove=True)
+    first = next(lines, None)
+
+    outputPath = os.path.join(outputDir, 'part-{0:05d}'.format(partition))
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdout = open(outputPath, 'w', encoding='utf-8')
+    try:
+        # Hadoop would run reducers on empty partitions as well, but ours
+        # always output their last state, which makes no sense without input.
+        if first is not None:
+            # Binary reducers read frames from any iterable (see
+            # `RecordCodec.readRecords()`)
+            sys.stdin = itertools.chain([first], lines)
+            runModule(reducer, 'reducer', reducerArgs)
+    finally:
+        sys.stdout.close()
+        sys.stdin, sys.stdout = stdin, stdout
+        # Let the merge clean up after itself
+        lines.close()
+
+    return {'reduce merges': merger.merges,
+            'reduce merge fan-in': merger.fanIn}
+
+
+def run(mapperName, reducerName, inputPath, outputDir, maps=None,
+        reducers=1, processes=None, mapperArgs=(), reducerArgs=(),
+        tempDir=None, memoryBudget=MEMORY_BUDGET, maxFanIn=MAX_FAN_IN,
+        partitioner='hash', keyFields=1, sampleSize=SAMPLE_SIZE,
+        binary=False):
+    """Runs a whole MapReduce job.
+
+    :mapperName: The mapper module.
+    :reducerName: The reducer module.
+    :inputPath: The input file.
+    :outputDir: Where the reducer outputs will be written. Must not exist.
+    :maps: How many map tasks to run. Defaults to the number of processes.
+    :reducers: How many reducers to run.
+    :processes: How many processes to use. Defaults to the number of CPUs.
+    :mapperArgs: Command line arguments for the mapper.
+    :reducerArgs: Command line arguments for the reducer.
+    :tempDir: Where the intermediate files go.
+    :memoryBudget: How much memory each map task can use for sorting.
+    :maxFanIn: How many sorted files can be merged at once.
+    :partitioner: How keys are assigned to reducers: "hash" or "range". See
+                  `partitioner`.
+    :keyFields: How many fields of mapper output make up the key that is
+                partitioned on. Lines are always sorted as a whole.
+    :sampleSize: How many keys to sample for the "range" partitioner.
+    :binary: Whether mappers and reducers exchange binary records. Both get
+             a "--binary" argument, and the mapper module must define the
+             RECORD_LAYOUTS of its records (see `common.RecordCodec`).
+    :returns: A dict with statistics about the job. Its "partition records"
+              entry has how many records each reducer got.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    maps = maps or processes
+    codec = None
+    if binary:
+        codec = RecordCodec(*loadModule(mapperName).RECORD_LAYOUTS)
+        mapperArgs = list(mapperArgs) + ['--binary']
+        reducerArgs = list(reducerArgs) + ['--binary']
+
+    os.makedirs(outputDir)
+    workDir = tempfile.mkdtemp(prefix='mapreduce-', dir=tempDir)
+    stats = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        start = time.time()
+        ranges = splitRanges(inputPath, maps)
+        # An empty input has no ranges at all, and no keys to sample
+        taskSample = sampleSize // max(len(ranges), 1) \
+            if partitioner == 'range' else 0
+        jobs = [(mapperName, list(mapperArgs), task, inputPath, begin, end,
+                 workDir, taskSample, keyFields, codec)
+                for task, (begin, end) in enumerate(ranges)]
+        sample = []
+        for keys in pool.map(mapTask, jobs, chunksize=1):
+            sample.extend(keys)
+        stats['map tasks'] = len(jobs)
+        stats['map seconds'] = time.time() - start
+
+        start = time.time()
+        partition = makePartitioner(partitioner, reducers, keyFields, sample,
+                                    codec)
+        jobs = [(task, workDir, partition, memoryBudget, maxFanIn, codec)
+                for task in range(len(ranges))]
+        counts = [0] * reducers
+        for taskStats, taskCounts in pool.map(partitionTask, jobs,
+                                              chunksize=1):
+            addStats(stats, taskStats)
+            counts = [total + count
+                      for total, count in zip(counts, taskCounts)]
+        stats['partition records'] = counts
+        stats['sort seconds'] = time.time() - start
+
+        start = time.time()
+        jobs = [(reducerName, list(reducerArgs), partition, reducers,
+                 workDir, outputDir, maxFanIn, codec)
+                for partition in range(reducers)]
+        for taskStats in pool.map(reduceTask, jobs, chunksize=1):
+            addStats(stats, taskStats)
+        stats['reduce tasks'] = len(jobs)
+        stats['reduce seconds'] = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(workDir)
+
+    return stats
+
+
+def main(argv=None):
+    "Parses the command line and runs the job."
+    parser = argparse.ArgumentParser(
+        description='Runs a mapper/reducer pair locally, without Hadoop.')
+    parser.add_argument('mapper', help='The mapper module or script.')
+    parser.add_argument('reducer', help='The reducer module or script.')
+    parser.add_argument('input', help='The input file.')
+    parser.add_argument('output', help='The output directory.')
+    parser.add_argument('--maps', type=int,
+                        help='How many map tasks to run.')
+    parser.add_argument('--reducers', type=int, default=1,
+                        help='How many reducers to run.')
+    parser.add_argument('--processes', type=int,
+                        help='How many processes to use.')
+    parser.add_argument('--mapper-args', default='',
+                        help='Arguments for the mapper, as a single string '
+                        '(e.g. --mapper-args=--combine).')
+    parser.add_argument('--reducer-args', default='',
+                        help='Arguments for the reducer, as a single string.')
+    parser.add_argument('--temp-dir',
+                        help='Where to keep intermediate files.')
+    parser.add_argument('--memory', type=parseSize, default=MEMORY_BUDGET,
+                        help='Sort memory budget of each map task, like '
+                        '512M. Default: 256M.')
+    parser.add_argument('--fan-in', type=int, default=MAX_FAN_IN,
+                        help='How many sorted files to merge at once.')
+    parser.add_argument('--partitioner', choices=('hash', 'range'),
+                        default='hash',
+                        help='How keys are assigned to reducers.')
+    parser.add_argument('--key-fields', type=int, default=1,
+                        help='How many fields make up the partitioning key.')
+    parser.add_argument('--sample', type=int, default=SAMPLE_SIZE,
+                        help='How many keys to sample for "range".')
+    parser.add_argument('--skew-report', action='store_true',
+                        help='Report how many records each reducer got.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Exchange binary records between mappers and '
+                        'reducers.')
+    args = parser.parse_args(argv)
+
+    stats = run(args.mapper, args.reducer, args.input, args.output,
+                maps=args.maps, reducers=args.reducers,
+                processes=args.processes,
+                mapperArgs=shlex.split(args.mapper_args),
+                reducerArgs=shlex.split(args.reducer_args),
+                tempDir=args.temp_dir, memoryBudget=args.memory,
+                maxFanIn=args.fan_in, partitioner=args.partitioner,
+                keyFields=args.key_fields, sampleSize=args.sample,
+                binary=args.binary)
+
+    counts = stats.pop('partition records')
+    for name in sorted(stats):
+        sys.stderr.write('{0}: {1}\n'.format(name, stats[name]))
+    if args.skew_report:
+        for line in skewReport(counts):
+            sys.stderr.write(line + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Partitioners: decide which reducer gets each line of mapper output.
+
+Every partitioner looks at the first `keyFields` tab-separated fields of a
+line only, while lines are always sorted as a whole (see `shuffle`). That's
+how composite keys work: study_groups, for instance, partitions on the thread
+id alone (``keyFields=1``), so that a whole thread goes to the same reducer,
+while the 'A'/'B' marker right after it still orders the question first.
+
+* `HashPartitioner` spreads keys uniformly, but a key that is very frequent
+  still lands on a single reducer.
+* `RangePartitioner` splits the key space at boundaries sampled from the
+  data, so each reducer gets about the same number of records. As a bonus,
+  reducer outputs concatenated in order are sorted.
+
+Binary mapper outputs (see `common.RecordCodec`) are partitioned on the same
+keys as their text counterparts, given the codec of the job.
+
+Run as a script, it reports how mapper output would be spread across reducers
+by each partitioner::
+
+    ./study_groups_mapper.py < forum_nodes.tsv > study-groups.map
+    python partitioner.py --reducers 8 --partitioner range study-groups.map
+
+.. module:: partitioner
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import zlib
+import bisect
+import random
+import argparse
+import fileinput
+
+# How many keys RangePartitioner samples to choose its boundaries
+SAMPLE_SIZE = 10000
+
+
+def getKey(line, keyFields=1, codec=None):
+    """Returns the key of a line of mapper output.
+
+    :line: The line.
+    :keyFields: How many fields, from the first one, make up the key.
+    :codec: The RecordCodec of the line, if it is a binary frame.
+    :returns: The key, with its fields still separated by tabs.
+    """
+    if codec is not None:
+        fields = codec.decode(line)[:keyFields]
+        return '\t'.join(str(field) for field in fields)
+    fields = line.rstrip('\n').split('\t', keyFields)
+    return '\t'.join(fields[:keyFields])
+
+
+class HashPartitioner(object):
+    """Sends each key to a reducer chosen by a hash of the key."""
+
+    def __init__(self, partitions, keyFields=1, codec=None):
+        """Creates the partitioner.
+
+        :partitions: How many reducers there are.
+        :keyFields: How many fields, from the first one, make up the key.
+        :codec: The RecordCodec of the lines, if they are binary frames.
+        """
+        self.partitions = partitions
+        self.keyFields = keyFields
+        self.codec = codec
+
+    def __call__(self, line):
+        """Returns the reducer that gets a line.
+
+        Python's own hash() can't be used here: it changes from a process to
+        another, and every map task must agree on where each key goes.
+        """
+        key = getKey(line, self.keyFields, self.codec)
+        return zlib.crc32(key.encode('utf-8')) % self.partitions
+
+
+class RangePartitioner(object):
+    """Sends each key to the reducer whose range of keys contains it."""
+
+    def __init__(self, boundaries, keyFields=1, codec=None):
+        """Creates the partitioner.
+
+        :boundaries: Sorted list of keys. Reducer i gets the keys k such that
+                     boundaries[i - 1] <= k < boundaries[i].
+        :keyFields: How many fields, from the first one, make up the key.
+        :codec: The RecordCodec of the lines, if they are binary frames.
+        """
+        self.boundaries = boundaries
+        self.partitions = len(boundaries) + 1
+        self.keyFields = keyFields
+        self.codec = codec
+
+    def __call__(self, line):
+        "Returns the reducer that gets a line."
+        return bisect.bisect_right(self.boundaries,
+                                   getKey(line, self.keyFields, self.codec))
+
+    @classmethod
+    def fromSample(cls, keys, partitions, keyFields=1, codec=None):
+        """Creates a partitioner whose boundaries split a sample evenly.
+
+        The sample should have one key per *record*, not per distinct key, so
+        that frequent keys weigh more when boundaries are chosen.
+
+        :keys: The sampled keys.
+        :partitions: How many reducers there are.
+        :keyFields: How many fields, from the first one, make up the key.
+        :codec: The RecordCodec of the lines, if they are binary frames.
+        :returns: The partitioner.
+        """
+        keys = sorted(keys)
+        # A key can't be split across reducers, so when a key takes more
+        # than a partition's worth of the sample, some boundaries repeat and
+        # the reducers between them get nothing.
+        boundaries = [keys[i * len(keys) // partitions] if keys else ''
+                      for i in range(1, partitions)]
+        return cls(boundaries, keyFields, codec)
+
+
+def sampleKeys(lines, size=SAMPLE_SIZE, keyFields=1, rng=random, codec=None):
+    """Samples the keys of some lines uniformly (reservoir sampling).
+
+    :lines: The lines.
+    :size: How many keys to sample.
+    :keyFields: How many fields, from the first one, make up the key.
+    :rng: The random number generator.
+    :codec: The RecordCodec of the lines, if they are binary frames.
+    :returns: A list with at most `size` keys.
+    """
+    sample = []
+    for seen, line in enumerate(lines):
+        if seen < size:
+            sample.append(getKey(line, keyFields, codec))
+        else:
+            position = rng.randint(0, seen)
+            if position < size:
+                sample[position] = getKey(line, keyFields, codec)
+    return sample
+
+
+def skewReport(counts):
+    """Describes how records are spread across reducers.
+
+    :counts: How many records each reducer gets.
+    :returns: A list of lines (without newlines) with one line per reducer
+              and a summary. The skew is the ratio between the largest and
+              the average partition: 1.0 is a perfect spread.
+    """
+    total = sum(counts)
+    mean = total / len(counts) if counts else 0
+    lines = ['partition\trecords\tshare']
+    for partition, count in enumerate(counts):
+        share = count / total if total else 0
+        lines.append('{0}\t{1}\t{2:.2%}'.format(partition, count, share))
+    skew = max(counts) / mean if mean else 0
+    lines.append('total\t{0}\tskew {1:.2f}'.format(total, skew))
+    return lines
+
+
+def makePartitioner(kind, partitions, keyFields=1, sample=None, codec=None):
+    """Builds a partitioner by name.
+
+    :kind: Either "hash" or "range".
+    :partitions: How many reducers there are.
+    :keyFields: How many fields, from the first one, make up the key.
+    :sample: Keys sampled from the data. Required by "range".
+    :codec: The RecordCodec of the lines, if they are binary frames.
+    :returns: The partitioner.
+    :raises ValueError: For unknown kinds.
+    """
+    if kind == 'hash':
+        return HashPartitioner(partitions, keyFields, codec)
+    elif kind == 'range':
+        return RangePartitioner.fromSample(sample or [], partitions,
+                                           keyFields, codec)
+    raise ValueError('Unknown partitioner: {0}'.format(kind))
+
+
+def main(argv=None):
+    "Reports how mapper output files would be spread across reducers."
+    parser = argparse.ArgumentParser(
+        description='Reports how mapper output would be partitioned.')
+    parser.add_argument('files', nargs='+', help='Mapper output files.')
+    parser.add_argument('--reducers', type=int, default=4,
+                        help='How many reducers there are.')
+    parser.add_argument('--partitioner', choices=('hash', 'range'),
+                        default='hash', help='Which partitioner to use.')
+    parser.add_argument('--key-fields', type=int, default=1,
+                        help='How many fields make up the key.')
+    parser.add_argument('--sample', type=int, default=SAMPLE_SIZE,
+                        help='How many keys to sample for "range".')
+    args = parser.parse_args(argv)
+
+    sample = None
+    if args.partitioner == 'range':
+        with fileinput.input(args.files) as lines:
+            sample = sampleKeys(lines, args.sample, args.key_fields)
+    partitioner = makePartitioner(args.partitioner, args.reducers,
+                                  args.key_fields, sample)
+
+    counts = [0] * partitioner.partitions
+    with fileinput.input(args.files) as lines:
+        for line in lines:
+            counts[partitioner(line)] += 1
+
+    for line in skewReport(counts):
+        print(line)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
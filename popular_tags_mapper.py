@@ -4,40 +4,159 @@
 from __future__ import print_function
 
 import sys
-import csv
+import math
+import heapq
+import argparse
+from operator import itemgetter
 
-from common import getField, isValidNodeLine
+from common import RecordWriter, SpaceSaving, addCounter, \
+    addInstrumentationArguments, instrumented, loadNodes, mapFile
 
-def mapper():
+# The only field we're interested in
+FIELDS = ('tagnames',)
+
+# Memory budget of the tag counter. See `TagCounter`. {{{
+MAX_ENTRIES = 100000
+MAX_BYTES = 64 * 1024 * 1024
+# Rough cost of a dict entry and of the int it holds, besides the tag itself
+ENTRY_OVERHEAD = 100
+# Which fraction of the counts is output when the budget is exhausted
+EVICT_FRACTION = 0.5
+# }}}
+
+# Approximate mode. See `approximateMapper()`. {{{
+# Key of the line holding a mapper's summary. Tags are never empty, so this
+# can't be a tag. Must match the reducer's.
+SUMMARY_KEY = ''
+# }}}
+
+
+class TagCounter(object):
+    """Counts tags in a bounded amount of memory.
+
+    When either the number of tags or (an estimate of) the memory they take
+    reaches the budget, the least frequent tags are output and forgotten.
+    Frequent tags stay, since that's where counting in the mapper saves the
+    most. Output counts are partial, but so are the counts coming from
+    different mappers: the reducer adds everything up anyway. See the note in
+    `mapper()`.
+    """
+
+    def __init__(self, emit, maxEntries=MAX_ENTRIES, maxBytes=MAX_BYTES):
+        """Creates an empty counter.
+
+        :emit: Function called with (tag, amount) to output a count, like
+               the `write()` of a RecordWriter.
+        :maxEntries: How many distinct tags can be held at once.
+        :maxBytes: How many bytes (estimated) the tags can take.
+        """
+        self.counts = {}
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.emit = emit
+        self.bytes = 0
+        # Instrumentation. {{{
+        self.flushes = 0
+        self.peakEntries = 0
+        # }}}
+
+    def add(self, tag):
+        "Counts one more occurrence of a tag."
+        counts = self.counts
+        if tag in counts:
+            counts[tag] += 1
+            return
+
+        if len(counts) >= self.maxEntries or self.bytes >= self.maxBytes:
+            self.evict()
+
+        counts[tag] = 1
+        self.bytes += sys.getsizeof(tag) + ENTRY_OVERHEAD
+        if len(counts) > self.peakEntries:
+            self.peakEntries = len(counts)
+
+    def evict(self):
+        "Outputs and forgets the least frequent tags."
+        amount = max(1, int(len(self.counts) * EVICT_FRACTION))
+        for tag, count in heapq.nsmallest(amount, self.counts.items(),
+                                          key=itemgetter(1)):
+            self.emit(tag, count)
+            del self.counts[tag]
+            self.bytes -= sys.getsizeof(tag) + ENTRY_OVERHEAD
+        self.flushes += 1
+
+    def flush(self):
+        "Outputs and forgets every tag."
+        for tag, count in self.counts.items():
+            self.emit(tag, count)
+        self.counts.clear()
+        self.bytes = 0
+
+
+def reportCounters(tagCounter):
+    """Adds the tag counter's instrumentation to the run's counters, if it is
+    instrumented (see `common.instrumented()`).
+
+    :tagCounter: The TagCounter used by the mapper.
+    """
+    addCounter('Flushes', tagCounter.flushes)
+    addCounter('Peak entries', tagCounter.peakEntries)
+
+
+def approximateMapper(errorRate, writer, cache=None):
+    """Summarises the tags with Space-Saving instead of counting them all.
+
+    The mapper outputs a single line, with SUMMARY_KEY and the summary, no
+    matter how many distinct tags it saw. The reducer merges the summaries of
+    all mappers. See `common.SpaceSaving`.
+
+    :errorRate: How much a count may be overestimated, as a fraction of the
+                number of tags the mapper saw.
+    :writer: The RecordWriter to output to.
+    :cache: A cache to read nodes from, as in `mapper()`.
+    """
+    summary = SpaceSaving(int(math.ceil(1 / errorRate)))
+    for tags, in loadNodes(FIELDS, cache):
+        for tag in tags.split():
+            summary.add(tag)
+    writer.write(SUMMARY_KEY, summary.dumps())
+
+
+def mapper(maxEntries=MAX_ENTRIES, maxBytes=MAX_BYTES, cache=None,
+           approximate=None):
     """Mapper function.
 
     Input is read from sys.stdin and written to sys.stdout. Both streams can be
     overwritten if needed.
 
+    :maxEntries: How many distinct tags can be counted in memory at once.
+    :maxBytes: How many bytes the tags counted in memory can take.
+    :cache: A cache to read nodes from instead of sys.stdin, if it is fresh.
+            See `common.loadNodes()`.
+    :approximate: If given, the error rate of `approximateMapper()`, which
+                  is used instead.
     :returns: Nothing. Writes to standard output.
     """
 
     # The input file is saved as a tab-separated file. The data itself comes
     # from http://content.udacity-data.com/course/hadoop/forum_data.tar.gz --
-    # file "forum_nodes.tsv".
-    reader = csv.reader(sys.stdin, delimiter='\t')
+    # file "forum_nodes.tsv". readNodes parses it and drops the invalid lines.
 
-    # Dictionary that will hold the count of tags
-    tagDict = {}
-    for line in reader:
-        # Basic data sanity check
-        if not isValidNodeLine(line):
-            continue
+    writer = RecordWriter()
 
-        tags = getField(line, 'tagnames')
-        if tags is None:
-            continue
+    if approximate is not None:
+        approximateMapper(approximate, writer, cache)
+        writer.flush()
+        return
 
-        # Every tag gets added to the dictionary. If it doesn't exist yet, it
+    # Will hold the count of tags
+    tagCounter = TagCounter(writer.write, maxEntries, maxBytes)
+    for tags, in loadNodes(FIELDS, cache):
+        # Every tag gets added to the counter. If it doesn't exist yet, it
         # is added with value 1. Otherwise, its current value is incremented.
         tags = tags.split()
         for tag in tags:
-            tagDict[tag] = tagDict.get(tag, 0) + 1
+            tagCounter.add(tag)
 
     # NOTE: Funny thing happening here. We *cannot use* the top-N pattern
     # explained in class! Suppose the following example: we want the top 1
@@ -68,11 +187,16 @@ def mapper():
     #   tag2 = 400
     #   tag2 = 900
     # Now it would be able to reduce correctly and output the top 1 tag, tag2.
+    #
+    # That's also why the tag counter is allowed to output partial counts
+    # when it runs out of memory: to the reducer, they're no different from
+    # the counts of yet another mapper.
 
     # We print everything we got. Can be out of order, Hadoop will sort it for
     # us.
-    for tag in tagDict.items():
-        print('%s\t%s' % tag)
+    tagCounter.flush()
+    writer.flush()
+    reportCounters(tagCounter)
 
     # Addendum:
     # Had I used the top N pattern, I would have defined a top-level function
@@ -93,7 +217,7 @@ def mapper():
     # Then, instead of printing all the tags, I would have defined
     # a mostFrequent list like this:
     #
-    #  mostFrequent = sorted(list(tagDict.items()), cmp=comparator)
+    #  mostFrequent = sorted(list(tagCounter.counts.items()), cmp=comparator)
     #
     # Last, but not least, I would have printed the output like this:
     #
@@ -101,6 +225,50 @@ def mapper():
     #   print('%s\t%s' % tag)
 
 
+def main(argv=None):
+    "Parses the command line and runs the mapper."
+    parser = argparse.ArgumentParser(
+        description='Mapper for the Top Tags exercise.')
+    parser.add_argument('--max-entries', type=int, default=MAX_ENTRIES,
+                        help='How many distinct tags to count in memory.')
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES,
+                        help='How much memory the tags counted can take.')
+    parser.add_argument('--cache',
+                        help='Read nodes from this cache (see build_cache.py) '
+                        'instead of standard input, if it is fresh.')
+    parser.add_argument('--approximate', type=float, metavar='ERROR',
+                        help='Output a summary of the most frequent tags, '
+                        'whose counts may be overestimated by at most this '
+                        'fraction of all tags (like 0.001).')
+    parser.add_argument('input', nargs='?',
+                        help='Read nodes from this file instead of standard '
+                        'input, splitting it among --workers processes.')
+    parser.add_argument('--workers', type=int,
+                        help='How many processes to use when given a file. '
+                        'Default: one per CPU.')
+    addInstrumentationArguments(parser)
+    # Flushes and peak entries are counters like any other now
+    parser.add_argument('--report', action='store_true', dest='counters',
+                        help='Same as --counters.')
+    args = parser.parse_args(argv)
+
+    if args.input is not None and args.cache is not None:
+        parser.error('--cache holds the whole input and cannot be split '
+                     'among workers')
+
+    if args.approximate is not None and not 0 < args.approximate < 1:
+        parser.error('--approximate must be between 0 and 1')
+
+    with instrumented('popular_tags_mapper', args.counters, args.stats,
+                      args.profile):
+        if args.input is None:
+            mapper(args.max_entries, args.max_bytes, args.cache,
+                   args.approximate)
+        else:
+            mapFile(args.input, args.workers, mapper, args.max_entries,
+                    args.max_bytes, approximate=args.approximate)
+
+
 if __name__ == '__main__':
-    mapper()
+    main()
 
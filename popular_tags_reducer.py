@@ -5,6 +5,18 @@
 
 .. _Top Tags: https://www.udacity.com/course/viewer#!/c-ud617/l-717558831/m-700468914
 
+Top tags are found in two stages, so that the job can run with many
+reducers. Tags are hash-partitioned, so each reducer sees every count of its
+tags and outputs its own top N with their exact totals. Each tag of the
+overall top N is also in the top N of its partition, so merging the outputs
+of all reducers with ``--merge`` gives the exact overall top N::
+
+    cat popular-tags-output/part-* | python popular_tags_reducer.py --merge
+
+With ``--approximate``, the reducer merges the Space-Saving summaries output
+by ``popular_tags_mapper.py --approximate`` instead, and outputs the count of
+each tag along with how much it may be overestimated.
+
 .. module:: popular_tags_reducer
 .. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
 """
@@ -13,10 +25,17 @@ from __future__ import print_function
 
 import sys
 import heapq
+import argparse
+
+from common import RecordWriter, SpaceSaving, addInstrumentationArguments, \
+    drop, instrumented, timed
 
-# Constant that indicates the amount of tags we want to output
+# The amount of tags we want to output, by default
 TOP_N_TAGS = 10
 
+# Key of the lines holding the mappers' summaries. Must match the mapper's.
+SUMMARY_KEY = ''
+
 def getData(line):
     "Basic sanity checking function. Gets the data for this reducer."
 
@@ -38,34 +57,38 @@ def getData(line):
     return tag, amount
 
 
-def update(topN, tag, amount):
+def update(topN, tag, amount, n=TOP_N_TAGS):
     """Updates the topN heap with the new tag.
 
     :topN: The heap we're maintaining.
     :tag: The tag to be added.
     :amount: The number of times this tag appears.
+    :n: How many tags the heap keeps.
     :returns: None
 
     """
     heapq.heappush(topN, (amount, tag))
-    if len(topN) > TOP_N_TAGS:
+    if len(topN) > n:
         heapq.heappop(topN)
 
 
-def output(topN):
+def output(topN, writer, n=TOP_N_TAGS):
     """Outputs the TOP N fields in the heap in ascending order.
 
     :topN: The heap to be iterated on.
+    :writer: The RecordWriter to output to.
+    :n: How many tags to output.
     :returns: None
 
     """
-    for elem in heapq.nsmallest(TOP_N_TAGS, topN):
-        print('{0}\t{1}'.format(elem[1], elem[0]))
+    for elem in heapq.nsmallest(n, topN):
+        writer.write(elem[1], elem[0])
 
 
-def reducer():
+def reducer(n=TOP_N_TAGS):
     """Reducer function.
 
+    :n: How many tags to output.
     :returns: Nothing. Writes to standard output.
     """
 
@@ -73,9 +96,10 @@ def reducer():
     topN = []
     lastTag = None
     lastAmount = 0
-    for line in sys.stdin:
+    for line in timed(sys.stdin, 'read'):
         data = getData(line)
         if data is None:
+            drop('malformed record')
             continue
 
         tag, amount = data
@@ -88,17 +112,108 @@ def reducer():
             # info about it before. In other words, if this is the first tag,
             # there's no need to add anything to the heap yet.
             if lastTag is not None:
-                update(topN, lastTag, lastAmount)
+                update(topN, lastTag, lastAmount, n)
                 lastAmount = 0
 
         lastTag = tag
         lastAmount += amount
 
-    # We exited the loop with remaining state. Update it.
-    update(topN, lastTag, lastAmount)
+    # We exited the loop with remaining state. Update it (unless this
+    # partition got no tags at all).
+    if lastTag is not None:
+        update(topN, lastTag, lastAmount, n)
+
+    # And now we have our top N (in a bounded amount of memory! \o/)
+    writer = RecordWriter()
+    output(topN, writer, n)
+    writer.flush()
+
+
+def merge(n=TOP_N_TAGS):
+    """Merges the outputs of many reducers into the overall top N.
+
+    Each tag must come from a single reducer, with its total, as `reducer()`
+    outputs them. The input doesn't have to be sorted.
+
+    :n: How many tags to output.
+    :returns: Nothing. Writes to standard output.
+    """
+    topN = []
+    for line in timed(sys.stdin, 'read'):
+        data = getData(line)
+        if data is None:
+            drop('malformed record')
+            continue
+        tag, amount = data
+        update(topN, tag, amount, n)
+
+    writer = RecordWriter()
+    output(topN, writer, n)
+    writer.flush()
+
+
+def approximateReducer(n=TOP_N_TAGS):
+    """Merges the summaries of the mappers and outputs the top N tags.
+
+    Each tag is output with its count and the most that count may be
+    overestimated by, in ascending order of counts, like `reducer()` does.
+    Lines that are not summaries are ignored.
+
+    :n: How many tags to output.
+    :returns: Nothing. Writes to standard output.
+    """
+    summary = None
+    for line in timed(sys.stdin, 'read'):
+        key, _, value = line.rstrip('\n').partition('\t')
+        if key != SUMMARY_KEY:
+            drop('not a summary')
+            continue
+        try:
+            other = SpaceSaving.loads(value)
+        except (ValueError, KeyError, TypeError):
+            # Not a summary. Ignore this line.
+            drop('not a summary')
+            continue
+        if summary is None:
+            summary = other
+        else:
+            summary.merge(other)
+
+    if summary is None:
+        return
+
+    writer = RecordWriter()
+    for tag, count, error in reversed(summary.top(n)):
+        writer.write(tag, count, error)
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the reducer or the merge step."
+    parser = argparse.ArgumentParser(
+        description='Reducer for the Top Tags exercise.')
+    parser.add_argument('--top', type=int, default=TOP_N_TAGS,
+                        help='How many tags to output.')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the outputs of many reducers instead.')
+    parser.add_argument('--approximate', action='store_true',
+                        help='Merge the summaries output by the mapper in '
+                        'approximate mode.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.top < 1:
+        parser.error('--top must be at least 1')
+
+    with instrumented('popular_tags_reducer', args.counters, args.stats,
+                      args.profile):
+        if args.approximate:
+            approximateReducer(args.top)
+        elif args.merge:
+            merge(args.top)
+        else:
+            reducer(args.top)
 
-    # And now we have our top 10 (in a bounded amount of memory! \o/)
-    output(topN)
 
 if __name__ == '__main__':
-    reducer()
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""External merge sort for mapper outputs: the "shuffle" Hadoop does for us.
+
+Lines are sorted in memory until a memory budget is exhausted, at which point
+they are spilled to a temporary file (a "run"). In the end, all runs are
+merged with `heapq.merge`. If there are too many runs to merge at once, they
+are merged in several passes.
+
+Lines are compared as a whole. Since every mapper here outputs the key first
+and the marker (the 'A' or 'B' some of them use) right after it, lines with
+the same key are grouped together and the markers come in the order reducers
+expect.
+
+Binary mapper outputs (see `common.RecordCodec`) are sorted by their decoded
+records instead, given the codec of the job.
+
+It can also be used as a replacement for `sort` in a pipeline::
+
+    ./study_groups_mapper.py < forum_nodes.tsv | python shuffle.py \\
+        --memory 512M | ./study_groups_reducer.py
+
+.. module:: shuffle
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import heapq
+import argparse
+import tempfile
+import contextlib
+
+from common import RecordCodec
+
+# How much memory lines being sorted can take before being spilled to disk
+MEMORY_BUDGET = 256 * 1024 * 1024
+# How many runs are merged at once, at most
+MAX_FAN_IN = 64
+
+# Multipliers for the suffixes parseSize understands
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parseSize(size):
+    """Parses a size like "512M" into a number of bytes.
+
+    :size: A number, optionally followed by K, M or G.
+    :returns: The number of bytes.
+    :raises ValueError: When the size can't be parsed.
+    """
+    size = size.strip().upper()
+    multiplier = SIZE_SUFFIXES.get(size[-1:], 1)
+    if multiplier != 1:
+        size = size[:-1]
+    return int(size) * multiplier
+
+
+def writeRun(lines, tempDir=None, binary=False):
+    """Writes sorted lines to a new temporary file.
+
+    :lines: The lines, already sorted.
+    :tempDir: Where to create the file.
+    :binary: Whether the lines are binary frames.
+    :returns: The path of the file.
+    """
+    descriptor, path = tempfile.mkstemp(prefix='run-', dir=tempDir)
+    with os.fdopen(descriptor, 'wb' if binary else 'w',
+                   encoding=None if binary else 'utf-8') as run:
+        run.writelines(lines)
+    return path
+
+
+class Merger(object):
+    """Merges sorted files, never opening more than `maxFanIn` at once."""
+
+    def __init__(self, maxFanIn=MAX_FAN_IN, tempDir=None, codec=None):
+        """Creates a merger.
+
+        :maxFanIn: How many files can be merged at once.
+        :tempDir: Where the intermediate runs go.
+        :codec: The RecordCodec of the files, if they hold binary frames.
+        """
+        self.maxFanIn = max(2, maxFanIn)
+        self.tempDir = tempDir
+        self.codec = codec
+        # Instrumentation. {{{
+        self.merges = 0
+        self.fanIn = 0
+        # }}}
+
+    def merge(self, paths, extra=None, remove=False):
+        """Merges sorted files.
+
+        :paths: The files to be merged.
+        :extra: A list of sorted lines to be merged as well, if any.
+        :remove: Whether the files can be removed once they have been merged.
+        :returns: A generator of sorted lines.
+        """
+        paths = list(paths)
+        # Files that can be removed once merged. Intermediate runs always can.
+        disposable = set(paths) if remove else set()
+
+        # Merge the first runs into a bigger one until what's left can be
+        # merged at once.
+        while len(paths) + (extra is not None) > self.maxFanIn:
+            group, paths = paths[:self.maxFanIn], paths[self.maxFanIn:]
+            run = writeRun(self._merge(group, None, disposable), self.tempDir,
+                           self.codec is not None)
+            disposable.add(run)
+            paths.append(run)
+
+        return self._merge(paths, extra, disposable)
+
+    def _merge(self, paths, extra, disposable):
+        "Merges files (and extra lines). See `merge()`."
+        if self.codec is None:
+            runs = [open(path, encoding='utf-8') for path in paths]
+            sources = runs + ([extra] if extra is not None else [])
+            key = None
+        else:
+            runs = [open(path, 'rb') for path in paths]
+            sources = [self.codec.readFrames(run) for run in runs]
+            sources += [extra] if extra is not None else []
+            key = self.codec.decode
+        self.fanIn = max(self.fanIn, len(sources))
+        self.merges += 1
+        try:
+            for line in heapq.merge(*sources, key=key):
+                yield line
+        finally:
+            for run in runs:
+                run.close()
+            for path in paths:
+                if path in disposable:
+                    os.remove(path)
+
+
+class ExternalSorter(object):
+    """Sorts lines in a bounded amount of memory, spilling runs to disk."""
+
+    def __init__(self, memoryBudget=MEMORY_BUDGET, maxFanIn=MAX_FAN_IN,
+                 tempDir=None, codec=None):
+        """Creates an empty sorter.
+
+        :memoryBudget: How many bytes of lines can be held in memory.
+        :maxFanIn: How many runs can be merged at once.
+        :tempDir: Where the runs go.
+        :codec: The RecordCodec of the lines, if they are binary frames.
+        """
+        self.memoryBudget = memoryBudget
+        self.tempDir = tempDir
+        self.codec = codec
+        self.key = None if codec is None else codec.decode
+        self.merger = Merger(maxFanIn, tempDir, codec)
+        self.lines = []
+        self.size = 0
+        self.runs = []
+        # Instrumentation. {{{
+        self.records = 0
+        self.spills = 0
+        # }}}
+
+    def add(self, line):
+        "Adds a line to be sorted."
+        self.lines.append(line)
+        self.size += sys.getsizeof(line)
+        self.records += 1
+        if self.size >= self.memoryBudget:
+            self.spill()
+
+    def extend(self, lines):
+        "Adds many lines to be sorted."
+        for line in lines:
+            self.add(line)
+
+    def spill(self):
+        "Sorts the lines in memory and writes them to a new run."
+        if not self.lines:
+            return
+        self.lines.sort(key=self.key)
+        self.runs.append(writeRun(self.lines, self.tempDir,
+                                  self.codec is not None))
+        self.lines = []
+        self.size = 0
+        self.spills += 1
+
+    def sorted(self):
+        """Returns every line added, sorted.
+
+        Lines still in memory are not spilled: they're merged with the runs
+        directly. The sorter should not be used after this is called.
+
+        :returns: A generator of sorted lines.
+        """
+        self.lines.sort(key=self.key)
+        lines, self.lines = self.lines, []
+        if not self.runs:
+            return iter(lines)
+        runs, self.runs = self.runs, []
+        return self.merger.merge(runs, lines, remove=True)
+
+    def stats(self):
+        "Returns a dict with the sorter's instrumentation."
+        return {'records': self.records,
+                'spills': self.spills,
+                'merges': self.merger.merges,
+                'merge fan-in': self.merger.fanIn}
+
+
+def shuffle(streams, memoryBudget=MEMORY_BUDGET, maxFanIn=MAX_FAN_IN,
+            tempDir=None, codec=None):
+    """Sorts the lines of many mapper outputs together.
+
+    :streams: Iterables of lines, like mapper output files. With a codec,
+              binary streams of frames instead.
+    :memoryBudget: How many bytes of lines can be held in memory.
+    :maxFanIn: How many runs can be merged at once.
+    :tempDir: Where the runs go.
+    :codec: The RecordCodec of the streams, if they hold binary frames.
+    :returns: A tuple with a generator of sorted lines and the sorter, whose
+              statistics are final once the generator is exhausted.
+    """
+    sorter = ExternalSorter(memoryBudget, maxFanIn, tempDir, codec)
+    for stream in streams:
+        sorter.extend(stream if codec is None else codec.readFrames(stream))
+    return sorter.sorted(), sorter
+
+
+def main(argv=None):
+    "Sorts files (or standard input) to standard output."
+    parser = argparse.ArgumentParser(
+        description='Sorts mapper outputs in a bounded amount of memory.')
+    parser.add_argument('files', nargs='*',
+                        help='Files to sort. Default: standard input.')
+    parser.add_argument('--memory', type=parseSize,
+                        default=MEMORY_BUDGET,
+                        help='Memory budget, like 512M. Default: 256M.')
+    parser.add_argument('--fan-in', type=int, default=MAX_FAN_IN,
+                        help='How many runs to merge at once, at most.')
+    parser.add_argument('--temp-dir', help='Where to spill runs to.')
+    parser.add_argument('--report', action='store_true',
+                        help='Report spills and merge fan-in on stderr.')
+    parser.add_argument('--binary', metavar='LAYOUT', nargs='+',
+                        help='Sort binary records with these layouts, like '
+                        '"nB" (see common.RecordCodec).')
+    args = parser.parse_args(argv)
+
+    codec = RecordCodec(*args.binary) if args.binary else None
+    mode, encoding = ('r', 'utf-8') if codec is None else ('rb', None)
+    with contextlib.ExitStack() as stack:
+        streams = [stack.enter_context(open(path, mode, encoding=encoding))
+                   for path in args.files] or [sys.stdin]
+        lines, sorter = shuffle(streams, args.memory, args.fan_in,
+                                args.temp_dir, codec)
+        output = sys.stdout if codec is None else sys.stdout.buffer
+        output.writelines(lines)
+
+    if args.report:
+        stats = sorter.stats()
+        for name in sorted(stats):
+            sys.stderr.write('{0}: {1}\n'.format(name, stats[name]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,11 +11,39 @@
 
 from __future__ import print_function
 
-import sys
-import csv
+import argparse
 from datetime import datetime
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by parseHours()
+    np = None
+
+from common import RecordCodec, RecordWriter, addInstrumentationArguments, \
+    drop, instrumented, loadNodes, mapFile
+
+# The fields we're interested in
+FIELDS = ('author_id', 'added_at')
+
+# Layout of our records in binary mode: author id and hour. See RecordCodec.
+RECORD_LAYOUTS = ('nB',)
+CODEC = RecordCodec(*RECORD_LAYOUTS)
+
+# Formats of the dates in forum_nodes.tsv, and of their first 13 characters
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+PREFIX_FORMAT = "%Y-%m-%d %H"
+
+# How many date prefixes (see `parsePrefix()`) are remembered
+PREFIX_CACHE_SIZE = 4096
+
+# How many dates the mapper converts at once when using NumPy
+BATCH_SIZE = 65536
+
+# Days in each month of a non-leap year
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
 
-from common import getField, isValidNodeLine
 
 def parseDate(dateRead):
     """Parses the date we just read.
@@ -24,44 +52,208 @@ def parseDate(dateRead):
     :returns: A datetime object representing the date we read.
 
     """
-    if '.' in dateRead:
-        # Fractions of a second don't matter to us
-        date = dateRead.split('.')[0]
+    # Fractions of a second don't matter to us
+    date = dateRead.split('.')[0]
 
     try:
-        return datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        return datetime.strptime(date, DATE_FORMAT)
     except ValueError:
         return None
 
 
-def mapper():
+@lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def parsePrefix(prefix):
+    """Parses the "YYYY-MM-DD HH" part of a date.
+
+    Posts made in the same hour share this part, so we parse it only once.
+
+    :prefix: The first 13 characters of a date.
+    :returns: The hour, or None if the prefix is not a valid date and hour.
+    """
+    try:
+        return datetime.strptime(prefix, PREFIX_FORMAT).hour
+    except ValueError:
+        return None
+
+
+def parseHour(dateRead):
+    """Returns the hour of the date we just read.
+
+    This is the same as `parseDate(dateRead).hour`, but dates in the format
+    forum_nodes.tsv uses ("2012-02-25 08:09:06.787181+00") are sliced instead
+    of being parsed. Their "YYYY-MM-DD HH" part is validated by `parsePrefix()`
+    (and cached), and the minutes and seconds are checked here. Anything else
+    goes through `parseDate()`.
+
+    :dateRead: The date we read.
+    :returns: The hour, or None if the date is not valid.
+    """
+    if (len(dateRead) >= 19 and
+            dateRead[4] == '-' and dateRead[7] == '-' and
+            dateRead[10] == ' ' and dateRead[13] == ':' and
+            dateRead[16] == ':' and dateRead[19:20] in ('', '.')):
+        minutes = dateRead[14:16]
+        seconds = dateRead[17:19]
+        if (minutes.isdecimal() and seconds.isdecimal() and
+                int(minutes) < 60 and int(seconds) < 60):
+            hour = parsePrefix(dateRead[:13])
+            if hour is not None:
+                return hour
+
+    # Not the format we expect. Let strptime decide.
+    date = parseDate(dateRead)
+    return None if date is None else date.hour
+
+
+def parseHours(dates):
+    """Returns the hours of many dates at once, using NumPy.
+
+    Dates in the format forum_nodes.tsv uses are converted and validated
+    (including the number of days of each month) as arrays. Whatever doesn't
+    look like that format is handed to `parseHour()`, so the results are the
+    same as calling it for every date.
+
+    :dates: A list of dates.
+    :returns: A list with the hour of each date, or None for invalid dates.
+    """
+    if not dates:
+        return []
+
+    # One row per date, one column per character (as code points). Longer
+    # dates are truncated, but we only look at the first 20 characters.
+    chars = np.array(dates, dtype='U20').view(np.uint32).reshape(
+        len(dates), 20).astype(np.int64)
+
+    def number(start, end):
+        "The integer formed by the digits in columns [start, end)."
+        value = np.zeros(len(dates), dtype=np.int64)
+        for column in range(start, end):
+            value = value * 10 + chars[:, column] - ord('0')
+        return value
+
+    digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]]
+    valid = ((digits >= ord('0')) & (digits <= ord('9'))).all(axis=1)
+    valid &= (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-'))
+    valid &= chars[:, 10] == ord(' ')
+    valid &= (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+    # Either the date ends here, or the fractions of a second start here
+    valid &= (chars[:, 19] == 0) | (chars[:, 19] == ord('.'))
+
+    year = number(0, 4)
+    month = number(5, 7)
+    day = number(8, 10)
+    hour = number(11, 13)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    monthIndex = np.clip(month - 1, 0, 11)
+    days = np.array(DAYS_IN_MONTH)[monthIndex] + ((month == 2) & leap)
+
+    valid &= (year >= 1) & (month >= 1) & (month <= 12)
+    valid &= (day >= 1) & (day <= days)
+    valid &= (hour < 24) & (number(14, 16) < 60) & (number(17, 19) < 60)
+
+    # Rows that failed might still be dates in a format we didn't expect
+    return [int(h) if ok else parseHour(date)
+            for h, ok, date in zip(hour.tolist(), valid.tolist(), dates)]
+
+
+def mapper(batch=False, binary=False, cache=None):
     """Mapper function.
 
     Input is read from sys.stdin and written to sys.stdout. Both streams can be
     overwritten if needed.
 
+    :batch: Whether to convert dates in batches, with NumPy.
+    :binary: Whether to output binary records instead of text. Hadoop
+             Streaming only handles text.
+    :cache: A cache to read nodes from instead of sys.stdin, if it is fresh.
+            See `common.loadNodes()`.
     :returns: Nothing. Writes to standard output.
     """
+    writer = RecordWriter(codec=CODEC if binary else None)
 
-    # The input file is saved as a tab-separated file. The data itself comes from
-    # http://content.udacity-data.com/course/hadoop/forum_data.tar.gz -- file
-    # "forum_nodes.tsv".
-    reader = csv.reader(sys.stdin, delimiter='\t')
-
-    for line in reader:
-        # Basic data sanity check
-        if not isValidNodeLine(line):
-            continue
+    # The input file is saved as a tab-separated file. The data itself comes
+    # from http://content.udacity-data.com/course/hadoop/forum_data.tar.gz --
+    # file "forum_nodes.tsv". readNodes parses it and drops the invalid lines.
+    if batch:
+        batchMapper(writer.write, cache)
+        writer.flush()
+        return
 
-        author = getField(line, 'author_id')
-        date = parseDate(getField(line, 'added_at'))
+    for author, date in loadNodes(FIELDS, cache):
+        hour = parseHour(date)
 
-        if date is None or author is None:
+        if hour is None:
             # Something's gone wrong. Ignore this line.
+            drop('bad date')
             continue
 
-        print('{0}\t{1}'.format(author, date.hour))
+        writer.write(author, hour)
+
+    writer.flush()
 
-if __name__ == '__main__':
-    mapper()
 
+def batchMapper(emit, cache=None):
+    """Same as `mapper()`, but converts BATCH_SIZE dates at a time.
+
+    :emit: The function that outputs a record, like `RecordWriter.write()`.
+    :cache: A cache to read nodes from, as in `mapper()`.
+    """
+    authors = []
+    dates = []
+
+    def flush():
+        for author, hour in zip(authors, parseHours(dates)):
+            # Invalid dates are ignored, just like in `mapper()`
+            if hour is not None:
+                emit(author, hour)
+            else:
+                drop('bad date')
+        del authors[:]
+        del dates[:]
+
+    for author, date in loadNodes(FIELDS, cache):
+        authors.append(author)
+        dates.append(date)
+        if len(dates) >= BATCH_SIZE:
+            flush()
+    flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the mapper."
+    parser = argparse.ArgumentParser(
+        description='Mapper for the Student Times exercise.')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Convert dates in batches, using NumPy.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Output binary records (for local runs only).')
+    parser.add_argument('--cache',
+                        help='Read nodes from this cache (see build_cache.py) '
+                        'instead of standard input, if it is fresh.')
+    parser.add_argument('input', nargs='?',
+                        help='Read nodes from this file instead of standard '
+                        'input, splitting it among --workers processes.')
+    parser.add_argument('--workers', type=int,
+                        help='How many processes to use when given a file. '
+                        'Default: one per CPU.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.input is not None and args.cache is not None:
+        parser.error('--cache holds the whole input and cannot be split '
+                     'among workers')
+
+    if args.numpy and np is None:
+        parser.error('--numpy requires NumPy to be installed')
+
+    with instrumented('student_times_mapper', args.counters, args.stats,
+                      args.profile):
+        if args.input is None:
+            mapper(batch=args.numpy, binary=args.binary, cache=args.cache)
+        else:
+            mapFile(args.input, args.workers, mapper, batch=args.numpy,
+                    binary=args.binary)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,32 @@
 from __future__ import print_function
 
 import sys
+import argparse
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by batchReducer()
+    np = None
+
+from common import RecordCodec, RecordWriter, addInstrumentationArguments, \
+    drop, instrumented, timed
+
+# Layout of our records in binary mode. Must match the mapper's.
+RECORD_LAYOUTS = ('nB',)
+CODEC = RecordCodec(*RECORD_LAYOUTS)
+
+# How much input batchReducer() handles at once: characters of text read from
+# a stream, or lines (or records) read from anything else
+BATCH_SIZE = 1 << 20
+
+# The author reducer() starts with. See `mergeRuns()`.
+NO_AUTHOR = '-1'
+
+# What follows the author in each line of output, by hour
+HOUR_SUFFIXES = ['\t{0}'.format(hour) for hour in range(24)]
+
 
 def increment(postHours, hour):
     """Increments the number of times a user has posted in a giver hour.
@@ -39,15 +65,16 @@ def getMatchingIndices(iterable, value):
     return [i for i, e in enumerate(iterable) if e == value]
 
 
-def output(author, postHours):
+def output(author, postHours, writer):
     """Outputs the hours on which a user most usually posts.
 
     :author: The author whose hours "belong" to.
     :postHours: The state about this author.
+    :writer: The RecordWriter to output to.
     """
     maximum = max(postHours)
     for hour in getMatchingIndices(postHours, maximum):
-        print('{0}\t{1}'.format(author, hour))
+        writer.write(author, hour)
 
 
 def getData(line):
@@ -56,10 +83,10 @@ def getData(line):
     Makes sure a line is valid before outputting it to the mapper by doing some
     basic sanity checks.
 
-    :line: The line to be validated.
+    :line: The line to be validated. Binary records come already split.
     :returns: The data in the format expected if it is valid. None otherwise.
     """
-    data = line.strip().split('\t')
+    data = line.strip().split('\t') if isinstance(line, str) else line
 
     # Our mapper outputs two columns. Anything different than that can be
     # considered corrupt
@@ -77,19 +104,23 @@ def getData(line):
 
     return author, hour
 
-def reducer():
+def reducer(binary=False):
     """Reducer function.
 
+    :binary: Whether the input holds binary records instead of text.
     :returns: Nothing. Writes to standard output.
     """
 
     # Init the reducer
-    lastAuthor = '-1'
+    lastAuthor = NO_AUTHOR
     postHours = emptyHours()
+    writer = RecordWriter()
 
-    for line in sys.stdin:
+    records = CODEC.readRecords(sys.stdin) if binary else sys.stdin
+    for line in timed(records, 'read'):
         data = getData(line)
         if data is None:
+            drop('malformed record')
             continue
         author, hour = data
 
@@ -99,8 +130,8 @@ def reducer():
         if author != lastAuthor:
             # We don't want to output data because the line we read is
             # different from the initialization data.
-            if lastAuthor != '-1':
-                output(lastAuthor, postHours)
+            if lastAuthor != NO_AUTHOR:
+                output(lastAuthor, postHours, writer)
                 postHours = emptyHours()
 
         # Increment the counter for the current hour
@@ -109,8 +140,203 @@ def reducer():
         lastAuthor = author
 
     # We exited the loop, but we still have state stored. Output it.
-    output(author, postHours)
+    output(author, postHours, writer)
+    writer.flush()
+
+
+def readChunks(records, size=BATCH_SIZE):
+    """Splits the reducer input into chunks of whole lines.
+
+    :records: The input: a text stream, an iterable of lines or an iterable of
+              binary records.
+    :size: How many characters (or lines, or records) go in a chunk.
+    :returns: A generator of chunks. Chunks of text are strings, and chunks of
+              binary records are lists.
+    """
+    if hasattr(records, 'read'):
+        rest = ''
+        while True:
+            block = records.read(size)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind('\n') + 1
+            if end:
+                yield block[:end]
+            rest = block[end:]
+        if rest:
+            yield rest
+        return
+
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            break
+        yield ''.join(chunk) if isinstance(chunk[0], str) else chunk
+
+
+def parseChunk(chunk):
+    """Gets the authors and hours of the valid lines in a chunk.
+
+    Chunks where every line looks like "author<TAB>hour", with an ASCII author
+    that doesn't start with whitespace and a hour of one or two digits, are
+    parsed with NumPy. Anything else goes through `getData()` line by line, so
+    the result is the same either way.
+
+    :chunk: A chunk, as returned by `readChunks()`.
+    :returns: A tuple with a list of authors and an array of hours (modulo 24,
+              as `increment()` would use them).
+    """
+    if isinstance(chunk, str) and chunk.endswith('\n') and chunk.isascii():
+        data = np.frombuffer(chunk.encode('ascii'), dtype=np.uint8)
+        tabs = np.flatnonzero(data == ord('\t'))
+        newlines = np.flatnonzero(data == ord('\n'))
+        if len(tabs) == len(newlines):
+            starts = np.concatenate(([0], newlines[:-1] + 1))
+            digits = newlines - tabs - 1
+            # A single tab per line, with something before it, and no
+            # whitespace that getData() would strip
+            valid = ((starts < tabs).all() and (tabs < newlines).all() and
+                     (data[starts] > ord(' ')).all() and
+                     ((digits == 1) | (digits == 2)).all())
+            if valid:
+                first = data[tabs + 1].astype(np.int64) - ord('0')
+                # For one-digit hours, this is the newline
+                second = data[tabs + 2].astype(np.int64) - ord('0')
+                second = np.where(digits == 2, second, 0)
+                valid = ((first >= 0).all() and (first <= 9).all() and
+                         (second >= 0).all() and (second <= 9).all())
+            if valid:
+                hours = np.where(digits == 2, first * 10 + second, first)
+                authors = [chunk[start:tab] for start, tab
+                           in zip(starts.tolist(), tabs.tolist())]
+                return authors, hours % 24
+
+    if isinstance(chunk, str):
+        chunk = chunk.split('\n')
+    authors = []
+    hours = []
+    for line in chunk:
+        data = getData(line)
+        if data is not None:
+            authors.append(data[0])
+            hours.append(data[1] % 24)
+        elif line:
+            drop('malformed record')
+    return authors, np.array(hours, dtype=np.int64)
+
+
+def countHours(authors, hours):
+    """Counts the posts of each run of lines of the same author, per hour.
+
+    :authors: The authors of the lines.
+    :hours: The hours of the lines, modulo 24.
+    :returns: A tuple with the author of each run and an array with a row of
+              24 counts per run.
+    """
+    keys = np.array(authors, dtype=object)
+    newRun = np.concatenate(([True], keys[1:] != keys[:-1]))
+    starts = np.flatnonzero(newRun)
+    runs = np.cumsum(newRun) - 1
+    counts = np.bincount(runs * 24 + hours, minlength=len(starts) * 24)
+    return [authors[start] for start in starts.tolist()], \
+        counts.reshape(len(starts), 24)
+
+
+def mergeRuns(authors, counts):
+    """Merges runs the way `reducer()` would, except for the last one.
+
+    `reducer()` never outputs the author it starts with, NO_AUTHOR: the posts
+    of a run of that author are added to the next run instead. The last run
+    is left alone, since more lines of its author may follow.
+
+    :authors: The author of each run.
+    :counts: The counts of each run, as returned by `countHours()`.
+    :returns: The authors and counts, without the merged runs.
+    """
+    if NO_AUTHOR not in authors[:-1]:
+        return authors, counts
+    keep = []
+    for run, author in enumerate(authors):
+        if author == NO_AUTHOR and run + 1 < len(authors):
+            counts[run + 1] += counts[run]
+        else:
+            keep.append(run)
+    return [authors[run] for run in keep], counts[keep]
+
+
+def outputRuns(authors, counts, writer):
+    """Outputs the hours on which each run's author most usually posts.
+
+    Same as calling `output()` for each run.
+
+    :authors: The author of each run.
+    :counts: The counts of each run, as returned by `countHours()`.
+    :writer: The RecordWriter to output to.
+    """
+    tied = counts == counts.max(axis=1)[:, np.newaxis]
+    # Row-major order: runs in order, and the hours of each run in order
+    runs, hours = np.nonzero(tied)
+    writer.writeLines([authors[run] + HOUR_SUFFIXES[hour]
+                       for run, hour in zip(runs.tolist(), hours.tolist())])
+
+
+def batchReducer(binary=False, batchSize=BATCH_SIZE):
+    """Same as `reducer()`, but handles its input in chunks, with NumPy.
+
+    :binary: Whether the input holds binary records instead of text.
+    :batchSize: How much input to handle at once. See BATCH_SIZE.
+    :returns: Nothing. Writes to standard output.
+    """
+    writer = RecordWriter()
+    records = CODEC.readRecords(sys.stdin) if binary else sys.stdin
+
+    # The last run of the previous chunk: its author and counts
+    pending = None
+    for chunk in timed(readChunks(records, batchSize), 'read', 'Chunks read'):
+        authors, hours = parseChunk(chunk)
+        if not authors:
+            continue
+        authors, counts = countHours(authors, hours)
+
+        if pending is not None:
+            if pending[0] == authors[0]:
+                counts[0] += pending[1]
+            else:
+                authors = [pending[0]] + authors
+                counts = np.vstack((pending[1], counts))
+        authors, counts = mergeRuns(authors, counts)
+
+        outputRuns(authors[:-1], counts[:-1], writer)
+        pending = authors[-1], counts[-1]
+
+    if pending is not None:
+        outputRuns([pending[0]], pending[1][np.newaxis], writer)
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the reducer."
+    parser = argparse.ArgumentParser(
+        description='Reducer for the Student Times exercise.')
+    parser.add_argument('--binary', action='store_true',
+                        help='Read binary records (for local runs only).')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Count hours in batches, using NumPy.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.numpy and np is None:
+        parser.error('--numpy requires NumPy to be installed')
+
+    with instrumented('student_times_reducer', args.counters, args.stats,
+                      args.profile):
+        if args.numpy:
+            batchReducer(binary=args.binary)
+        else:
+            reducer(binary=args.binary)
 
 
 if __name__ == '__main__':
-    reducer()
+    main()
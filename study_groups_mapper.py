@@ -3,56 +3,78 @@
 
 from __future__ import print_function
 
-import sys
-import csv
+import argparse
 
-from common import getField, isValidNodeLine
+from common import RecordWriter, addInstrumentationArguments, instrumented, \
+    loadNodes, mapFile
 
 # To make our reducers lives' easier, we want questions before the rest. {{{
 QUESTION = 'A'
 WHATEVER = 'B'
 # }}}
 
-def mapper():
+# The fields we're interested in. See the comments in `mapper()`
+FIELDS = ('id', 'node_type', 'abs_parent_id', 'author_id')
+
+def mapper(cache=None):
     """Mapper function.
 
     Input is read from sys.stdin and written to sys.stdout. Both streams can be
     overwritten if needed.
 
+    :cache: A cache to read nodes from instead of sys.stdin, if it is fresh.
+            See `common.loadNodes()`.
     :returns: Nothing. Writes to standard output.
     """
 
-    # The input file is saved as a tab-separated file. The data itself comes from
-    # http://content.udacity-data.com/course/hadoop/forum_data.tar.gz -- file
-    # "forum_nodes.tsv".
-    reader = csv.reader(sys.stdin, delimiter='\t')
-
-    for line in reader:
-        # Basic data sanity check
-        if not isValidNodeLine(line):
-            continue
+    writer = RecordWriter()
 
+    # The input file is saved as a tab-separated file. The data itself comes
+    # from http://content.udacity-data.com/course/hadoop/forum_data.tar.gz --
+    # file "forum_nodes.tsv". readNodes parses it and drops the invalid lines.
+    for node, nodeType, parent, author in loadNodes(FIELDS, cache):
         # The fields we're interested in. Question represent new threads,
         # comments & answers, posts to that thread. Hence, we need the node id
         # for questions and the parent id for answers / comments. We obviously
         # need the author id as well, so we can group that.
-        node = getField(line, 'id')
-        nodeType = getField(line, 'node_type')
-        parent = getField(line, 'abs_parent_id')
-        author = getField(line, 'author_id')
-
-        # If any of the fields we're interested in is None, then it is no good
-        # for us. Drop this line altogether.
-        if any(map(lambda x: x == None, (node, nodeType, parent, author))):
-            continue
 
         # Data output, as announced by the comments above
         if nodeType == 'question':
-            print('{0}\t{1}\t{2}'.format(node, QUESTION, author))
+            writer.write(node, QUESTION, author)
+        else:
+            writer.write(parent, WHATEVER, author)
+
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the mapper."
+    parser = argparse.ArgumentParser(
+        description='Mapper for the Study Groups exercise.')
+    parser.add_argument('--cache',
+                        help='Read nodes from this cache (see build_cache.py) '
+                        'instead of standard input, if it is fresh.')
+    parser.add_argument('input', nargs='?',
+                        help='Read nodes from this file instead of standard '
+                        'input, splitting it among --workers processes.')
+    parser.add_argument('--workers', type=int,
+                        help='How many processes to use when given a file. '
+                        'Default: one per CPU.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.input is not None and args.cache is not None:
+        parser.error('--cache holds the whole input and cannot be split '
+                     'among workers')
+
+    with instrumented('study_groups_mapper', args.counters, args.stats,
+                      args.profile):
+        if args.input is None:
+            mapper(cache=args.cache)
         else:
-            print('{0}\t{1}\t{2}'.format(parent, WHATEVER, author))
+            mapFile(args.input, args.workers, mapper)
 
 
 if __name__ == '__main__':
-    mapper()
+    main()
 
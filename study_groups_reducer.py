@@ -5,19 +5,67 @@
 
 .. _Study Groups: https://www.udacity.com/course/viewer#!/c-ud617/l-717558831/m-730138597
 
+By default, every post of a thread adds its author to the output, repeated
+authors included. With ``--unique``, each author is output once per thread,
+in the order they first posted (with ``--counts``, along with how many posts
+they made, as ``author:posts``). Authors are then kept as integers in arrays,
+rather than as a list of strings, and ``--max-authors`` bounds how many are
+waiting to be output: past that, the authors held so far are output and the
+thread continues in another line. Every distinct author of the thread is
+still remembered, so that it is output only once.
+
+With ``--graph``, the reducer also saves who posted in which thread, as
+NumPy arrays, to a file: a sparse author by thread matrix of post counts,
+and, for each author, how many threads they share with every other author.
+Both are in compressed sparse row (CSR) form, so the threads of an author
+and the authors they study with are found without reading anything else::
+
+    python study_groups_reducer.py --graph groups.npz < sorted-records
+    python study_groups_reducer.py --graph groups.npz --study-with 100042
+
+Each reducer only knows about its own threads, so the graph is complete only
+when a single reducer gets every thread: ``--graph`` refuses to run in a job
+with more reducers, as told by Hadoop Streaming's environment.
+
 .. module:: study_groups_reducer
 .. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
 """
 
 from __future__ import print_function
 
+import os
 import sys
+import argparse
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by ParticipationIndex and Participation
+    np = None
+
+from common import RecordWriter, addInstrumentationArguments, drop, \
+    instrumented, timed
 
 # To make our reducers lives' easier, we want questions before the rest. {{{
 QUESTION = 'A'
 WHATEVER = 'B'
 # }}}
 
+# Position of an author that was already output. See `AuthorSet`.
+OUTPUT = -1
+
+# Graph mode. See `ParticipationIndex`. {{{
+# How many pairs of authors are expanded at once
+PAIR_BATCH = 1 << 20
+# Pairs of authors are packed in an integer: the first one's row is shifted
+# left by this many bits, and the second one's row fills them
+PAIR_SHIFT = 32
+# The environment variables Hadoop Streaming (or local_mapreduce.py) sets to
+# the number of reducers of the job, in newer and older versions
+REDUCERS_VARIABLES = ('mapreduce_job_reduces', 'mapred_reduce_tasks')
+# }}}
+
 
 def getData(line):
     """Basic sanity checking function.
@@ -41,20 +89,22 @@ def getData(line):
     return node, True if nodeType == QUESTION else False, author
 
 
-def output(thread, authors):
+def output(thread, authors, writer):
     """Outputs the information this reducer has consolidated.
 
     :thread: The thread id we're outputting information about.
     :authors: The list of authors that has contributed to this thread.
+    :writer: The RecordWriter to output to.
     :returns: None.
 
     """
-    print('{0}\t{1}'.format(thread, ','.join(authors)))
+    writer.write(thread, ','.join(authors))
 
 
-def reducer():
+def reducer(graph=None):
     """Reducer function.
 
+    :graph: A ParticipationIndex to add the threads to as well, if any.
     :returns: Nothing. Writes to standard output.
 
     """
@@ -65,9 +115,11 @@ def reducer():
     # Holds the thread id (the node id of the question that originated this
     # thread)
     lastThread = None
-    for line in sys.stdin:
+    writer = RecordWriter()
+    for line in timed(sys.stdin, 'read'):
         data = getData(line)
         if data is None:
+            drop('malformed record')
             continue
 
         # Unpack our data. See `getData()`
@@ -85,16 +137,458 @@ def reducer():
 
             # No point in printing info about a thread that doesn't exist
             if lastThread is not None:
-                output(lastThread, authors)
+                output(lastThread, authors, writer)
                 authors = []
+                if graph is not None:
+                    graph.endThread(lastThread)
 
         authors.append(author)
+        if graph is not None:
+            graph.add(author)
 
         lastThread = thread
 
     # Leftover state from the loop
-    output(lastThread, authors)
+    output(lastThread, authors, writer)
+    if graph is not None and lastThread is not None:
+        graph.endThread(lastThread)
+    writer.flush()
+
+
+class AuthorSet(object):
+    """The distinct authors of a thread, in the order they first posted.
+
+    Author ids are kept as machine integers, in an array, along with the
+    number of posts of each author (when counting) in another array. The few
+    ids that don't look like integers are kept as strings, and stand for a
+    negative integer in the array.
+    """
+
+    def __init__(self, counts=False):
+        """Creates an empty set.
+
+        :counts: Whether to count the posts of each author.
+        """
+        self.ids = array('l')
+        self.counts = array('l') if counts else None
+        # Where each author is in `ids`, or OUTPUT
+        self.positions = {}
+        self.names = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _encode(self, author):
+        "Returns the integer that stands for an author."
+        if author.isdigit() and author.isascii() and \
+                (author == '0' or author[0] != '0'):
+            return int(author)
+        code = self.codes.get(author)
+        if code is None:
+            self.names.append(author)
+            code = self.codes[author] = -len(self.names)
+        return code
+
+    def _decode(self, code):
+        "Returns the author an integer stands for."
+        return str(code) if code >= 0 else self.names[-code - 1]
+
+    def add(self, author):
+        "Adds a post of an author."
+        if author.isdigit() and author.isascii() and author[0] != '0':
+            # The usual case, handled here rather than by `_encode()`
+            code = int(author)
+        else:
+            code = self._encode(author)
+        position = self.positions.get(code)
+        if position is None:
+            self.positions[code] = len(self.ids)
+            self.ids.append(code)
+            if self.counts is not None:
+                self.counts.append(1)
+        elif self.counts is not None:
+            if position == OUTPUT:
+                self.positions[code] = len(self.ids)
+                self.ids.append(code)
+                self.counts.append(1)
+            else:
+                self.counts[position] += 1
+
+    def take(self):
+        """Returns the authors held, formatted for output, and forgets them.
+
+        Authors that were taken are not added again, unless posts are being
+        counted: then their later posts are counted from zero, and the counts
+        of an author in different lines must be added up.
+
+        :returns: A list of strings.
+        """
+        if self.counts is None:
+            authors = [self._decode(code) for code in self.ids]
+        else:
+            authors = ['{0}:{1}'.format(self._decode(code), count)
+                       for code, count in zip(self.ids, self.counts)]
+            del self.counts[:]
+        for code in self.ids:
+            self.positions[code] = OUTPUT
+        del self.ids[:]
+        return authors
+
+
+class ParticipationIndex(object):
+    """Who posted in which thread, built one thread at a time.
+
+    Authors and threads are numbered in the order they are first seen. As
+    each thread ends, its authors are appended to the author by thread
+    matrix, kept as coordinate arrays. Once the threads not counted yet add
+    up to `pairBatch` pairs of authors, the pairs are expanded with NumPy
+    into (author, other author) edges, at most `pairBatch` at a time, even
+    within a thread, and counted with np.unique(). These runs of counts are
+    merged into the pairs counted so far when they add up to as many pairs,
+    so that memory grows with the number of distinct pairs, at 16 bytes
+    each. `save()` turns both into CSR arrays. See `Participation`.
+    """
+
+    def __init__(self, pairBatch=PAIR_BATCH):
+        """Creates an empty index.
+
+        :pairBatch: How many pairs of authors to expand at once.
+        """
+        self.authors = []
+        self.threads = []
+        # The row of each author
+        self.rows = {}
+        # The matrix, as (author, thread, posts) entries, by thread
+        self.entryRows = array('l')
+        self.entryThreads = array('l')
+        self.entryPosts = array('l')
+        # The pairs of authors that share threads, as keys made by
+        # `_pairKeys()`, sorted, and how many threads each pair shares
+        self.pairKeys = np.zeros(0, dtype=np.int64)
+        self.pairCounts = np.zeros(0, dtype=np.int64)
+        # Pairs counted since, as (keys, counts) runs, and how many
+        self.runs = []
+        self.runPairs = 0
+        # The first entry whose thread's pairs aren't counted yet, and how
+        # many pairs those threads have
+        self.counted = 0
+        self.pending = 0
+        self.pairBatch = pairBatch
+        # The posts of each author in the thread being read
+        self.posts = {}
+
+    def add(self, author):
+        "Adds a post of an author to the thread being read."
+        self.posts[author] = self.posts.get(author, 0) + 1
+
+    def endThread(self, thread):
+        """Adds the thread being read to the index.
+
+        :thread: The thread's id.
+        """
+        column = len(self.threads)
+        self.threads.append(thread)
+        for author, posts in self.posts.items():
+            row = self.rows.get(author)
+            if row is None:
+                row = self.rows[author] = len(self.authors)
+                self.authors.append(author)
+            self.entryRows.append(row)
+            self.entryThreads.append(column)
+            self.entryPosts.append(posts)
+        size = len(self.posts)
+        self.posts = {}
+
+        self.pending += size * (size - 1)
+        if self.pending >= self.pairBatch:
+            self._countPairs()
+
+    def _countPairs(self):
+        "Counts the pairs of authors of the threads not counted yet."
+        start = self.counted
+        self.counted = len(self.entryRows)
+        self.pending = 0
+        if start == self.counted:
+            return
+
+        rows = np.array(self.entryRows[start:], dtype=np.int64)
+        threads = np.array(self.entryThreads[start:], dtype=np.int64)
+        # Where each thread starts, and how many authors it has
+        firsts = np.flatnonzero(np.diff(threads, prepend=-1))
+        sizes = np.diff(np.append(firsts, len(rows)))
+        # Each entry is paired with every entry of its thread, itself
+        # included, which makes as many edges as the thread has entries
+        edges = np.repeat(sizes, sizes)
+        threadFirsts = np.repeat(firsts, sizes)
+        ends = np.cumsum(edges)
+
+        begin = 0
+        while begin < len(rows):
+            end = np.searchsorted(ends, ends[begin] - edges[begin] +
+                                  self.pairBatch, side='right')
+            end = max(end, begin + 1)
+            entryEdges = edges[begin:end]
+            # The n-th edge goes to the entry n - (the entry's first edge)
+            # positions after the first one of the thread
+            targets = np.repeat(threadFirsts[begin:end] - ends[begin:end] +
+                                entryEdges + ends[begin] - edges[begin],
+                                entryEdges)
+            targets += np.arange(len(targets))
+            targets = rows[targets]
+            sources = np.repeat(rows[begin:end], entryEdges)
+            # Authors appear once per thread, so pairs of the same author
+            # are the edges from entries to themselves
+            keys, counts = np.unique(
+                _pairKeys(sources, targets)[sources != targets],
+                return_counts=True)
+            del sources, targets
+            self.runs.append((keys, counts))
+            self.runPairs += len(keys)
+            if self.runPairs >= len(self.pairKeys):
+                self._mergeRuns()
+            begin = end
+
+    def _mergeRuns(self):
+        "Merges the runs of counted pairs into the pairs counted so far."
+        if not self.runs:
+            return
+        keys = np.concatenate([self.pairKeys] +
+                              [keys for keys, _ in self.runs])
+        counts = np.concatenate([self.pairCounts] +
+                                [counts for _, counts in self.runs])
+        self.pairKeys = self.pairCounts = None
+        self.runs = []
+        self.runPairs = 0
+        # Every run is sorted already, which a stable sort takes advantage of
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        counts = counts[order]
+        del order
+        firsts = np.flatnonzero(np.diff(keys, prepend=-1))
+        self.pairKeys = keys[firsts]
+        del keys
+        self.pairCounts = np.add.reduceat(counts, firsts)
+
+    def arrays(self):
+        """Returns the index as NumPy arrays.
+
+        :returns: A dict with the arrays described in `Participation`.
+        """
+        self._countPairs()
+        self._mergeRuns()
+        entryRows = np.array(self.entryRows, dtype=np.int64)
+        order = np.argsort(entryRows, kind='stable')
+        rowSizes = np.bincount(entryRows, minlength=len(self.authors))
+
+        # Keys are sorted by author, then by the other author
+        sources = self.pairKeys >> PAIR_SHIFT
+        others = self.pairKeys & ((1 << PAIR_SHIFT) - 1)
+        sharedSizes = np.bincount(sources, minlength=len(self.authors))
+
+        return {
+            'authors': np.array(self.authors, dtype=str),
+            'threads': np.array(self.threads, dtype=str),
+            'indptr': _indptr(rowSizes),
+            'indices': np.array(self.entryThreads, dtype=np.int64)[order],
+            'posts': np.array(self.entryPosts, dtype=np.int64)[order],
+            'shared_indptr': _indptr(sharedSizes),
+            'shared_indices': others,
+            'shared_counts': self.pairCounts,
+        }
+
+    def save(self, path):
+        """Saves the index to a NumPy .npz file.
+
+        :path: The file's path, or a binary file object.
+        """
+        if isinstance(path, str):
+            # Otherwise np.savez() adds .npz to names without it
+            with open(path, 'wb') as stream:
+                np.savez(stream, **self.arrays())
+        else:
+            np.savez(path, **self.arrays())
+
+
+def _pairKeys(sources, others):
+    "Packs pairs of author rows into integers that sort like the pairs."
+    return (sources << PAIR_SHIFT) | others
+
+
+def reduceTasks():
+    """Returns how many reducers the job running this one has, as Hadoop
+    Streaming (or local_mapreduce.py) tells through the environment. Outside
+    of a job, there is only this one.
+    """
+    for name in REDUCERS_VARIABLES:
+        value = os.environ.get(name)
+        if value:
+            return int(value)
+    return 1
+
+
+def _indptr(sizes):
+    "Returns the row pointers of a CSR matrix with rows of the given sizes."
+    indptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=indptr[1:])
+    return indptr
+
+
+class Participation(object):
+    """Who posted in which thread, as saved by `ParticipationIndex.save()`.
+
+    The author by thread matrix is held in CSR form: the threads of the
+    author in row i are ``threads[indices[indptr[i]:indptr[i + 1]]]``, and
+    their posts in each, ``posts[indptr[i]:indptr[i + 1]]``. The authors
+    they share threads with, and how many, are held likewise in
+    ``shared_indptr``, ``shared_indices`` and ``shared_counts``.
+    """
+
+    def __init__(self, arrays):
+        """Wraps the arrays of an index.
+
+        :arrays: A mapping with the arrays returned by
+                 `ParticipationIndex.arrays()`.
+        """
+        for name in ('authors', 'threads', 'indptr', 'indices', 'posts',
+                     'shared_indptr', 'shared_indices', 'shared_counts'):
+            setattr(self, name, arrays[name])
+        self.rows = {author: row for row, author in
+                     enumerate(self.authors.tolist())}
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved by `ParticipationIndex.save()`.
+
+        :path: The file's path.
+        :returns: A Participation.
+        """
+        with np.load(path) as arrays:
+            return cls(arrays)
+
+    def threadsOf(self, author):
+        """Returns the threads an author posted in.
+
+        :author: The author's id.
+        :returns: A list of (thread, posts) tuples, in the order the threads
+                  were read. Empty if the author is unknown.
+        """
+        row = self.rows.get(author)
+        if row is None:
+            return []
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return list(zip(self.threads[self.indices[start:end]].tolist(),
+                        self.posts[start:end].tolist()))
+
+    def studiesWith(self, author):
+        """Returns the authors that posted in threads an author posted in.
+
+        :author: The author's id.
+        :returns: A list of (author, threads in common) tuples, from the most
+                  threads in common to the least. Empty if the author is
+                  unknown.
+        """
+        row = self.rows.get(author)
+        if row is None:
+            return []
+        start, end = self.shared_indptr[row], self.shared_indptr[row + 1]
+        others = zip(self.authors[self.shared_indices[start:end]].tolist(),
+                     self.shared_counts[start:end].tolist())
+        return sorted(others, key=lambda pair: -pair[1])
+
+
+def uniqueReducer(counts=False, maxAuthors=None, graph=None):
+    """Same as `reducer()`, but outputs each author only once per thread.
+
+    :counts: Whether to output how many posts each author made as well.
+    :maxAuthors: How many authors to hold for a thread, at most. Past that,
+                 they are output, and the thread continues in another line.
+                 None means no limit.
+    :graph: A ParticipationIndex to add the threads to as well, if any.
+    :returns: Nothing. Writes to standard output.
+    """
+    authors = None
+    lastThread = None
+    writer = RecordWriter()
+    for line in timed(sys.stdin, 'read'):
+        data = getData(line)
+        if data is None:
+            drop('malformed record')
+            continue
+        thread, newThread, author = data
+
+        if thread != lastThread:
+            if lastThread is not None and len(authors):
+                output(lastThread, authors.take(), writer)
+            if graph is not None and lastThread is not None:
+                graph.endThread(lastThread)
+            authors = AuthorSet(counts)
+            lastThread = thread
+
+        authors.add(author)
+        if graph is not None:
+            graph.add(author)
+        if maxAuthors is not None and len(authors) >= maxAuthors:
+            output(thread, authors.take(), writer)
+
+    if lastThread is not None and len(authors):
+        output(lastThread, authors.take(), writer)
+    if graph is not None and lastThread is not None:
+        graph.endThread(lastThread)
+    writer.flush()
+
+
+def main(argv=None):
+    "Parses the command line and runs the reducer."
+    parser = argparse.ArgumentParser(
+        description='Reducer for the Study Groups exercise.')
+    parser.add_argument('--unique', action='store_true',
+                        help='Output each author only once per thread.')
+    parser.add_argument('--counts', action='store_true',
+                        help='Output how many posts each author made in the '
+                        'thread. Implies --unique.')
+    parser.add_argument('--max-authors', type=int,
+                        help='Output the authors of a thread in lines of at '
+                        'most this many. Implies --unique.')
+    parser.add_argument('--graph',
+                        help='Save who posted in which thread, and who '
+                        'shares threads with whom, to this .npz file.')
+    parser.add_argument('--study-with', metavar='AUTHOR',
+                        help='Instead of reducing, output the authors that '
+                        'share threads with this one, according to --graph.')
+    addInstrumentationArguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.max_authors is not None and args.max_authors < 1:
+        parser.error('--max-authors must be at least 1')
+    if (args.graph is not None or args.study_with is not None) and \
+            np is None:
+        parser.error('--graph requires NumPy to be installed')
+    if args.study_with is not None and args.graph is None:
+        parser.error('--study-with needs the --graph to read from')
+    if args.graph is not None and args.study_with is None and \
+            reduceTasks() > 1:
+        parser.error('--graph needs every thread in a single reducer, but '
+                     'the job has {0} reducers'.format(reduceTasks()))
+
+    if args.study_with is not None:
+        graph = Participation.load(args.graph)
+        writer = RecordWriter()
+        for author, threads in graph.studiesWith(args.study_with):
+            writer.write(author, threads)
+        writer.flush()
+        return
+
+    graph = ParticipationIndex() if args.graph is not None else None
+    with instrumented('study_groups_reducer', args.counters, args.stats,
+                      args.profile):
+        if args.unique or args.counts or args.max_authors is not None:
+            uniqueReducer(args.counts, args.max_authors, graph)
+        else:
+            reducer(graph)
+        if graph is not None:
+            graph.save(args.graph)
 
 
 if __name__ == '__main__':
-    reducer()
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Tests for common.py. Run them with ``python -m unittest``.
+
+.. module:: test_common
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+import io
+import os
+import csv
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+import contextlib
+
+from common import BODY_LENGTH, NODE_FIELDS, STDIN_NEWLINE, isCacheOf, \
+    isValidNodeLine, loadNodes, readLines, readNodes, writeCache
+
+# The fields every test reads
+FIELDS = ('id', 'title', 'body', BODY_LENGTH, 'node_type', 'marked')
+
+# Where common.py is
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Prints the nodes read from the real sys.stdin, by csv.reader or readNodes
+STDIN_READER = """
+import csv, sys
+from common import isValidNodeLine, readNodes
+if sys.argv[1] == 'csv':
+    rows = [(row[0], row[4]) for row in csv.reader(sys.stdin, delimiter='\\t')
+            if isValidNodeLine(row)]
+else:
+    rows = list(readNodes(('id', 'body')))
+print(repr(rows))
+"""
+
+
+def formatNode(node, body, title='Title'):
+    "Formats a line of forum_nodes.tsv, without its newline."
+    fields = ['\\N'] * len(NODE_FIELDS)
+    fields[0] = str(node)
+    fields[1] = title
+    fields[4] = body
+    fields[5] = 'question'
+    return '\t'.join('"' + field.replace('"', '""') + '"' for field in fields)
+
+
+def textStream(data, newline=STDIN_NEWLINE):
+    """Returns a text stream over some bytes. By default, it splits lines
+    like sys.stdin does.
+    """
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8',
+                            newline=newline)
+
+
+def readBaseline(data, fieldNames, newline=STDIN_NEWLINE):
+    """Reads nodes the way the mappers did before readNodes: with csv.reader
+    over a text stream, sys.stdin by default.
+    """
+    indices = [NODE_FIELDS.index('body' if name == BODY_LENGTH else name)
+               for name in fieldNames]
+    nodes = []
+    for line in csv.reader(textStream(data, newline), delimiter='\t'):
+        if not isValidNodeLine(line):
+            continue
+        nodes.append(tuple(len(line[index]) if name == BODY_LENGTH
+                           else line[index]
+                           for name, index in zip(fieldNames, indices)))
+    return nodes
+
+
+class NewlineTest(unittest.TestCase):
+    """Carriage returns are read like csv.reader reads them from a text
+    stream: from sys.stdin by default, or with universal newlines.
+    """
+
+    def assertSameNodes(self, data):
+        for newline in (STDIN_NEWLINE, None, '\n'):
+            try:
+                expected = readBaseline(data, FIELDS, newline)
+            except csv.Error:
+                # Lone "\r" line endings, which csv.reader rejects unless
+                # they are translated. So must readNodes.
+                with self.assertRaises(csv.Error):
+                    list(readNodes(FIELDS, textStream(data, newline),
+                                   newline=newline))
+                continue
+            nodes = [tuple(node) for node in
+                     readNodes(FIELDS, textStream(data, newline),
+                               newline=newline)]
+            self.assertEqual(nodes, expected, newline)
+            self.assertTrue(nodes)
+
+    def test_crlfInsideQuotedFields(self):
+        data = '\n'.join([
+            '\t'.join('"' + name + '"' for name in NODE_FIELDS),
+            formatNode(1, 'body\r\nline2'),
+            formatNode(2, 'one\r\ntwo\r\nthree', title='a\r\nb'),
+            formatNode(3, 'plain'),
+        ]) + '\n'
+        self.assertSameNodes(data.encode('utf-8'))
+
+    def test_crInsideQuotedFields(self):
+        data = '\n'.join([
+            formatNode(1, 'body\rline2'),
+            formatNode(2, 'trailing\r'),
+            formatNode(3, '\rleading', title='t\ritle'),
+            formatNode(4, 'plain'),
+        ]) + '\n'
+        self.assertSameNodes(data.encode('utf-8'))
+
+    def test_crlfAndCrLineEndings(self):
+        lines = [formatNode(node, 'body {0}\r\nmore'.format(node))
+                 for node in range(1, 7)]
+        data = (lines[0] + '\r\n' + lines[1] + '\r' + lines[2] + '\r\n' +
+                lines[3] + '\n' + lines[4] + '\r' + lines[5] + '\r')
+        self.assertSameNodes(data.encode('utf-8'))
+
+    def test_sysStdin(self):
+        data = '\n'.join([
+            formatNode(1, 'body\r\nline2'),
+            formatNode(2, 'body\rline2'),
+            formatNode(3, 'plain'),
+        ]) + '\r\n'
+        outputs = [subprocess.run([sys.executable, '-c', STDIN_READER, mode],
+                                  input=data.encode('utf-8'), cwd=HERE,
+                                  stdout=subprocess.PIPE, check=True).stdout
+                   for mode in ('csv', 'readNodes')]
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn(b'body', outputs[0])
+
+    def test_universalNewlines(self):
+        data = formatNode(1, 'body\r\nline2\rline3') + '\n'
+        body, = [body for body, in readNodes(('body',),
+                                             textStream(data.encode('utf-8')),
+                                             newline=None)]
+        self.assertEqual(body, 'body\nline2\nline3')
+
+    def test_blockBoundaries(self):
+        data = b'a\r\nb\rc\r\r\nd\n\re\r'
+        for newline in (None, '\n'):
+            expected = textStream(data, newline).read().split('\n')
+            if not expected[-1]:
+                expected.pop()
+            for blockSize in range(1, len(data) + 1):
+                lines = list(readLines(textStream(data), blockSize, newline))
+                self.assertEqual(lines, expected, (newline, blockSize))
+
+
+class CacheTest(unittest.TestCase):
+    "A cache is only read instead of the input it was built from."
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test-common-')
+        self.source = self.writeNodes('source.tsv', 1)
+        self.other = self.writeNodes('other.tsv', 11)
+        self.cache = os.path.join(self.directory, 'source.tsv.cache')
+        with contextlib.redirect_stdout(io.StringIO()):
+            writeCache(self.source, self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeNodes(self, name, first):
+        "Writes a forum_nodes.tsv with three nodes, from a given id on."
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as stream:
+            for node in range(first, first + 3):
+                stream.write(formatNode(node, 'body') + '\n')
+        return path
+
+    def load(self, path):
+        "Returns the ids loadNodes reads with the cache, from a file."
+        with open(path, encoding='utf-8') as stream, \
+                contextlib.redirect_stderr(io.StringIO()) as warnings:
+            ids = [node for node, in loadNodes(('id',), self.cache, stream)]
+        return ids, warnings.getvalue()
+
+    def test_sourceReadsCache(self):
+        with open(self.source, encoding='utf-8') as stream:
+            self.assertTrue(isCacheOf(self.cache, stream))
+        ids, warnings = self.load(self.source)
+        self.assertEqual(ids, ['1', '2', '3'])
+        self.assertEqual(warnings, '')
+
+    def test_otherInputIsParsed(self):
+        with open(self.other, encoding='utf-8') as stream:
+            self.assertFalse(isCacheOf(self.cache, stream))
+        ids, warnings = self.load(self.other)
+        self.assertEqual(ids, ['11', '12', '13'])
+        self.assertIn('not built from the input', warnings)
+
+    def test_streamWithoutFile(self):
+        self.assertFalse(isCacheOf(self.cache, textStream(b'')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Tests for local_mapreduce.py. Run them with ``python -m unittest``.
+
+.. module:: test_local_mapreduce
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+import local_mapreduce
+
+
+class EmptyInputTest(unittest.TestCase):
+    "An empty input is valid, and gives an empty output."
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test-local-mapreduce-')
+        self.input = os.path.join(self.directory, 'forum_nodes.tsv')
+        open(self.input, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertEmptyOutput(self, partitioner):
+        output = os.path.join(self.directory, partitioner)
+        stats = local_mapreduce.run(
+            'study_groups_mapper', 'study_groups_reducer', self.input,
+            output, maps=2, reducers=2, processes=1, partitioner=partitioner)
+
+        self.assertEqual(stats['map tasks'], 0)
+        self.assertEqual(stats['partition records'], [0, 0])
+        parts = sorted(glob.glob(os.path.join(output, 'part-*')))
+        self.assertEqual(len(parts), 2)
+        for part in parts:
+            self.assertEqual(os.path.getsize(part), 0)
+
+    def test_hashPartitioner(self):
+        self.assertEmptyOutput('hash')
+
+    def test_rangePartitioner(self):
+        self.assertEmptyOutput('range')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Tests for study_groups_reducer.py. Run them with ``python -m unittest``.
+
+.. module:: test_study_groups_reducer
+.. moduleauthor:: Renato L. F. Cunha <renato@renatocunha.com>
+"""
+
+import io
+import os
+import random
+import itertools
+import unittest
+import contextlib
+from unittest import mock
+from collections import Counter
+
+import study_groups_reducer
+from study_groups_reducer import ParticipationIndex, np
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class ParticipationIndexTest(unittest.TestCase):
+    "Threads shared by pairs of authors are counted like one by one."
+
+    def buildIndex(self, pairBatch):
+        """Builds an index of random threads.
+
+        :returns: The index, and how many threads each pair of authors
+                  shares.
+        """
+        rand = random.Random(1)
+        index = ParticipationIndex(pairBatch)
+        expected = Counter()
+        for thread in range(300):
+            authors = set()
+            for _ in range(rand.randint(0, 15)):
+                author = str(rand.randint(0, 40))
+                index.add(author)
+                authors.add(author)
+            index.endThread(str(thread))
+            expected.update(itertools.permutations(authors, 2))
+        return index, expected
+
+    def test_sharedThreads(self):
+        # Batches of one pair, within threads, across threads, and all
+        for pairBatch in (1, 7, 100, study_groups_reducer.PAIR_BATCH):
+            index, expected = self.buildIndex(pairBatch)
+            arrays = index.arrays()
+            authors, indptr = arrays['authors'], arrays['shared_indptr']
+            shared = Counter()
+            for row, author in enumerate(authors):
+                others = arrays['shared_indices'][indptr[row]:indptr[row + 1]]
+                counts = arrays['shared_counts'][indptr[row]:indptr[row + 1]]
+                self.assertEqual(list(others), sorted(set(others)))
+                for other, count in zip(others, counts):
+                    shared[author, authors[other]] = int(count)
+            self.assertEqual(shared, expected, pairBatch)
+
+
+class ReducersTest(unittest.TestCase):
+    "--graph refuses to run in a job with more than one reducer."
+
+    def runMain(self, argv, environ):
+        with mock.patch.dict(os.environ, environ), \
+                contextlib.redirect_stderr(io.StringIO()) as errors, \
+                self.assertRaises(SystemExit) as exited:
+            study_groups_reducer.main(argv)
+        return exited.exception.code, errors.getvalue()
+
+    @unittest.skipIf(np is None, 'NumPy is not installed')
+    def test_manyReducers(self):
+        for name in study_groups_reducer.REDUCERS_VARIABLES:
+            code, errors = self.runMain(['--graph', 'groups.npz'],
+                                        {name: '2'})
+            self.assertEqual(code, 2)
+            self.assertIn('2 reducers', errors)
+
+    def test_reduceTasks(self):
+        environ = {'mapred_reduce_tasks': '4'}
+        with mock.patch.dict(os.environ, environ):
+            self.assertEqual(study_groups_reducer.reduceTasks(), 4)
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(study_groups_reducer.reduceTasks(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()